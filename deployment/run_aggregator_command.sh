@@ -1 +1 @@
-sudo -u hepdata -H bash -c '/hepdata/env/bin/python /hepdata/hepdata-explore/server-aggregator/run_aggregator.py add /hepdata/data/*/*'
+sudo -u hepdata -H bash -c '/hepdata/env/bin/python /hepdata/hepdata-explore/server-aggregator/run_aggregator.py add --suggestions-dir /hepdata/hepdata-explore/frontend/suggestions /hepdata/data/*/*'
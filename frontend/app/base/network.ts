@@ -37,8 +37,10 @@ export function asyncFetch(xhr: XMLHttpRequest, data: any = null): Promise<void>
             if (xhr.status >= 200 && xhr.status < 300) {
                 resolve();
             } else {
+                // responseText is not available for binary responses
                 reject(new HTTPError(xhr.status, xhr.statusText,
-                    tryParseJSON(xhr.responseText)));
+                    xhr.responseType == '' || xhr.responseType == 'text'
+                        ? tryParseJSON(xhr.responseText) : null));
             }
         };
         xhr.onerror = function () {
@@ -63,6 +65,50 @@ export function jsonPOST(url: string, data: {}): Promise<any> {
         })
 }
 
+/** POSTs JSON data and returns the response as an ArrayBuffer. */
+export function binaryPOST(url: string, data: {}): Promise<ArrayBuffer> {
+    const xhr = new XMLHttpRequest();
+    xhr.open('POST', url, true);
+    xhr.responseType = 'arraybuffer';
+    xhr.setRequestHeader('Content-Type', 'application/json');
+    return asyncFetch(xhr, JSON.stringify(data))
+        .then(() => {
+            return xhr.response;
+        })
+}
+
+/**
+ * POSTs JSON data and reads the response as newline delimited JSON, calling
+ * onValue with every value as soon as its line has arrived.
+ */
+export function ndjsonPOST(url: string, data: {},
+                           onValue: (value: any) => void): Promise<void> {
+    const xhr = new XMLHttpRequest();
+    xhr.open('POST', url, true);
+    xhr.setRequestHeader('Content-Type', 'application/json');
+
+    let parsedLength = 0;
+    function parseLines() {
+        const text = xhr.responseText;
+        let lineEnd: number;
+        while ((lineEnd = text.indexOf('\n', parsedLength)) != -1) {
+            const line = text.substring(parsedLength, lineEnd);
+            parsedLength = lineEnd + 1;
+            if (line.length > 0) {
+                onValue(JSON.parse(line));
+            }
+        }
+    }
+
+    xhr.onprogress = function () {
+        if (xhr.status >= 200 && xhr.status < 300) {
+            parseLines();
+        }
+    };
+    return asyncFetch(xhr, JSON.stringify(data))
+        .then(parseLines);
+}
+
 export function jsonGET(url: string): Promise<any> {
     const xhr = new XMLHttpRequest();
     xhr.open('GET', url, true);
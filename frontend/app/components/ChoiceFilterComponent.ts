@@ -1,6 +1,7 @@
 import ChoiceFilter = require("../filters/ChoiceFilter");
 import {elastic, CountAggregationBucket} from "../services/Elastic";
 import {AutocompleteService} from "../services/AutocompleteService";
+import {suggestions} from "../services/Suggestions";
 import {KnockoutComponent} from "../decorators/KnockoutComponent";
 import {app} from "../AppViewModel";
 import {calculateComplementaryFilter} from "../utils/complementaryFilter";
@@ -8,7 +9,8 @@ import {bind} from "../decorators/bind";
 import {observable} from "../decorators/observable";
 import {variableTokenizer} from "../utils/variableTokenizer";
 import {ensure} from "../utils/assert";
-import {FilterDump} from "../filters/Filter";
+import {Filter, FilterDump} from "../filters/Filter";
+import AllFilter = require("../filters/AllFilter");
 import {rxObservableFromPromise} from "../rx/rxObservableFromPromise";
 import {enumerate} from "../utils/functools";
 import {
@@ -25,6 +27,12 @@ interface ChoiceSuggestion {
     freqDividedByModeFullDB: number;
 }
 
+/** True if a filter doesn't restrict the tables matched. */
+function matchesEverything(filter: Filter): boolean {
+    return filter instanceof AllFilter &&
+        _.every(filter.getUsableChildren(), matchesEverything);
+}
+
 /**
  * A class having enough data to perform autocompletion searches.
  * 
@@ -89,8 +97,7 @@ class ChoiceFilterComponent {
                 console.log(JSON.stringify(complement.toElasticQuery(), null!, 2));
             })
             // Launch the query
-            .map(complementaryFilter =>
-                elastic.fetchCountByField(this.filter.field, complementaryFilter))
+            .map(this.fetchCounts)
             .map(rxObservableFromPromise)
             // Ignore errors, only showing a warning for developers.
             //
@@ -131,6 +138,23 @@ class ChoiceFilterComponent {
         });
     }
 
+    /**
+     * Returns the count of tables by value of the field that match the other
+     * filters. When they don't restrict anything, the counts precomputed by
+     * the aggregator are used instead of an aggregation, if available.
+     */
+    @bind()
+    fetchCounts(complementaryFilter: Filter): Promise<CountAggregationBucket[]> {
+        const field = this.filter.field;
+        if (!matchesEverything(complementaryFilter)) {
+            return elastic.fetchCountByField(field, complementaryFilter);
+        }
+        return suggestions.fetchCountByField(field)
+            .then((buckets) => buckets
+                ? Promise.resolve(buckets)
+                : elastic.fetchCountByField(field, complementaryFilter));
+    }
+
     @bind()
     indexFromSuggestions(suggestions: ChoiceSuggestion[]): ChoiceIndex {
         console.log('Creating index on ' + this.filter.field);
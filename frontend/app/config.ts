@@ -3,10 +3,10 @@ const prod = location.hostname.indexOf('.rufian.eu') != -1;
 const elasticIndex = 'hepdata8';
 
 export const config = {
-    // Used for search
+    // Used for search, through the caching search-gateway
     elasticUrl: (prod 
-        ? '/elastic'
-        : 'http://' + location.hostname + ':9200'
+        ? '/search-gateway'
+        : 'http://' + location.hostname + ':9202'
     ) + '/' + elasticIndex,
 
     // Used for state persistence
@@ -14,4 +14,8 @@ export const config = {
         ? '/kv-server'
         : 'http://' + location.hostname + ':9201'
     ),
+
+    // Autocomplete suggestions written by the aggregator
+    // (add --suggestions-dir frontend/suggestions)
+    suggestionsUrl: 'suggestions',
 };
\ No newline at end of file
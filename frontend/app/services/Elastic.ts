@@ -8,8 +8,8 @@ import {
     isSymmetricError
 } from "../base/dataFormat";
 import {assert, AssertionError} from "../utils/assert";
-import {jsonPOST} from "../base/network";
-import {sum, map} from "../utils/functools";
+import {jsonPOST, binaryPOST, ndjsonPOST} from "../base/network";
+import {sum} from "../utils/functools";
 import {bind} from "../decorators/bind";
 import {config} from "../config";
 import SomeFilter = require("../filters/SomeFilter");
@@ -20,25 +20,22 @@ export interface CountAggregationBucket {
     count: number;
 }
 
-interface ElasticQueryResult {
-    // Subset of the fields we use from the response of ElasticSearch
-
-    // Matched publications
-    hits: {
-        total: number,
-        hits: {
-            _source: Publication,
-            inner_hits: {
-                tables: {
-                    hits: {
-                        hits: {
-                            _source: PublicationTable
-                        }[]
-                    }
-                }
-            }
-        }[]
-    };
+/** A publication with its matching tables, from the stream of results. */
+interface StreamLine {
+    publication: Publication;
+    tables: PublicationTable[];
+}
+
+/** The last line of the stream of results. */
+interface StreamEnd {
+    done: boolean;
+    total_publications: number;
+    /** False if there were too many results to send them all. */
+    complete: boolean;
+}
+
+function isStreamEnd(line: StreamLine|StreamEnd): line is StreamEnd {
+    return (<StreamEnd>line).done === true;
 }
 
 export interface SearchResult {
@@ -59,6 +56,55 @@ export interface SearchResult {
     totalPublicationsInServer: number;
 }
 
+/**
+ * Points of a pair of variables, as returned by the plot-data endpoint of the
+ * search gateway. Columns are views of the response, not copies.
+ */
+export interface PlotData {
+    numPoints: number;
+    /** Range of the points of each table in the columns: [start, end). */
+    tables: {inspire_record: number, table_num: number, start: number, end: number}[];
+    incomplete: boolean;
+    totalPublicationsInServer: number;
+
+    xLow: Float32Array;
+    xHigh: Float32Array;
+    y: Float32Array;
+    yLow: Float32Array;
+    yHigh: Float32Array;
+}
+
+export function decodePlotData(buffer: ArrayBuffer): PlotData {
+    const headerLength = new DataView(buffer).getUint32(0, true);
+    const headerBytes = new Uint8Array(buffer, 4, headerLength);
+    // TextDecoder is missing in the DOM typings of our TypeScript version
+    const decoder = new (<any>window).TextDecoder('utf-8');
+    const header = JSON.parse(decoder.decode(headerBytes));
+
+    // The header is padded so that columns are aligned to 4 bytes. Typed
+    // arrays use the byte order of the platform, which in practice is always
+    // little endian like the data.
+    const numPoints: number = header.num_points;
+    const columns: {[name: string]: Float32Array} = {};
+    let offset = 4 + headerLength;
+    for (let name of header.columns) {
+        columns[name] = new Float32Array(buffer, offset, numPoints);
+        offset += 4 * numPoints;
+    }
+
+    return {
+        numPoints: numPoints,
+        tables: header.tables,
+        incomplete: header.incomplete,
+        totalPublicationsInServer: header.total_publications,
+        xLow: columns['x_low'],
+        xHigh: columns['x_high'],
+        y: columns['y'],
+        yLow: columns['y_low'],
+        yHigh: columns['y_high'],
+    };
+}
+
 export class Elastic {
     elasticUrl: string;
 
@@ -66,47 +112,68 @@ export class Elastic {
         this.elasticUrl = config.elasticUrl;
     }
 
+    /**
+     * Fetches every table matching a filter. Tables are streamed by the search
+     * gateway in chunks, which are passed to onTables (if given) as soon as
+     * they arrive.
+     */
     @bind()
-    fetchFilteredData(rootFilter: Filter): Promise<SearchResult> {
-        const requestData = {
-            "size": 100,
-            "query": {
-                "nested": {
-                    "path": "tables",
-                    "query": rootFilter.toElasticQuery(),
-                    "inner_hits": {},
-                },
-            },
-            "_source": {
-                "exclude": ["tables"]
+    fetchFilteredData(rootFilter: Filter,
+                      onTables?: (tables: PublicationTable[]) => void)
+        : Promise<SearchResult>
+    {
+        const returnedTables: PublicationTable[] = [];
+        let end: StreamEnd|null = null;
+
+        return ndjsonPOST(this.elasticUrl + '/stream', {
+            "query": rootFilter.toElasticQuery(),
+        }, (line: StreamLine|StreamEnd) => {
+            if (isStreamEnd(line)) {
+                end = line;
+                return;
             }
-        };
-        return jsonPOST(this.elasticUrl + '/publication/_search', requestData)
-            .then((results: ElasticQueryResult) => {
-                const returnedTables: PublicationTable[] = [];
-
-                for (let publicationHit of results.hits.hits) {
-                    const publication: Publication = publicationHit._source;
-                    const filteredTables: PublicationTable[] = map(
-                        publicationHit.inner_hits.tables.hits.hits, h=>h._source);
-
-                    for (let table of filteredTables) {
-                        // Use client side filtering too
-                        if (!rootFilter.isUsable() || rootFilter.filterTable(table)) {
-                            // The table passes all filters, index it.
-                            table.publication = publication;
-                            this.addRangeProperties(table.data_points);
-                            returnedTables.push(table);
-                        }
-                    }
+
+            const publication: Publication = line.publication;
+            const chunk: PublicationTable[] = [];
+            for (let table of line.tables) {
+                // Use client side filtering too
+                if (!rootFilter.isUsable() || rootFilter.filterTable(table)) {
+                    // The table passes all filters, index it.
+                    table.publication = publication;
+                    this.addRangeProperties(table.data_points);
+                    chunk.push(table);
                 }
+            }
+            returnedTables.push(...chunk);
+            if (onTables && chunk.length > 0) {
+                onTables(chunk);
+            }
+        }).then(() => {
+            if (end == null) {
+                throw new Error('Search results stream ended unexpectedly');
+            }
+            return {
+                totalPublicationsInServer: end.total_publications,
+                incomplete: !end.complete,
+                tables: returnedTables,
+            };
+        });
+    }
 
-                return {
-                    totalPublicationsInServer: results.hits.total,
-                    incomplete: results.hits.total != results.hits.hits.length,
-                    tables: returnedTables,
-                };
-            })
+    /**
+     * Fetches only the points needed to plot yVar against xVar, from the
+     * tables matching a filter, packed in typed arrays.
+     *
+     * Not used by the plots yet: they are still drawn from the tables of
+     * fetchFilteredData(), which the rest of the application needs anyway.
+     */
+    @bind()
+    fetchPlotData(rootFilter: Filter, xVar: string, yVar: string): Promise<PlotData> {
+        return binaryPOST(this.elasticUrl + '/plot-data', {
+            "query": rootFilter.toElasticQuery(),
+            "x": xVar,
+            "y": yVar,
+        }).then(decodePlotData);
     }
 
     /** Returns count of tables grouped by a field. */
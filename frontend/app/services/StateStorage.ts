@@ -1,5 +1,5 @@
 
-import {jsonGET, plainPUT} from "../base/network";
+import {jsonGET, jsonPOST, plainPUT} from "../base/network";
 import {StateDump} from "../base/StateDump";
 import {config} from "../config";
 class StateStorage {
@@ -13,6 +13,11 @@ class StateStorage {
         return jsonGET(this.baseUrl + '/states/' + id);
     }
     
+    /** Fetches several states in one request. Ids of states that don't exist are listed in `missing`. */
+    getMany(ids: string[]): Promise<{states: {[id: string]: StateDump}, missing: string[]}> {
+        return jsonPOST(this.baseUrl + '/states/batch', {ids: ids});
+    }
+
     put(id: string, value: string) {
         return plainPUT(this.baseUrl + '/states/' + id, value);
     }
@@ -0,0 +1,86 @@
+import {jsonGET} from "../base/network";
+import {config} from "../config";
+import {CountAggregationBucket} from "./Elastic";
+
+/** Written by the aggregator, see server-aggregator/aggregator/suggestions.py */
+interface SuggestionsManifest {
+    format: number;
+    generated: string;
+    /** File name of the suggestions of every field */
+    fields: {[field: string]: string};
+}
+
+interface FieldSuggestions {
+    format: number;
+    field: string;
+    /** Sorted by their lower case form */
+    terms: string[];
+    /** Number of tables having each term */
+    counts: number[];
+}
+
+const supportedFormat = 1;
+
+/**
+ * Fetches the autocomplete suggestions precomputed by the aggregator: the
+ * values of a field with the number of tables having each one, in the whole
+ * database. They are static files, so they are much cheaper to get than an
+ * aggregation.
+ */
+class Suggestions {
+    baseUrl: string;
+    private manifest: Promise<SuggestionsManifest|null>|null = null;
+    private fields = new Map<string, Promise<CountAggregationBucket[]|null>>();
+
+    constructor() {
+        this.baseUrl = config.suggestionsUrl;
+    }
+
+    private fetchManifest(): Promise<SuggestionsManifest|null> {
+        if (this.manifest == null) {
+            this.manifest = jsonGET(this.baseUrl + '/suggestions.json')
+                .then((manifest: SuggestionsManifest) =>
+                    manifest.format == supportedFormat ? manifest : null)
+                .catch((err: any) => {
+                    console.warn('Precomputed suggestions are not available:');
+                    console.warn(err);
+                    return null;
+                });
+        }
+        return this.manifest;
+    }
+
+    /**
+     * Returns the count of tables by value of a field, sorted by count like
+     * Elastic.fetchCountByField(), or null if there are no precomputed
+     * suggestions for the field.
+     */
+    fetchCountByField(field: string): Promise<CountAggregationBucket[]|null> {
+        let buckets = this.fields.get(field);
+        if (buckets == null) {
+            buckets = this.fetchManifest()
+                .then((manifest): Promise<FieldSuggestions|null> => {
+                    if (manifest == null || !(field in manifest.fields)) {
+                        return Promise.resolve(null);
+                    }
+                    return jsonGET(this.baseUrl + '/' + manifest.fields[field]);
+                })
+                .then((suggestions: FieldSuggestions|null) => {
+                    if (suggestions == null) {
+                        return null;
+                    }
+                    return _(suggestions.terms)
+                        .map((term: string, i: number) => ({
+                            name: term,
+                            count: suggestions.counts[i],
+                        }))
+                        .sortBy(d => -d.count)
+                        .value();
+                });
+            this.fields.set(field, buckets);
+        }
+        return buckets;
+    }
+}
+
+export const suggestions = new Suggestions();
@@ -15,19 +15,72 @@ def create_db(db_url=default_db_url):
     app.config['SQLALCHEMY_DATABASE_URI'] = db_url
     warn_default_db(db_url)
 
-    from kv_server.model import db
-    db.create_all()
+    from kv_server.model import init_storage
+    init_storage()
+
+
+def patch_for_gevent():
+    # Background threads (group commit, checkpoints) wait on threading
+    # primitives, which must let other greenlets run when serving with gevent
+    from gevent import monkey
+    monkey.patch_thread()
+    monkey.patch_time()
 
 
 def run_server(host='localhost', port=9201, debug=False, db_url=default_db_url,
-               enable_cors=False):
+               enable_cors=False, state_cache_mb=64, gzip_states=False,
+               group_commit=False, group_commit_max_batch=64,
+               group_commit_delay_ms=5, sqlite_tuning=False, concurrency=100,
+               checkpoint_interval=0, storage='sql', log_dir=None,
+               compress_states=False, state_dictionary=None,
+               slow_request_ms=500, read_rate_limit=0, read_burst=100,
+               write_rate_limit=0, write_burst=20, max_in_flight=0,
+               workers=1, graceful_timeout=30):
+    if debug and workers > 1:
+        raise ValueError('--workers can not be used with --debug')
+    if not debug and workers == 1:
+        patch_for_gevent()
+
     from kv_server.app import app
     app.config['SQLALCHEMY_DATABASE_URI'] = db_url
-    warn_default_db(db_url)
+    app.config['STATE_CACHE_BYTES'] = state_cache_mb * 1024 * 1024
+    app.config['STATE_CACHE_GZIP'] = gzip_states
+    app.config['GROUP_COMMIT'] = group_commit
+    app.config['GROUP_COMMIT_MAX_BATCH'] = group_commit_max_batch
+    app.config['GROUP_COMMIT_DELAY'] = group_commit_delay_ms / 1000
+    app.config['SQLITE_TUNING'] = sqlite_tuning
+    # One connection for every request that may be served at the same time
+    app.config['DB_POOL_SIZE'] = concurrency
+    app.config['SQLITE_CHECKPOINT_INTERVAL'] = checkpoint_interval
+    app.config['STORAGE_BACKEND'] = storage
+    app.config['LOG_STORAGE_DIR'] = log_dir
+    app.config['STATE_COMPRESSION'] = compress_states
+    app.config['STATE_DICTIONARY'] = state_dictionary
+    app.config['SLOW_REQUEST_SECONDS'] = \
+        slow_request_ms / 1000 if slow_request_ms > 0 else None
+    app.config['READ_RATE_LIMIT'] = read_rate_limit
+    app.config['READ_BURST'] = read_burst
+    app.config['WRITE_RATE_LIMIT'] = write_rate_limit
+    app.config['WRITE_BURST'] = write_burst
+    app.config['MAX_IN_FLIGHT'] = max_in_flight if max_in_flight > 0 else None
+    if workers > 1:
+        # Every worker keeps its own token buckets. Connections are spread
+        # among workers, so each one allows its share of the requests.
+        app.config['READ_RATE_LIMIT'] = read_rate_limit / workers
+        app.config['WRITE_RATE_LIMIT'] = write_rate_limit / workers
+        app.config['LOG_SHARED'] = True
+        if storage == 'sql' and not sqlite_tuning and \
+                db_url.startswith('sqlite:'):
+            print('WARNING: --sqlite-tuning is recommended with --workers, '
+                  'so that writers don\'t block readers of other workers.')
+    if storage == 'sql':
+        warn_default_db(db_url)
+    elif log_dir is None:
+        raise ValueError('--log-dir is required with --storage log')
 
     # Decode client IP from X-Forwarded-For (nginx must be used in production,
     # configured to send this header)
-    from werkzeug.contrib.fixers import ProxyFix
+    from werkzeug.middleware.proxy_fix import ProxyFix
     app.wsgi_app = ProxyFix(app.wsgi_app)
 
     # On production CORS is not needed as kv-server lives in a proxy under
@@ -41,24 +94,253 @@ def run_server(host='localhost', port=9201, debug=False, db_url=default_db_url,
         })
 
     # Create the database if it does not exist already
-    from kv_server.model import db
-    db.create_all()
+    from kv_server.model import db, init_storage
+    if storage == 'sql':
+        init_storage()
+
+    def start_app(worker_number):
+        # A single process (or worker) checkpoints the WAL
+        if storage == 'sql' and sqlite_tuning and checkpoint_interval > 0 \
+                and worker_number == 0:
+            from kv_server.sqlite_tuning import Checkpointer
+            Checkpointer(db.engine, checkpoint_interval,
+                         app.config['SQLITE_CHECKPOINT_MODE']).start()
+
+        # looks unused, but it's actually needed in order to have... well,
+        # views.
+        import kv_server.views
+
+    def run_worker(listener, worker_number):
+        if workers > 1:
+            import gevent
+            gevent.reinit()
+            patch_for_gevent()
+        start_app(worker_number)
+
+        # gevent is needed in order not to get hung on browser connections
+        import gevent
+        import gevent.socket
+        import signal
+        import socket
+        from gevent.pywsgi import WSGIServer
+
+        class NoDelayWSGIServer(WSGIServer):
+            def handle(self, sock, address):
+                # pywsgi writes the headers and the body of a response
+                # separately. With Nagle's algorithm the body waits until
+                # the client acknowledges the headers, which it delays by
+                # ~40 ms, on every response of a keep-alive connection.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                WSGIServer.handle(self, sock, address)
+
+        if workers > 1:
+            # The listener was opened by the master, without gevent
+            listener = gevent.socket.socket(fileno=listener.detach())
+        http_server = NoDelayWSGIServer(listener, app, spawn=concurrency)
+
+        from kv_server.metrics import watch_server_pool, LoopLagMonitor
+        watch_server_pool(http_server.pool)
+        LoopLagMonitor().start()
 
-    # looks unused, but it's actually needed in order to have... well, views.
-    import kv_server.views
+        # Stop accepting connections and finish the requests in progress
+        gevent.signal_handler(signal.SIGTERM, lambda: gevent.spawn(
+            http_server.stop, graceful_timeout))
+        http_server.serve_forever()
 
     if debug:
+        start_app(0)
         # Auto reloads (sort of), but hangs easily :(
         app.run(host, port, debug)
+    elif workers == 1:
+        run_worker((host, port), 0)
     else:
-        # gevent is needed in order not to get hung on browser connections
-        from gevent.wsgi import WSGIServer
+        from kv_server.prefork import PreforkMaster, create_listener
+        # Workers must not share database connections
+        if storage == 'sql':
+            db.engine.dispose()
+        PreforkMaster(create_listener(host, port), workers,
+                      run_worker).serve_forever()
 
-        http_server = WSGIServer((host, port), app)
-        http_server.serve_forever()
+
+def open_storage(db_url=default_db_url, storage='sql', log_dir=None,
+                 compress_states=False, state_dictionary=None):
+    from kv_server.app import app
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_url
+    app.config['STORAGE_BACKEND'] = storage
+    app.config['LOG_STORAGE_DIR'] = log_dir
+    app.config['STATE_COMPRESSION'] = compress_states
+    app.config['STATE_DICTIONARY'] = state_dictionary
+
+    if storage == 'sql':
+        from kv_server.model import init_storage
+        init_storage()
+
+    from kv_server.storage import create_storage
+    return create_storage()
+
+
+def migrate_to_log(log_dir, db_url=default_db_url, batch_size=1000,
+                   compress_states=False, state_dictionary=None):
+    """Copies every state in the database to a log storage directory."""
+    from kv_server.app import app
+    from kv_server.log_storage import LogStateStorage
+    from kv_server.model import State
+    from kv_server.storage import StoredState
+
+    sql_storage = open_storage(db_url, 'sql', None, compress_states,
+                               state_dictionary)
+    log_storage = LogStateStorage(log_dir, sql_storage.codec, fsync=False)
+    count_created = 0
+    batch = []
+    with app.app_context():
+        for state in State.query.order_by(State.id).yield_per(batch_size):
+            batch.append(StoredState(state.id, sql_storage.value_of(state),
+                                     state.ip, state.created))
+            if len(batch) >= batch_size:
+                count_created += sum(log_storage.add_many(batch))
+                batch = []
+        count_created += sum(log_storage.add_many(batch))
+    log_storage.close()
+
+    # Check everything is there
+    log_storage = LogStateStorage(log_dir, sql_storage.codec)
+    with app.app_context():
+        for state in State.query.yield_per(batch_size):
+            assert log_storage.get(state.id) == sql_storage.value_of(state), \
+                state.id
+    print('Migrated %d states, %d states in the log.' %
+          (count_created, len(log_storage)))
+    log_storage.close()
+
+
+def compact_log(log_dir, compress_states=False, state_dictionary=None):
+    """
+    Compacts a log storage directory. The server must be stopped.
+    Values are stored again with the given compression settings.
+    """
+    from kv_server.log_storage import compact_log
+    from kv_server.value_codec import ValueCodec
+    codec = ValueCodec(compress_states, state_dictionary)
+    print('%d states after compaction.' % compact_log(log_dir, codec))
+
+
+def train_dictionary(output_dir, db_url=default_db_url, storage='sql',
+                     log_dir=None, state_dictionary=None, sample_size=1000):
+    """Builds a compression dictionary from a sample of the saved states."""
+    import os
+    import random
+    from kv_server.app import app
+    from kv_server.value_codec import train_dictionary, dictionary_file_name
+
+    state_storage = open_storage(db_url, storage, log_dir,
+                                 state_dictionary=state_dictionary)
+    with app.app_context():
+        values = [value for value, size in state_storage.iter_stored()]
+    sample = random.sample(values, min(sample_size, len(values)))
+    dictionary = train_dictionary(sample)
+
+    path = os.path.join(output_dir, dictionary_file_name(dictionary))
+    with open(path, 'wb') as f:
+        f.write(dictionary)
+    print('Wrote a %d bytes dictionary trained from %d states to %s' %
+          (len(dictionary), len(sample), path))
+
+
+def compression_stats(db_url=default_db_url, storage='sql', log_dir=None,
+                      state_dictionary=None):
+    """Reports how much space states take in storage."""
+    from kv_server.app import app
+
+    state_storage = open_storage(db_url, storage, log_dir,
+                                 state_dictionary=state_dictionary)
+    count = raw_size = stored_size = 0
+    with app.app_context():
+        for value, size in state_storage.iter_stored():
+            count += 1
+            raw_size += len(value.encode('UTF-8'))
+            stored_size += size
+    print('%d states, %d bytes uncompressed, %d bytes stored '
+          '(compression ratio %.2f)' %
+          (count, raw_size, stored_size,
+           raw_size / stored_size if stored_size else 1))
+
+
+def compress_states(state_dictionary=None, db_url=default_db_url):
+    """Compresses the states of a SQL database saved without compression."""
+    from kv_server.app import app
+
+    state_storage = open_storage(db_url, 'sql', None, True, state_dictionary)
+    with app.app_context():
+        print('Compressed %d states.' % state_storage.compress_existing())
+
+
+def load_test(url=None, duration=10, warmup=2, concurrency=50,
+              get_ratio=0.9, num_states=1000, zipf_s=1.1, seed=0,
+              output=None, port=9299, server_args='', server_log=None):
+    """
+    Measures the throughput and latency of a kv-server.
+
+    Without --url, a server is started on --port with a fresh database in a
+    temporary directory; --server-args are passed to its run-server command
+    and its output is written to --server-log.
+    """
+    import json
+    import os
+    import shlex
+    import tempfile
+
+    # Workers run as greenlets, so thousands of them are cheap
+    from gevent import monkey
+    monkey.patch_all()
+
+    from kv_server.load_test import LoadTest, start_local_server, \
+        format_summary
+
+    server = None
+    temp_dir = None
+    log = None
+    if url is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix='kv-load-test-')
+        args = shlex.split(server_args)
+        if '--db-url' not in args:
+            args += ['--db-url', 'sqlite:///' +
+                     os.path.join(temp_dir.name, 'kv-server.db')]
+        if server_log is not None:
+            log = open(server_log, 'w')
+        server = start_local_server(os.path.abspath(__file__), port, args,
+                                    log)
+        url = 'http://localhost:%d' % port
+
+    try:
+        test = LoadTest(url, concurrency, get_ratio, num_states, zipf_s, seed)
+        summary = test.run(duration, warmup).summary()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if log is not None:
+            log.close()
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    summary['parameters'] = {
+        'url': url, 'concurrency': concurrency, 'get_ratio': get_ratio,
+        'num_states': num_states, 'zipf_s': zipf_s, 'seed': seed,
+        'server_args': server_args,
+    }
+    print(format_summary(summary))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
 
 
 argh.dispatch_commands([
     create_db,
-    run_server
+    run_server,
+    migrate_to_log,
+    compact_log,
+    train_dictionary,
+    compression_stats,
+    compress_states,
+    load_test,
 ])
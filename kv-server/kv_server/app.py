@@ -5,13 +5,59 @@ app = Flask(__name__)
 app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+# Maximum size of the in-memory cache of states, in bytes
+app.config['STATE_CACHE_BYTES'] = 64 * 1024 * 1024
+# Keep a gzip compressed copy of cached states for clients accepting it
+app.config['STATE_CACHE_GZIP'] = False
+# Per client rate limits (requests per second and burst size), separate for
+# reads and writes. A rate of 0 disables the limit. See kv_server.rate_limit
+app.config['READ_RATE_LIMIT'] = 0
+app.config['READ_BURST'] = 100
+app.config['WRITE_RATE_LIMIT'] = 0
+app.config['WRITE_BURST'] = 20
+app.config['RATE_LIMIT_MAX_CLIENTS'] = 10000
+app.config['RATE_LIMIT_IDLE_SECONDS'] = 600
+# Requests are answered with 503 while more than this many are being served,
+# None to disable
+app.config['MAX_IN_FLIGHT'] = None
+# Requests taking longer than this are logged, None to disable
+app.config['SLOW_REQUEST_SECONDS'] = 0.5
+# Maximum number of ids accepted by POST /states/batch
+app.config['BATCH_MAX_IDS'] = 1000
+# Save new states in batches, see kv_server.group_commit
+app.config['GROUP_COMMIT'] = False
+app.config['GROUP_COMMIT_MAX_BATCH'] = 64
+app.config['GROUP_COMMIT_DELAY'] = 0.005
+# Where states are saved: 'sql' (the State table) or 'log' (an append-only
+# log in LOG_STORAGE_DIR, see kv_server.log_storage)
+app.config['STORAGE_BACKEND'] = 'sql'
+app.config['LOG_STORAGE_DIR'] = None
+app.config['LOG_FSYNC'] = True
+# Set when several processes use the same log, see kv_server.prefork
+app.config['LOG_SHARED'] = False
+# Compress stored values, optionally with a trained dictionary (path of a
+# .zdict file), see kv_server.value_codec
+app.config['STATE_COMPRESSION'] = False
+app.config['STATE_DICTIONARY'] = None
+# Production profile for SQLite databases, see kv_server.sqlite_tuning
+app.config['SQLITE_TUNING'] = False
+app.config['DB_POOL_SIZE'] = 100
+app.config['SQLITE_SYNCHRONOUS'] = 'NORMAL'
+app.config['SQLITE_CACHE_SIZE_KB'] = 64 * 1024
+app.config['SQLITE_MMAP_SIZE'] = 256 * 1024 * 1024
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = 5000
+app.config['SQLITE_WAL_AUTOCHECKPOINT'] = 1000  # pages
+app.config['SQLITE_CHECKPOINT_INTERVAL'] = 0  # seconds, 0 to disable
+app.config['SQLITE_CHECKPOINT_MODE'] = 'PASSIVE'
 
 
 class HTTPError(Exception):
-    def __init__(self, status_code, message):
+    def __init__(self, status_code, message, retry_after=None):
         Exception.__init__(self)
         self.message = message
         self.status_code = status_code
+        # Value of the Retry-After header, if any
+        self.retry_after = retry_after
 
 
 def something_fishy(reason):
@@ -35,6 +81,8 @@ def handle_http_error(error):
     })
     """:type: Response"""
     response.status_code = error.status_code
+    if error.retry_after is not None:
+        response.headers['Retry-After'] = error.retry_after
     return response
 
 
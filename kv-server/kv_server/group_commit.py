@@ -0,0 +1,217 @@
+import threading
+import time
+from collections import OrderedDict
+from unittest import TestCase
+
+from kv_server.app import app
+from kv_server.storage import StateStorage, StoredState
+
+
+class PendingState(object):
+    def __init__(self, state):
+        self.state = state
+        self.created = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+    Saves new states in batches, each one with a single call to
+    StateStorage.add_many() (e.g. a single database transaction).
+
+    Requests queue their states and wait until the batch containing them has
+    been committed, so a request is only acknowledged once its state is
+    durable. A batch is flushed when it reaches max_batch_size states or
+    max_delay seconds after its first state was queued, whichever comes first.
+
+    The ids of the last max_known_ids states saved are kept in memory, so
+    saving one of them again (e.g. a popular link shared several times) is
+    answered without queuing it. States are never deleted, so they never need
+    to be invalidated. Any other existing state is found by add_many().
+    """
+
+    def __init__(self, storage, max_batch_size=64, max_delay=0.005,
+                 max_known_ids=100000):
+        """
+        :type storage: kv_server.storage.StateStorage
+        """
+        self.storage = storage
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_known_ids = max_known_ids
+        # Used as an LRU set
+        self._known_ids = OrderedDict()  # type: OrderedDict[int, None]
+        self._known_ids_lock = threading.Lock()
+
+        self._queue = []  # type: list[PendingState]
+        self._queue_changed = threading.Condition(threading.Lock())
+        self._thread = threading.Thread(target=self._run,
+                                        name='group-committer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def is_known(self, numeric_id):
+        with self._known_ids_lock:
+            if numeric_id not in self._known_ids:
+                return False
+            self._known_ids.move_to_end(numeric_id)
+            return True
+
+    def _add_known(self, numeric_ids):
+        with self._known_ids_lock:
+            for numeric_id in numeric_ids:
+                self._known_ids[numeric_id] = None
+                self._known_ids.move_to_end(numeric_id)
+            while len(self._known_ids) > self.max_known_ids:
+                self._known_ids.popitem(last=False)
+
+    def save(self, state):
+        """
+        Saves a StoredState, waiting until it's durable.
+
+        Returns True if the state was created, False if it already existed.
+        """
+        if self.is_known(state.id):
+            return False
+
+        pending = PendingState(state)
+        with self._queue_changed:
+            self._queue.append(pending)
+            self._queue_changed.notify()
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.created
+
+    def _take_batch(self):
+        with self._queue_changed:
+            while len(self._queue) == 0:
+                self._queue_changed.wait()
+
+            # Give other requests a chance to join the batch
+            deadline = time.time() + self.max_delay
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._queue_changed.wait(remaining)
+
+            batch = self._queue[:self.max_batch_size]
+            del self._queue[:self.max_batch_size]
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            with app.app_context():
+                self._flush(batch)
+
+    def _flush(self, batch):
+        """
+        :type batch: list[PendingState]
+        """
+        try:
+            created = self.storage.add_many(
+                [pending.state for pending in batch])
+            for pending, was_created in zip(batch, created):
+                pending.created = was_created
+            self._add_known(pending.state.id for pending in batch)
+        except Exception as error:
+            app.logger.exception('Could not save a batch of %d states' %
+                                 len(batch))
+            for pending in batch:
+                pending.error = error
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+
+class MemoryStorage(StateStorage):
+    """Keeps states in a dict, for the tests."""
+
+    def __init__(self):
+        StateStorage.__init__(self, None)
+        self.values = {}
+        self.batches = []
+        self.error = None
+
+    def get(self, numeric_id):
+        return self.values.get(numeric_id)
+
+    def add_many(self, states):
+        self.batches.append([state.id for state in states])
+        if self.error is not None:
+            raise self.error
+        created = []
+        for state in states:
+            created.append(state.id not in self.values)
+            self.values.setdefault(state.id, state.value)
+        return created
+
+
+class TestGroupCommitter(TestCase):
+    def setUp(self):
+        self.storage = MemoryStorage()
+
+    def start(self, **kwargs):
+        committer = GroupCommitter(self.storage, **kwargs)
+        committer.start()
+        return committer
+
+    def save_all(self, committer, ids):
+        """Saves states from a thread each, returns their results."""
+        results = {}
+
+        def save(id):
+            try:
+                results[id] = committer.save(StoredState(
+                    id, '{}', '127.0.0.1', None))
+            except Exception as error:
+                results[id] = error
+
+        threads = [threading.Thread(target=save, args=(id,)) for id in ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        return [results[id] for id in ids]
+
+    def test_batches(self):
+        # Long enough for every thread to queue its state
+        committer = self.start(max_batch_size=3, max_delay=1)
+        self.assertEqual(self.save_all(committer, [1, 2, 3, 4, 5]),
+                         [True] * 5)
+        self.assertEqual(sorted(len(batch)
+                                for batch in self.storage.batches), [2, 3])
+        self.assertEqual(sorted(self.storage.values), [1, 2, 3, 4, 5])
+
+    def test_existing(self):
+        committer = self.start(max_delay=0.05, max_known_ids=2)
+        self.storage.values[1] = '{}'
+        self.assertEqual(self.save_all(committer, [1, 2]), [False, True])
+        self.assertEqual(len(self.storage.batches), 1)
+
+        # The ids saved lately are answered without queuing them, the older
+        # ones by the storage
+        self.assertEqual(self.save_all(committer, [1]), [False])
+        self.assertEqual(len(self.storage.batches), 1)
+        self.assertEqual(self.save_all(committer, [3]), [True])
+        self.assertEqual(self.save_all(committer, [1]), [False])
+        self.assertEqual(self.save_all(committer, [2]), [False])
+        self.assertEqual(self.storage.batches[1:], [[3], [2]])
+
+    def test_error(self):
+        committer = self.start(max_delay=0.05)
+        self.storage.error = IOError('Disk full')
+        results = self.save_all(committer, [1, 2])
+        self.assertTrue(all(result is self.storage.error
+                            for result in results))
+        self.assertEqual(self.storage.values, {})
+
+        # Failed states are not taken as saved, and the committer goes on
+        self.storage.error = None
+        self.assertEqual(self.save_all(committer, [1, 2]), [True, True])
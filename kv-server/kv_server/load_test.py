@@ -0,0 +1,275 @@
+"""
+Load generator for kv-server.
+
+Workers send a mix of GET and PUT requests over persistent HTTP connections.
+GETs ask for previously saved states, picked with a Zipf distribution so a
+few states are much more popular than the rest, as with shared links. PUTs
+save new states, with ids computed with custom_url_hash() like the frontend
+does.
+"""
+import http.client
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from itertools import accumulate
+from unittest import TestCase
+from urllib.parse import urlsplit
+
+from kv_server.custom_url_hash import custom_url_hash
+
+percentiles = (50, 90, 99, 99.9)
+# Latencies of responses held back by Nagle's algorithm until the client's
+# delayed ACK (at least 40 ms on Linux), instead of by the server
+nagle_stall_range = (0.038, 0.050)
+
+
+def random_state(rng):
+    """Returns a random state value, similar to those of the frontend."""
+    return json.dumps({
+        'version': 2,
+        'filter': {
+            'type': 'AllFilter',
+            'children': [
+                {'type': 'CMEnergiesFilter',
+                 'value': {'min': rng.choice([7, 8, 13]) * 1000,
+                           'max': 13000}},
+                {'type': 'ReactionFilter',
+                 'value': rng.choice(['P P --> JET X', 'P P --> Z0 X',
+                                      'E+ E- --> HADRONS'])},
+            ],
+        },
+        'plots': [
+            {'config': {'xVar': 'PT (GEV)',
+                        'yVars': [{'name': 'D(SIG)/DPT', 'color': '#%06x' %
+                                   rng.randrange(0x1000000)}],
+                        'logX': rng.random() < 0.5,
+                        'logY': rng.random() < 0.5},
+             'alive': True}
+            for _ in range(rng.randint(1, 6))
+        ],
+        'seed': rng.random(),
+    }, sort_keys=True)
+
+
+class ZipfSampler(object):
+    """Samples indices 0..n-1 with probability proportional to 1 / (i+1)^s."""
+
+    def __init__(self, n, s, rng):
+        self.rng = rng
+        self.cumulative = list(accumulate(1 / (i + 1) ** s for i in range(n)))
+
+    def sample(self):
+        value = self.rng.random() * self.cumulative[-1]
+        return bisect_left(self.cumulative, value)
+
+
+class LoadTestResults(object):
+    def __init__(self):
+        self.latencies = {'GET': [], 'PUT': []}
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.duration = 0
+        self._lock = threading.Lock()
+
+    def record(self, method, status, latency):
+        with self._lock:
+            self.latencies[method].append(latency)
+            self.statuses['%s %d' % (method, status)] += 1
+
+    def record_error(self, method, error):
+        with self._lock:
+            self.errors['%s %s' % (method, type(error).__name__)] += 1
+
+    def summary(self):
+        summary = {
+            'duration': self.duration,
+            'requests': sum(len(latencies)
+                            for latencies in self.latencies.values()),
+            'statuses': dict(self.statuses),
+            'errors': dict(self.errors),
+            'methods': {},
+            'warnings': [],
+        }
+        summary['throughput'] = summary['requests'] / self.duration \
+            if self.duration else 0
+        for method, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            if not latencies:
+                continue
+            summary['methods'][method] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / self.duration,
+                'mean_ms': 1000 * sum(latencies) / len(latencies),
+                'max_ms': 1000 * latencies[-1],
+                'percentiles_ms': {
+                    'p%g' % p: 1000 * latencies[
+                        min(len(latencies) - 1, int(len(latencies) * p / 100))]
+                    for p in percentiles
+                },
+            }
+            stalled = sum(1 for latency in latencies
+                          if nagle_stall_range[0] <= latency <=
+                          nagle_stall_range[1])
+            if stalled >= len(latencies) / 2:
+                summary['warnings'].append(
+                    '%d%% of the %s requests took %d-%d ms: they are probably '
+                    'delayed by Nagle\'s algorithm (is TCP_NODELAY set?), so '
+                    'the results don\'t tell the server\'s work apart.' % (
+                        100 * stalled / len(latencies), method,
+                        1000 * nagle_stall_range[0],
+                        1000 * nagle_stall_range[1]))
+        return summary
+
+
+def format_summary(summary):
+    lines = ['%d requests in %.1f s: %.1f requests/s' %
+             (summary['requests'], summary['duration'],
+              summary['throughput'])]
+    for method, stats in sorted(summary['methods'].items()):
+        lines.append('%-4s %8d requests %8.1f/s  mean %7.2f ms  %s  '
+                     'max %7.2f ms' % (
+                         method, stats['requests'], stats['throughput'],
+                         stats['mean_ms'],
+                         '  '.join('%s %7.2f ms' % item for item in
+                                   stats['percentiles_ms'].items()),
+                         stats['max_ms']))
+    lines.append('Statuses: %s' % ', '.join(
+        '%s: %d' % item for item in sorted(summary['statuses'].items())))
+    if summary['errors']:
+        lines.append('Errors: %s' % ', '.join(
+            '%s: %d' % item for item in sorted(summary['errors'].items())))
+    for warning in summary.get('warnings', []):
+        lines.append('Warning: %s' % warning)
+    return '\n'.join(lines)
+
+
+class LoadTest(object):
+    def __init__(self, url, concurrency=50, get_ratio=0.9, num_states=1000,
+                 zipf_s=1.1, seed=0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip('/')
+        self.concurrency = concurrency
+        self.get_ratio = get_ratio
+        self.num_states = num_states
+        self.zipf_s = zipf_s
+        self.seed = seed
+        self.ids = []
+
+    def _connect(self):
+        # Sets TCP_NODELAY, so requests are not held back by Nagle's
+        # algorithm either
+        return http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def _request(self, connection, method, id, body=None):
+        connection.request(method, '%s/states/%s' % (self.base_path, id),
+                           body=body)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+
+    def populate(self):
+        """Saves the states that GET requests will ask for."""
+        rng = random.Random(self.seed)
+        connection = self._connect()
+        for _ in range(self.num_states):
+            value = random_state(rng)
+            id = custom_url_hash(value)
+            status = self._request(connection, 'PUT', id, value)
+            if status not in (201, 204):
+                raise RuntimeError('Could not save a state: HTTP %d' % status)
+            self.ids.append(id)
+        connection.close()
+
+    def _worker(self, worker_number, start_time, warmup, deadline, results):
+        rng = random.Random('%s-%d' % (self.seed, worker_number))
+        zipf = ZipfSampler(len(self.ids), self.zipf_s, rng)
+        connection = self._connect()
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            if rng.random() < self.get_ratio:
+                method, id, body = 'GET', self.ids[zipf.sample()], None
+            else:
+                body = random_state(rng)
+                method, id = 'PUT', custom_url_hash(body)
+
+            try:
+                status = self._request(connection, method, id, body)
+            except (OSError, http.client.HTTPException) as error:
+                results.record_error(method, error)
+                connection.close()
+                connection = self._connect()
+                continue
+            if now >= start_time + warmup:
+                results.record(method, status, time.perf_counter() - now)
+        connection.close()
+
+    def run(self, duration=10, warmup=2):
+        """Runs the load test and returns its LoadTestResults."""
+        if not self.ids:
+            self.populate()
+        results = LoadTestResults()
+        start_time = time.perf_counter()
+        deadline = start_time + warmup + duration
+        workers = [threading.Thread(target=self._worker,
+                                    args=(i, start_time, warmup, deadline,
+                                          results))
+                   for i in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        results.duration = duration
+        return results
+
+
+def start_local_server(script, port, server_args=(), log=None):
+    """
+    Starts kv-server in a subprocess and waits until it accepts
+    connections. Its output (including the access log) goes to the file
+    object log, or is discarded.
+    """
+    output = log if log is not None else subprocess.DEVNULL
+    process = subprocess.Popen([sys.executable, script, 'run-server',
+                                '--port', str(port)] + list(server_args),
+                               stdout=output, stderr=output)
+    deadline = time.time() + 30
+    while True:
+        try:
+            connection = http.client.HTTPConnection('localhost', port,
+                                                    timeout=1)
+            connection.request('GET', '/')
+            connection.getresponse().read()
+            connection.close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError('kv-server did not start')
+            time.sleep(0.1)
+
+
+class TestLoadTestResults(TestCase):
+    def test_summary(self):
+        results = LoadTestResults()
+        results.duration = 2
+        for i in range(10):
+            results.record('GET', 200, 0.001 * (i + 1))
+            results.record('PUT', 201, 0.040 + 0.001 * (i % 3))
+        summary = results.summary()
+        self.assertEqual(summary['requests'], 20)
+        self.assertEqual(summary['throughput'], 10)
+        self.assertEqual(summary['methods']['GET']['percentiles_ms']['p50'],
+                         6)
+        # Only PUTs look delayed by Nagle's algorithm
+        self.assertEqual(len(summary['warnings']), 1)
+        self.assertIn('100% of the PUT requests', summary['warnings'][0])
+        self.assertIn('Warning: 100% of the PUT', format_summary(summary))
@@ -0,0 +1,501 @@
+"""
+Append-only log storage for states.
+
+States are appended to segment files (00000001.log, 00000002.log...) in a
+directory. A new segment is started when the last one grows over
+segment_size. An index from state id to the location of its value is kept in
+memory, so reading a state costs a dictionary lookup and one pread().
+
+    Record {
+        uint32 crc32;         // of the rest of the record
+        uint32 id;
+        double created;       // POSIX timestamp, 0 if unknown
+        uint16 ip_length;
+        uint32 value_length;
+        byte[ip_length] ip;           // UTF-8
+        byte[value_length] value;     // encoded by a ValueCodec
+    }
+
+On startup every segment is scanned to rebuild the index. If the process died
+while appending, the last segment may end with a torn record: it's truncated
+back to the last valid record. Invalid records anywhere else are reported as
+a CorruptLog error.
+
+Several processes can use the same directory (see kv_server.prefork) if
+they open it with shared=True. Appending is then serialized with an flock()
+on the .lock file of the directory, and every process indexes the records
+appended by the others before writing and when it can't find a state.
+
+States are never deleted, so compaction (compact_log(), which must be run
+while the server is stopped) only drops duplicated records and rewrites the
+log in full segments, encoding values again with the given codec.
+"""
+import fcntl
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import TestCase, mock
+
+from kv_server.app import app
+from kv_server.storage import StateStorage, StoredState
+
+record_header_struct = struct.Struct('<LLdHL')
+default_segment_size = 256 * 1024 * 1024
+re_segment_name = re.compile(r'^(\d{8})\.log$')
+
+
+class CorruptLog(Exception):
+    pass
+
+
+def segment_name(segment_number):
+    return '%08d.log' % segment_number
+
+
+def encode_record(state, codec):
+    """
+    :type state: StoredState
+    :type codec: kv_server.value_codec.ValueCodec
+    """
+    ip = (state.ip or '').encode('UTF-8')
+    value = codec.encode(state.value)
+    created = state.created.timestamp() if state.created else 0.0
+    header = record_header_struct.pack(0, state.id, created, len(ip),
+                                       len(value))
+    body = header[4:] + ip + value
+    return struct.pack('<L', zlib.crc32(body)) + body
+
+
+def record_value_length(record):
+    return record_header_struct.unpack_from(record, 0)[4]
+
+
+def iter_segment_records(buf):
+    """
+    Yields (offset, state, value_offset, end) for each record in a segment
+    buffer, where value_offset is the position of the encoded value. The value
+    of the yielded StoredState is still encoded (bytes).
+
+    Stops at the end of the buffer. Raises CorruptLog at the first invalid
+    record, with the offset of the record as second argument.
+    """
+    offset = 0
+    size = len(buf)
+    while offset < size:
+        if offset + record_header_struct.size > size:
+            raise CorruptLog('Truncated record header', offset)
+        crc, id, created, ip_length, value_length = \
+            record_header_struct.unpack_from(buf, offset)
+        ip_offset = offset + record_header_struct.size
+        value_offset = ip_offset + ip_length
+        end = value_offset + value_length
+        if end > size:
+            raise CorruptLog('Truncated record', offset)
+        if zlib.crc32(buf[offset + 4:end]) != crc:
+            raise CorruptLog('Checksum mismatch', offset)
+
+        state = StoredState(
+            id=id,
+            value=bytes(buf[value_offset:end]),
+            ip=bytes(buf[ip_offset:value_offset]).decode('UTF-8'),
+            created=datetime.fromtimestamp(created) if created else None,
+        )
+        yield offset, state, value_offset, end
+        offset = end
+
+
+def read_segment(path):
+    """Returns the contents of a segment (possibly a mmap) and its size."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return b'', 0
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), size
+
+
+class LogStateStorage(StateStorage):
+    def __init__(self, directory, codec, fsync=True,
+                 segment_size=default_segment_size, shared=False):
+        StateStorage.__init__(self, codec)
+        self.directory = directory
+        self.fsync = fsync
+        self.segment_size = segment_size
+        self.shared = shared
+
+        # state id -> (segment number, value offset, value length)
+        self._index = {}  # type: dict[int, tuple]
+        self._read_fds = {}  # type: dict[int, int]
+        self._write_fd = None
+        self._write_segment = None
+        self._write_offset = 0
+        # Records before this position have been added to the index
+        self._indexed_segment = 1
+        self._indexed_offset = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(directory, '.lock'),
+                                os.O_RDWR | os.O_CREAT, 0o644) \
+            if shared else None
+
+        with self._locked():
+            segments = self._segment_numbers()
+            for segment_number in segments:
+                self._load_segment(segment_number,
+                                   is_last=(segment_number == segments[-1]))
+            self._open_for_writing(segments[-1] if segments else 1)
+
+    @contextmanager
+    def _locked(self):
+        """Excludes other threads and, if shared, other processes."""
+        with self._lock:
+            if self._lock_fd is None:
+                yield
+                return
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _segment_numbers(self):
+        return sorted(int(match.group(1))
+                      for match in map(re_segment_name.match,
+                                       os.listdir(self.directory))
+                      if match)
+
+    def _segment_path(self, segment_number):
+        return os.path.join(self.directory, segment_name(segment_number))
+
+    def _load_segment(self, segment_number, is_last):
+        path = self._segment_path(segment_number)
+        buf, size = read_segment(path)
+        valid_size = 0
+        try:
+            for offset, state, value_offset, end in iter_segment_records(buf):
+                # The first copy of a state wins
+                self._index.setdefault(state.id, (
+                    segment_number, value_offset, end - value_offset))
+                valid_size = end
+        except CorruptLog as err:
+            if not is_last:
+                raise CorruptLog('%s at %s, offset %d' %
+                                 (err.args[0], path, err.args[1]))
+            app.logger.warning('Truncating %s from %d to %d bytes: %s' %
+                               (path, size, valid_size, err.args[0]))
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+        if valid_size != size:
+            with open(path, 'r+b') as f:
+                f.truncate(valid_size)
+                os.fsync(f.fileno())
+
+        self._read_fds[segment_number] = os.open(path, os.O_RDONLY)
+        self._indexed_segment = segment_number
+        self._indexed_offset = valid_size
+
+    def _catch_up(self, exclusive):
+        """
+        Indexes the records appended to the log by other processes.
+
+        Without holding the lock (exclusive=False) a record may be in the
+        middle of being written. Indexing stops there, to be resumed later.
+        """
+        while True:
+            segment_number = self._indexed_segment
+            path = self._segment_path(segment_number)
+            if segment_number not in self._read_fds:
+                self._read_fds[segment_number] = os.open(path, os.O_RDONLY)
+            fd = self._read_fds[segment_number]
+            start = self._indexed_offset
+            size = os.fstat(fd).st_size
+            if size > start:
+                buf = os.pread(fd, size - start, start)
+                try:
+                    for offset, state, value_offset, end in \
+                            iter_segment_records(buf):
+                        self._index.setdefault(state.id, (
+                            segment_number, start + value_offset,
+                            end - value_offset))
+                        self._indexed_offset = start + end
+                except CorruptLog as err:
+                    if not exclusive:
+                        return
+                    next_path = self._segment_path(segment_number + 1)
+                    if os.path.exists(next_path):
+                        raise CorruptLog('%s at %s, offset %d' % (
+                            err.args[0], path, start + err.args[1]))
+                    # A process died while appending
+                    app.logger.warning(
+                        'Truncating %s from %d to %d bytes: %s' %
+                        (path, size, self._indexed_offset, err.args[0]))
+                    with open(path, 'r+b') as f:
+                        f.truncate(self._indexed_offset)
+                        os.fsync(f.fileno())
+                    return
+
+            if not os.path.exists(self._segment_path(segment_number + 1)):
+                return
+            self._indexed_segment = segment_number + 1
+            self._indexed_offset = 0
+
+    def _open_for_writing(self, segment_number):
+        path = self._segment_path(segment_number)
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+        self._write_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                 0o644)
+        self._write_segment = segment_number
+        self._write_offset = os.fstat(self._write_fd).st_size
+        if segment_number not in self._read_fds:
+            self._read_fds[segment_number] = os.open(path, os.O_RDONLY)
+        if segment_number > self._indexed_segment:
+            self._indexed_segment = segment_number
+            self._indexed_offset = self._write_offset
+
+    def get(self, numeric_id):
+        location = self._index.get(numeric_id)
+        if location is None and self.shared:
+            # It may have been saved by another process
+            with self._lock:
+                self._catch_up(exclusive=False)
+            location = self._index.get(numeric_id)
+        if location is None:
+            return None
+        segment_number, offset, length = location
+        return self.codec.decode(
+            os.pread(self._read_fds[segment_number], length, offset))
+
+    def add_many(self, states):
+        with self._locked():
+            if self.shared:
+                self._catch_up(exclusive=True)
+                if self._indexed_segment != self._write_segment:
+                    self._open_for_writing(self._indexed_segment)
+                self._write_offset = self._indexed_offset
+            if self._write_offset >= self.segment_size:
+                self._open_for_writing(self._write_segment + 1)
+
+            created = []
+            records = []
+            new_locations = {}
+            offset = self._write_offset
+            for state in states:
+                is_new = state.id not in self._index and \
+                    state.id not in new_locations
+                created.append(is_new)
+                if is_new:
+                    record = encode_record(state, self.codec)
+                    value_length = record_value_length(record)
+                    new_locations[state.id] = (
+                        self._write_segment,
+                        offset + len(record) - value_length,
+                        value_length)
+                    records.append(record)
+                    offset += len(record)
+
+            if records:
+                data = b''.join(records)
+                try:
+                    while data:
+                        written = os.write(self._write_fd, data)
+                        data = data[written:]
+                    if self.fsync:
+                        os.fsync(self._write_fd)
+                except BaseException:
+                    # Remove what was written (e.g. before running out of
+                    # space), otherwise the next records would be appended
+                    # after a torn one, and dropped with it when recovering.
+                    os.ftruncate(self._write_fd, self._write_offset)
+                    raise
+                self._write_offset = offset
+                self._indexed_offset = offset
+                # Only visible once durable
+                self._index.update(new_locations)
+            return created
+
+    def ids(self):
+        return list(self._index.keys())
+
+    def iter_stored(self):
+        for segment_number, offset, length in list(self._index.values()):
+            data = os.pread(self._read_fds[segment_number], length, offset)
+            yield self.codec.decode(data), length
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+        for fd in self._read_fds.values():
+            os.close(fd)
+        self._read_fds = {}
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+def iter_log_states(directory, codec):
+    """Yields every valid StoredState of a log directory, in order."""
+    storage = LogStateStorage(directory, codec, fsync=False)
+    storage.close()
+    for segment_number in storage._segment_numbers():
+        buf, size = read_segment(storage._segment_path(segment_number))
+        try:
+            for offset, state, value_offset, end in iter_segment_records(buf):
+                yield state._replace(value=codec.decode(state.value))
+        finally:
+            if isinstance(buf, mmap.mmap):
+                buf.close()
+
+
+def compact_log(directory, codec, segment_size=default_segment_size,
+                batch_size=1000):
+    """
+    Rewrites a log directory keeping only the first record of every state.
+
+    Must not be run while a server is using the directory. Returns the number
+    of states kept.
+    """
+    directory = directory.rstrip('/')
+    new_directory = directory + '.compacting'
+    old_directory = directory + '.old'
+    if os.path.exists(new_directory):
+        shutil.rmtree(new_directory)
+
+    new_storage = LogStateStorage(new_directory, codec, fsync=False,
+                                  segment_size=segment_size)
+    batch = []
+    for state in iter_log_states(directory, codec):
+        batch.append(state)
+        if len(batch) >= batch_size:
+            new_storage.add_many(batch)
+            batch = []
+    new_storage.add_many(batch)
+    num_states = len(new_storage)
+
+    for segment_number in new_storage._segment_numbers():
+        with open(new_storage._segment_path(segment_number), 'rb') as f:
+            os.fsync(f.fileno())
+    new_storage.close()
+
+    os.rename(directory, old_directory)
+    os.rename(new_directory, directory)
+    shutil.rmtree(old_directory)
+    return num_states
+
+
+class TestLogStateStorage(TestCase):
+    def setUp(self):
+        from kv_server.value_codec import ValueCodec
+        self.dir = tempfile.mkdtemp()
+        self.log_dir = os.path.join(self.dir, 'log')
+        self.codec = ValueCodec()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, **kwargs):
+        storage = LogStateStorage(self.log_dir, self.codec, fsync=False,
+                                  **kwargs)
+        self.addCleanup(storage.close)
+        return storage
+
+    def state(self, id, value=None):
+        return StoredState(id, value or '{"state": %d}' % id, '127.0.0.1',
+                           datetime(2020, 1, 1))
+
+    def segment_size(self, segment_number=1):
+        return os.path.getsize(os.path.join(self.log_dir,
+                                            segment_name(segment_number)))
+
+    def test_torn_tail(self):
+        storage = self.open()
+        self.assertEqual(storage.add_many([self.state(1), self.state(2)]),
+                         [True, True])
+        valid_size = self.segment_size()
+        storage.close()
+
+        # The process died while appending a record
+        record = encode_record(self.state(3), self.codec)
+        with open(os.path.join(self.log_dir, segment_name(1)), 'ab') as f:
+            f.write(record[:len(record) - 3])
+
+        storage = self.open()
+        self.assertEqual(self.segment_size(), valid_size)
+        self.assertEqual(sorted(storage.ids()), [1, 2])
+        self.assertIsNone(storage.get(3))
+        self.assertTrue(storage.add(self.state(3)))
+        self.assertFalse(storage.add(self.state(1)))
+        storage.close()
+
+        storage = self.open()
+        self.assertEqual(storage.get(3), '{"state": 3}')
+
+    def test_corrupt_segment(self):
+        storage = self.open(segment_size=1)
+        storage.add(self.state(1))
+        storage.add(self.state(2))
+        storage.close()
+        with open(os.path.join(self.log_dir, segment_name(1)), 'r+b') as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+        # Only the tail of the last segment may be torn
+        with self.assertRaises(CorruptLog):
+            self.open()
+
+    def test_failed_write(self):
+        storage = self.open()
+        storage.add(self.state(1))
+        valid_size = self.segment_size()
+
+        real_write = os.write
+
+        def write_half(fd, data):
+            real_write(fd, data[:len(data) // 2])
+            raise OSError(28, 'No space left on device')
+
+        with mock.patch('os.write', write_half):
+            with self.assertRaises(OSError):
+                storage.add_many([self.state(2), self.state(3)])
+        self.assertEqual(self.segment_size(), valid_size)
+        self.assertIsNone(storage.get(2))
+
+        # Later records land where the failed ones would have, and survive a
+        # restart
+        self.assertEqual(storage.add_many([self.state(4), self.state(2)]),
+                         [True, True])
+        self.assertEqual(storage.get(4), '{"state": 4}')
+        storage.close()
+        storage = self.open()
+        self.assertEqual(sorted(storage.ids()), [1, 2, 4])
+        self.assertEqual(storage.get(2), '{"state": 2}')
+
+    def test_compact(self):
+        storage = self.open(segment_size=1)
+        for id in (1, 2, 3):
+            storage.add(self.state(id))
+        storage.close()
+        # A duplicate, as written by an older server
+        with open(os.path.join(self.log_dir, segment_name(3)), 'ab') as f:
+            f.write(encode_record(self.state(2, '{"copy": true}'),
+                                  self.codec))
+
+        self.assertEqual(compact_log(self.log_dir, self.codec), 3)
+        self.assertEqual(os.listdir(self.log_dir), [segment_name(1)])
+        self.assertFalse(os.path.exists(self.log_dir + '.old'))
+        storage = self.open()
+        self.assertEqual(sorted(storage.ids()), [1, 2, 3])
+        # The first copy of a state wins
+        self.assertEqual(storage.get(2), '{"state": 2}')
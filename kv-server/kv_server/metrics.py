@@ -0,0 +1,276 @@
+"""
+Request instrumentation, exposed at /metrics in the Prometheus text format.
+
+Every request records its total time and, separately, the time spent in the
+phases that are likely to be slow: 'validation' (parsing and checking the
+JSON of saved states) and 'storage' (the database or the log, including the
+wait for a group commit). How late the event loop wakes up sleeping
+greenlets is measured by LoopLagMonitor; when it grows, requests are waiting
+for the CPU rather than for storage.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, request
+
+from kv_server.app import app
+
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+size_buckets = (64, 256, 1024, 2048, 4096, 8192, 16384, 65536, 262144,
+                1048576)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """A value that only goes up, for each combination of label values."""
+    type = 'counter'
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, list(zip(self.label_names, label_values)), value
+
+
+class Gauge(object):
+    """
+    A value read from a function when metrics are collected. Counters kept
+    elsewhere (e.g. by StateCache) are exported with type='counter'.
+    """
+
+    def __init__(self, name, help, function, type='gauge'):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.type = type
+
+    def samples(self):
+        yield self.name, [], self.function()
+
+
+class Histogram(object):
+    """Cumulative histogram of observations, like a Prometheus histogram."""
+    type = 'histogram'
+
+    def __init__(self, name, help, label_names=(), buckets=latency_buckets):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above last bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = \
+                    [0] * (len(self.buckets) + 2)
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, list(counts))
+                            for label_values, counts in self._values.items())
+        for label_values, counts in values:
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', labels + [('le', bound)], \
+                    cumulative
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, cumulative
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """Returns all the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (
+                    name,
+                    format_labels([(label, format_value(label_value))
+                                   for label, label_value in labels]),
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+requests_total = registry.add(Counter(
+    'kv_requests_total', 'Requests served.',
+    ('endpoint', 'method', 'status')))
+request_duration = registry.add(Histogram(
+    'kv_request_duration_seconds', 'Total time spent serving requests.',
+    ('endpoint', 'method')))
+phase_duration = registry.add(Histogram(
+    'kv_request_phase_duration_seconds',
+    'Time spent in each phase of serving requests.',
+    ('endpoint', 'phase')))
+request_size = registry.add(Histogram(
+    'kv_request_size_bytes', 'Size of request bodies.',
+    ('endpoint',), buckets=size_buckets))
+response_size = registry.add(Histogram(
+    'kv_response_size_bytes', 'Size of response bodies.',
+    ('endpoint',), buckets=size_buckets))
+slow_requests = registry.add(Counter(
+    'kv_slow_requests_total',
+    'Requests that took longer than SLOW_REQUEST_SECONDS.', ('endpoint',)))
+rejected_requests = registry.add(Counter(
+    'kv_rejected_requests_total',
+    'Requests rejected by rate limits or because the server was busy.',
+    ('reason',)))
+loop_lag = registry.add(Histogram(
+    'kv_event_loop_lag_seconds',
+    'How late sleeping greenlets are woken up by the event loop.'))
+
+in_flight_requests = 0
+_in_flight_lock = threading.Lock()
+
+
+def requests_in_flight():
+    return in_flight_requests
+
+
+registry.add(Gauge('kv_requests_in_flight',
+                   'Requests being served at the moment.',
+                   requests_in_flight))
+
+
+def watch_server_pool(pool):
+    """Exports the number of greenlets of a gevent server pool."""
+    registry.add(Gauge('kv_server_greenlets',
+                       'Greenlets handling connections at the moment.',
+                       lambda: len(pool)))
+
+
+@contextmanager
+def timed_phase(phase):
+    """Adds the time spent inside the block to a phase of this request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = g.setdefault('phases', {})
+        phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+
+
+def endpoint_label():
+    if request.url_rule is not None:
+        return request.url_rule.rule
+    return 'unmatched'
+
+
+@app.before_request
+def start_request_timer():
+    global in_flight_requests
+    g.request_start = time.perf_counter()
+    g.in_flight = True
+    with _in_flight_lock:
+        in_flight_requests += 1
+
+
+@app.teardown_request
+def end_request(exception):
+    # Also run after unhandled exceptions, unlike after_request
+    global in_flight_requests
+    if g.pop('in_flight', False):
+        with _in_flight_lock:
+            in_flight_requests -= 1
+
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is None:
+        return response
+
+    duration = time.perf_counter() - start
+    endpoint = endpoint_label()
+    phases = g.get('phases', {})
+
+    requests_total.inc(endpoint, request.method, response.status_code)
+    request_duration.observe(duration, endpoint, request.method)
+    for phase, phase_time in phases.items():
+        phase_duration.observe(phase_time, endpoint, phase)
+    request_size.observe(request.content_length or 0, endpoint)
+    if not response.is_streamed:
+        response_size.observe(response.calculate_content_length() or 0,
+                              endpoint)
+
+    threshold = app.config['SLOW_REQUEST_SECONDS']
+    if threshold is not None and duration >= threshold:
+        slow_requests.inc(endpoint)
+        app.logger.warning('Slow request: %s %s took %.3f s (%s), status %d' % (
+            request.method, request.path, duration,
+            ', '.join('%s %.3f s' % phase for phase in sorted(phases.items()))
+            or 'no phases recorded',
+            response.status_code))
+    return response
+
+
+class LoopLagMonitor(object):
+    """
+    Sleeps for interval seconds again and again, recording how much later
+    than requested it wakes up. With gevent's monkey patching it runs as a
+    greenlet, so the lag is the time greenlets wait to be scheduled.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._thread = threading.Thread(target=self._run,
+                                        name='loop-lag-monitor')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            start = time.perf_counter()
+            time.sleep(self.interval)
+            loop_lag.observe(
+                max(0, time.perf_counter() - start - self.interval))
@@ -1,20 +1,49 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 from kv_server.app import app
 
-db = SQLAlchemy(app)
+
+class TunableSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, info, options):
+        ret = SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if app.config['SQLITE_TUNING'] and info.drivername == 'sqlite':
+            from kv_server.sqlite_tuning import pool_options
+            options.update(pool_options())
+        return ret
+
+
+db = TunableSQLAlchemy(app)
+
+
+def init_storage():
+    """Sets up the database engines. Must be called before using them."""
+    if app.config['SQLITE_TUNING']:
+        from kv_server.sqlite_tuning import tune_engine
+        tune_engine(db.engine)
+    db.create_all()
+
+    # Databases created before compression existed lack the data column
+    columns = [column['name']
+               for column in inspect(db.engine).get_columns('state')]
+    if 'data' not in columns:
+        db.engine.execute('ALTER TABLE state ADD COLUMN data BLOB')
 
 
 class State(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # Uncompressed values are stored as text in value, compressed ones in
+    # data (see kv_server.value_codec). The other column is NULL.
     value = db.Column(db.Text(), unique=False)
+    data = db.Column(db.LargeBinary(), nullable=True)
     ip = db.Column(db.String(45))
     created = db.Column(db.DateTime())
 
-    def __init__(self, id, value, ip, created):
+    def __init__(self, id, value, ip, created, data=None):
         self.id = id
         self.value = value
         self.ip = ip
         self.created = created
+        self.data = data
 
     def __repr__(self):
         return '<State %r>' % self.id
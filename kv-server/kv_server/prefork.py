@@ -0,0 +1,140 @@
+"""
+Pre-fork serving: a master process opens the listening socket and forks
+worker processes that accept connections from it, so requests are spread
+over several cores.
+
+The master restarts workers that die. On SIGHUP it starts a new set of
+workers and then asks the old ones to stop, so workers can be replaced (e.g.
+to reopen the storage) without refusing connections. On SIGTERM or SIGINT it
+stops every worker and exits. Workers stop by finishing the requests in
+progress, for up to graceful_timeout seconds.
+
+Workers are forked before any storage is opened or thread is started, so
+they share nothing but the socket and the files on disk.
+"""
+import os
+import signal
+import socket
+import sys
+import time
+
+from kv_server.app import app
+
+# Workers dying sooner than this after being started are restarted after a
+# delay, so a broken configuration does not make the master spin.
+min_worker_lifetime = 5
+
+
+def create_listener(host, port, backlog=1024):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+class Worker(object):
+    def __init__(self, pid, number, generation):
+        self.pid = pid
+        self.number = number
+        self.generation = generation
+        self.started = time.time()
+
+
+class PreforkMaster(object):
+    def __init__(self, listener, num_workers, run_worker):
+        """
+        :param run_worker: function called in each worker process, with the
+        listening socket and the worker number (from 0 to num_workers - 1)
+        as arguments. It must serve until the process gets SIGTERM.
+        """
+        self.listener = listener
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.generation = 0
+        self.workers = {}  # type: dict[int, Worker]
+        self._stopping = False
+        self._restart_requested = False
+
+    def _spawn(self, number):
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            # Ctrl+C reaches every process of the terminal: let the master
+            # stop the workers gracefully
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            exit_code = 0
+            try:
+                self.run_worker(self.listener, number)
+            except BaseException:
+                app.logger.exception('Worker %d failed' % number)
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        self.workers[pid] = Worker(pid, number, self.generation)
+
+    def _signal_workers(self, sig, generation=None):
+        for worker in list(self.workers.values()):
+            if generation is None or worker.generation == generation:
+                try:
+                    os.kill(worker.pid, sig)
+                except ProcessLookupError:
+                    pass
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _handle_restart(self, signum, frame):
+        self._restart_requested = True
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if self._stopping or worker.generation != self.generation:
+                continue
+
+            app.logger.warning('Worker %d (pid %d) exited with status %d, '
+                               'restarting it' % (worker.number, pid, status))
+            if time.time() - worker.started < min_worker_lifetime:
+                time.sleep(1)
+            self._spawn(worker.number)
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_restart)
+
+        for number in range(self.num_workers):
+            self._spawn(number)
+
+        stop_sent = False
+        while self.workers:
+            if self._stopping and not stop_sent:
+                self._signal_workers(signal.SIGTERM)
+                stop_sent = True
+            if self._restart_requested and not self._stopping:
+                self._restart_requested = False
+                old_generation = self.generation
+                self.generation += 1
+                app.logger.warning('Restarting workers')
+                for number in range(self.num_workers):
+                    self._spawn(number)
+                self._signal_workers(signal.SIGTERM, old_generation)
+
+            self._reap()
+            time.sleep(0.1)
+
+        self.listener.close()
@@ -0,0 +1,129 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from unittest import TestCase, mock
+
+
+class TokenBucket(object):
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter(object):
+    """
+    Token bucket rate limiter, with a bucket per client.
+
+    Each client can make bursts of up to `burst` requests, refilled at `rate`
+    requests per second. Buckets are kept in memory, in LRU order: buckets
+    not used in idle_timeout seconds (which would be full again anyway) are
+    dropped, and at most max_clients buckets are kept.
+
+    Requests costing more than `burst` tokens are allowed once the bucket is
+    full, leaving it in debt, so that the client waits for all of them.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000, idle_timeout=600):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.idle_timeout = idle_timeout
+        self._buckets = OrderedDict()  # type: OrderedDict[str, TokenBucket]
+        self._lock = threading.Lock()
+
+    def acquire(self, client, cost=1):
+        """
+        Takes cost tokens from the bucket of a client.
+
+        Returns 0 if the request is allowed, otherwise the number of seconds
+        until it would be.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, now)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens +
+                                    (now - bucket.updated) * self.rate)
+                bucket.updated = now
+            self._buckets[client] = bucket
+            self._evict(now)
+
+            needed = min(cost, self.burst)
+            if bucket.tokens >= needed:
+                bucket.tokens -= cost
+                return 0
+            else:
+                return (needed - bucket.tokens) / self.rate
+
+    def _evict(self, now):
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        while self._buckets:
+            oldest = next(iter(self._buckets.values()))
+            if now - oldest.updated < self.idle_timeout:
+                break
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def retry_after_header(seconds):
+    """Value for a Retry-After header, which only accepts whole seconds."""
+    return str(max(1, int(math.ceil(seconds))))
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_bucket(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        self.assertEqual([limiter.acquire('a') for i in range(4)],
+                         [0, 0, 0, 0.5])
+        # Other clients have their own bucket
+        self.assertEqual(limiter.acquire('b'), 0)
+
+        self.now += 0.5
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('a'), 0.5)
+        # Refilled up to the burst size
+        self.now += 60
+        self.assertEqual([limiter.acquire('a') for i in range(4)],
+                         [0, 0, 0, 0.5])
+
+    def test_cost(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        self.assertEqual(limiter.acquire('a', cost=2), 0)
+        self.assertEqual(limiter.acquire('a', cost=2), 0.5)
+        self.now += 0.5
+        self.assertEqual(limiter.acquire('a', cost=2), 0)
+
+        # More than the burst waits for a full bucket, and then for its debt
+        self.assertEqual(limiter.acquire('a', cost=10), 1.5)
+        self.now += 1.5
+        self.assertEqual(limiter.acquire('a', cost=10), 0)
+        self.assertEqual(limiter.acquire('a'), 4)
+
+    def test_evict(self):
+        limiter = RateLimiter(rate=1, burst=1, max_clients=2,
+                              idle_timeout=10)
+        for client in 'abc':
+            limiter.acquire(client)
+        self.assertEqual(len(limiter), 2)
+        # a was dropped, so its bucket is full again
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.now += 10
+        limiter.acquire('d')
+        self.assertEqual(len(limiter), 1)
+
+        self.assertEqual([retry_after_header(seconds)
+                          for seconds in (0.01, 1, 1.5)], ['1', '1', '2'])
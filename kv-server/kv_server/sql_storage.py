@@ -0,0 +1,136 @@
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from kv_server.app import app
+from kv_server.model import State, db
+from kv_server.storage import StateStorage
+
+max_ids_per_query = 500
+max_add_attempts = 3
+
+
+class SQLStateStorage(StateStorage):
+    """Saves states in the State table, with SQLAlchemy."""
+
+    def __init__(self, codec):
+        StateStorage.__init__(self, codec)
+        if app.config['SQLITE_TUNING']:
+            from kv_server.sqlite_tuning import create_read_engine
+            self.read_engine = create_read_engine(db.engine.url)
+        else:
+            self.read_engine = None
+
+    def _new_state(self, state):
+        if self.codec.compress:
+            return State(state.id, None, state.ip, state.created,
+                         data=self.codec.encode(state.value))
+        else:
+            return State(*state)
+
+    def value_of(self, row):
+        """Returns the value of a State row, decompressing it if needed."""
+        if row.data is not None:
+            return self.codec.decode(row.data)
+        else:
+            return row.value
+
+    def get(self, numeric_id):
+        if self.read_engine is not None:
+            with self.read_engine.connect() as connection:
+                row = connection.execute(
+                    select([State.value, State.data])
+                    .where(State.id == numeric_id)
+                ).first()
+        else:
+            row = State.query.get(numeric_id)
+
+        if row is not None:
+            return self.value_of(row)
+        else:
+            return None
+
+    def get_many(self, numeric_ids):
+        numeric_ids = list(set(numeric_ids))
+        values = {}
+        # Keep below the limit of bound parameters of SQLite
+        for start in range(0, len(numeric_ids), max_ids_per_query):
+            query = select([State.id, State.value, State.data]).where(
+                State.id.in_(numeric_ids[start:start + max_ids_per_query]))
+            if self.read_engine is not None:
+                with self.read_engine.connect() as connection:
+                    rows = connection.execute(query).fetchall()
+            else:
+                rows = db.session.execute(query).fetchall()
+            for row in rows:
+                values[row.id] = self.value_of(row)
+        return values
+
+    def add(self, state):
+        try:
+            db.session.add(self._new_state(state))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # The key already exists.
+            db.session.rollback()
+            return False
+
+    def add_many(self, states):
+        # Another process may save one of the states between the query and
+        # the commit. Then the existing ids are queried again.
+        for attempt in range(max_add_attempts):
+            try:
+                return self._add_many(states)
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == max_add_attempts - 1:
+                    raise
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _add_many(self, states):
+        existing_ids = set(
+            id for (id,) in
+            db.session.query(State.id).filter(
+                State.id.in_(set(state.id for state in states))))
+
+        created = []
+        for state in states:
+            is_new = state.id not in existing_ids
+            if is_new:
+                db.session.add(self._new_state(state))
+                # Later duplicates in the same batch are not new
+                existing_ids.add(state.id)
+            created.append(is_new)
+        db.session.commit()
+        return created
+
+    def ids(self):
+        return [id for (id,) in db.session.query(State.id)]
+
+    def iter_stored(self):
+        query = db.session.query(State.value, State.data).yield_per(1000)
+        for value, data in query:
+            if data is not None:
+                yield self.codec.decode(data), len(data)
+            else:
+                yield value, len(value.encode('UTF-8'))
+
+    def compress_existing(self, batch_size=1000):
+        """
+        Stores again with the current codec every state saved uncompressed.
+        Returns the number of states converted.
+        """
+        assert self.codec.compress
+        count = 0
+        while True:
+            states = State.query.filter(State.data.is_(None)) \
+                .limit(batch_size).all()
+            if len(states) == 0:
+                return count
+            for state in states:
+                state.data = self.codec.encode(state.value)
+                state.value = None
+            db.session.commit()
+            count += len(states)
@@ -0,0 +1,93 @@
+"""
+Production storage profile for SQLite databases.
+
+* The database uses WAL journaling, so readers never wait for the writer and
+  the writer never waits for readers.
+* Connections are pooled instead of being opened for every request, and get
+  a bigger page cache and memory mapped I/O.
+* GET requests read through a separate pool of read-only connections.
+* WAL checkpoints are done automatically every SQLITE_WAL_AUTOCHECKPOINT
+  pages, and optionally by a background thread every
+  SQLITE_CHECKPOINT_INTERVAL seconds.
+"""
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from kv_server.app import app
+
+
+def sqlite_pragmas(read_only):
+    pragmas = [
+        ('synchronous', app.config['SQLITE_SYNCHRONOUS']),
+        # Negative values are in KiB instead of pages
+        ('cache_size', -app.config['SQLITE_CACHE_SIZE_KB']),
+        ('mmap_size', app.config['SQLITE_MMAP_SIZE']),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', app.config['SQLITE_BUSY_TIMEOUT_MS']),
+    ]
+    if not read_only:
+        # journal_mode is persistent, but can only be set from a connection
+        # allowed to write
+        pragmas += [
+            ('journal_mode', 'WAL'),
+            ('wal_autocheckpoint', app.config['SQLITE_WAL_AUTOCHECKPOINT']),
+        ]
+    return pragmas
+
+
+def tune_engine(engine, read_only=False):
+    """Sets the pragmas of the profile on every new connection of engine."""
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    return engine
+
+
+def pool_options():
+    return dict(
+        poolclass=QueuePool,
+        pool_size=app.config['DB_POOL_SIZE'],
+        max_overflow=0,
+        # Pooled connections are handed to whichever thread needs them
+        connect_args={'check_same_thread': False},
+    )
+
+
+def create_read_engine(url):
+    """Creates an engine with read-only connections to a SQLite database."""
+    read_url = 'sqlite:///file:%s?mode=ro&uri=true' % make_url(url).database
+    return tune_engine(create_engine(read_url, **pool_options()),
+                       read_only=True)
+
+
+class Checkpointer(object):
+    """Runs WAL checkpoints on a database every interval seconds."""
+
+    def __init__(self, engine, interval, mode='PASSIVE'):
+        self.engine = engine
+        self.interval = interval
+        self.mode = mode
+        self._thread = threading.Thread(target=self._run, name='checkpointer')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.engine.connect() as connection:
+                    connection.execute('PRAGMA wal_checkpoint(%s)' % self.mode)
+            except Exception:
+                app.logger.exception('WAL checkpoint failed')
@@ -0,0 +1,93 @@
+import gzip
+import threading
+from collections import OrderedDict
+from unittest import TestCase
+
+
+class CachedState(object):
+    __slots__ = ('body', 'gzip_body')
+
+    def __init__(self, body, gzip_body):
+        self.body = body
+        self.gzip_body = gzip_body
+
+    @property
+    def size(self):
+        return len(self.body) + (len(self.gzip_body) if self.gzip_body else 0)
+
+
+class StateCache(object):
+    """
+    LRU cache of state values, bounded by the total size of the bodies held.
+
+    States are immutable (their id is a hash of their content), so entries
+    never need to be invalidated.
+    """
+
+    def __init__(self, max_bytes, precompress=False):
+        self.max_bytes = max_bytes
+        self.precompress = precompress
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: OrderedDict[int, CachedState]
+        self._lock = threading.Lock()
+
+    def get(self, numeric_id):
+        """Returns the CachedState of a state or None if it's not cached."""
+        with self._lock:
+            entry = self._entries.get(numeric_id)
+            if entry is not None:
+                self._entries.move_to_end(numeric_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def put(self, numeric_id, value):
+        """Caches the value of a state and returns its CachedState."""
+        body = value.encode('UTF-8')
+        gzip_body = gzip.compress(body) if self.precompress else None
+        entry = CachedState(body, gzip_body)
+        if entry.size > self.max_bytes:
+            return entry
+
+        with self._lock:
+            old_entry = self._entries.pop(numeric_id, None)
+            if old_entry is not None:
+                self.size -= old_entry.size
+            self._entries[numeric_id] = entry
+            self.size += entry.size
+
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted.size
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TestStateCache(TestCase):
+    def test_lru(self):
+        cache = StateCache(10)
+        cache.put(1, 'aaaa')
+        cache.put(2, 'bbbb')
+        self.assertEqual(cache.get(1).body, b'aaaa')
+        # 2 is the least recently used
+        cache.put(3, 'cccc')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual((len(cache), cache.size), (2, 8))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Too big to be cached, but still returned
+        self.assertEqual(cache.put(4, 'x' * 11).body, b'x' * 11)
+        self.assertIsNone(cache.get(4))
+        self.assertEqual(len(cache), 2)
+
+    def test_precompress(self):
+        cache = StateCache(1000, precompress=True)
+        entry = cache.put(1, '{"a": 1}')
+        self.assertEqual(gzip.decompress(entry.gzip_body), b'{"a": 1}')
+        self.assertEqual(cache.size, len(entry.body) + len(entry.gzip_body))
+        self.assertIsNone(StateCache(1000).put(1, '{}').gzip_body)
@@ -0,0 +1,83 @@
+from collections import namedtuple
+
+from kv_server.app import app
+
+# A state as handed to storage backends. id is the numeric id
+# (see url_string_to_number()).
+StoredState = namedtuple('StoredState', ['id', 'value', 'ip', 'created'])
+
+
+class StateStorage(object):
+    """
+    Interface of the backends that persist states.
+
+    Values are stored encoded with codec (see kv_server.value_codec).
+    """
+
+    def __init__(self, codec):
+        """
+        :type codec: kv_server.value_codec.ValueCodec
+        """
+        self.codec = codec
+
+    def get(self, numeric_id):
+        """Returns the value of a state or None if it does not exist."""
+        raise NotImplementedError
+
+    def get_many(self, numeric_ids):
+        """
+        Returns a dict with the value of each one of the states that exist.
+        Missing states are left out.
+        """
+        values = {}
+        for numeric_id in numeric_ids:
+            value = self.get(numeric_id)
+            if value is not None:
+                values[numeric_id] = value
+        return values
+
+    def add(self, state):
+        """
+        Saves a StoredState.
+
+        Returns True if it was created, False if a state with the same id
+        already existed.
+        """
+        return self.add_many([state])[0]
+
+    def add_many(self, states):
+        """
+        Saves several states at once, durably. Returns a list with the result
+        of add() for each one of them.
+        """
+        raise NotImplementedError
+
+    def ids(self):
+        """Returns an iterable with the ids of all the saved states."""
+        raise NotImplementedError
+
+    def iter_stored(self):
+        """Yields (value, size of the stored value) for every state."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def create_storage():
+    """Returns the StateStorage set in the STORAGE_BACKEND setting."""
+    from kv_server.value_codec import ValueCodec
+    codec = ValueCodec(compress=app.config['STATE_COMPRESSION'],
+                       dictionary_path=app.config['STATE_DICTIONARY'])
+
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'sql':
+        from kv_server.sql_storage import SQLStateStorage
+        return SQLStateStorage(codec)
+    elif backend == 'log':
+        from kv_server.log_storage import LogStateStorage
+        return LogStateStorage(app.config['LOG_STORAGE_DIR'], codec,
+                               fsync=app.config['LOG_FSYNC'],
+                               shared=app.config['LOG_SHARED'])
+    else:
+        raise ValueError('Unknown storage backend: %s' % backend)
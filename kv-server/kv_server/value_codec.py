@@ -0,0 +1,197 @@
+"""
+Encoding of state values in storage.
+
+Values are stored either as plain UTF-8 JSON (the original format, always
+readable) or compressed with zlib, optionally using a shared dictionary
+trained from existing states:
+
+    Compressed {
+        byte marker = 0;           // JSON never starts with a NUL byte
+        byte version = 1;
+        uint32 dictionary_id;      // 0 if no dictionary was used
+        byte[] zlib_stream;
+    }
+
+Dictionaries are files named <dictionary id>.zdict, where the id is the
+CRC-32 of their contents. Every dictionary in the directory of the current
+one is loaded, so values compressed with older dictionaries can still be
+read.
+"""
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import Counter
+from unittest import TestCase
+
+compressed_header = struct.Struct('<BBL')
+compressed_marker = 0
+compressed_version = 1
+max_dictionary_size = 32 * 1024  # zlib window size
+
+
+def dictionary_id(dictionary):
+    return zlib.crc32(dictionary) or 1
+
+
+def dictionary_file_name(dictionary):
+    return '%08x.zdict' % dictionary_id(dictionary)
+
+
+class ValueCodec(object):
+    def __init__(self, compress=False, dictionary_path=None):
+        self.compress = compress
+        self.dictionaries = {}  # type: dict[int, bytes]
+        self.dictionary = None  # used for new values
+
+        if dictionary_path is not None:
+            with open(dictionary_path, 'rb') as f:
+                self.dictionary = f.read()
+            directory = os.path.dirname(os.path.abspath(dictionary_path))
+            for file_name in os.listdir(directory):
+                if file_name.endswith('.zdict'):
+                    with open(os.path.join(directory, file_name), 'rb') as f:
+                        dictionary = f.read()
+                    self.dictionaries[dictionary_id(dictionary)] = dictionary
+            self.dictionaries[dictionary_id(self.dictionary)] = self.dictionary
+
+    def encode(self, value):
+        """Returns the bytes to store for a state value."""
+        data = value.encode('UTF-8')
+        if not self.compress:
+            return data
+
+        if self.dictionary is not None:
+            compressor = zlib.compressobj(9, zdict=self.dictionary)
+            used_dictionary_id = dictionary_id(self.dictionary)
+        else:
+            compressor = zlib.compressobj(9)
+            used_dictionary_id = 0
+        return compressed_header.pack(compressed_marker, compressed_version,
+                                      used_dictionary_id) + \
+            compressor.compress(data) + compressor.flush()
+
+    def decode(self, data):
+        """Returns the state value for stored bytes, in any format."""
+        if not is_compressed(data):
+            return bytes(data).decode('UTF-8')
+
+        marker, version, used_dictionary_id = \
+            compressed_header.unpack_from(data, 0)
+        if version != compressed_version:
+            raise ValueError('Unknown compressed value version: %d' % version)
+        if used_dictionary_id != 0:
+            try:
+                decompressor = zlib.decompressobj(
+                    zdict=self.dictionaries[used_dictionary_id])
+            except KeyError:
+                raise ValueError('Missing dictionary %08x.zdict' %
+                                 used_dictionary_id)
+        else:
+            decompressor = zlib.decompressobj()
+        payload = data[compressed_header.size:]
+        return (decompressor.decompress(payload) + decompressor.flush()) \
+            .decode('UTF-8')
+
+
+def is_compressed(data):
+    return len(data) > 0 and data[0] == compressed_marker
+
+
+def train_dictionary(values, size=max_dictionary_size, gram_length=16,
+                     step=4):
+    """
+    Builds a zlib dictionary with the substrings shared by most values.
+
+    Substrings that appear in more values go at the end of the dictionary,
+    where zlib finds them with the shortest distances.
+    """
+    document_frequency = Counter()
+    for value in values:
+        data = value.encode('UTF-8')
+        document_frequency.update(set(
+            data[i:i + gram_length]
+            for i in range(0, len(data) - gram_length + 1, step)))
+
+    chosen = []
+    dictionary_size = 0
+    for gram, count in document_frequency.most_common():
+        if count < 2 or dictionary_size >= size:
+            break
+        if any(gram in other for other in chosen):
+            continue
+        chosen.append(gram)
+        dictionary_size += len(gram)
+
+    # Most frequent last
+    return b''.join(reversed(chosen))[-size:]
+
+
+class TestValueCodec(TestCase):
+    values = ['{"filters": [{"type": "reaction", "value": "P P --> Z0 X"}, '
+              '{"type": "cmenergies", "value": [%d, 8000]}], "version": 2}'
+              % energy for energy in range(7000, 7100, 10)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write_dictionary(self, dictionary):
+        path = os.path.join(self.dir, dictionary_file_name(dictionary))
+        with open(path, 'wb') as f:
+            f.write(dictionary)
+        return path
+
+    def test_plain(self):
+        codec = ValueCodec()
+        value = '{"label": "\u03c3 [pb]"}'
+        self.assertEqual(codec.encode(value), value.encode('UTF-8'))
+        self.assertEqual(codec.decode(memoryview(value.encode('UTF-8'))),
+                         value)
+        self.assertEqual(codec.decode(b''), '')
+
+    def test_compressed(self):
+        codec = ValueCodec(compress=True)
+        data = codec.encode(self.values[0])
+        self.assertEqual(data[:6], b'\x00\x01\x00\x00\x00\x00')
+        self.assertEqual(codec.decode(data), self.values[0])
+        # Values stored before compression are still read
+        self.assertEqual(codec.decode(self.values[1].encode('UTF-8')),
+                         self.values[1])
+        # As written by this version, so it must always be read
+        self.assertEqual(ValueCodec().decode(
+            b'\x00\x01\x00\x00\x00\x00' + zlib.compress(b'{"a": 1}')),
+            '{"a": 1}')
+
+        with self.assertRaises(ValueError):
+            codec.decode(b'\x00\x02\x00\x00\x00\x00' + data[6:])
+
+    def test_dictionary(self):
+        dictionary = train_dictionary(self.values)
+        self.assertTrue(0 < len(dictionary) <= max_dictionary_size)
+        self.assertIn(b'"P P --> Z0 X', dictionary)
+
+        old_path = self.write_dictionary(b'{"type": "cmenergies", "value": ')
+        old_data = ValueCodec(True, old_path).encode(self.values[0])
+        path = self.write_dictionary(dictionary)
+        codec = ValueCodec(True, path)
+        data = codec.encode(self.values[0])
+        self.assertEqual(struct.unpack('<L', data[2:6])[0],
+                         dictionary_id(dictionary))
+        self.assertLess(len(data),
+                        len(ValueCodec(True).encode(self.values[0])))
+        self.assertEqual(codec.decode(data), self.values[0])
+        # Values compressed with older dictionaries of the same directory
+        self.assertEqual(codec.decode(old_data), self.values[0])
+
+        with self.assertRaises(ValueError):
+            ValueCodec(True).decode(data)
+
+    def test_train_dictionary(self):
+        self.assertEqual(train_dictionary([]), b'')
+        # Substrings of a single value are not worth it
+        self.assertEqual(train_dictionary(['{"a": "abcdefghijklmnopq"}']),
+                         b'')
+        dictionary = train_dictionary(self.values, size=64)
+        self.assertLessEqual(len(dictionary), 64)
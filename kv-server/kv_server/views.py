@@ -1,12 +1,118 @@
 from datetime import datetime
+import gzip
 import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
 
-from flask import request, Response
-from sqlalchemy.exc import IntegrityError
+from flask import g, request, Response
 
-from kv_server.app import something_fishy, app
+from kv_server.app import something_fishy, app, HTTPError
 from kv_server.custom_url_hash import url_string_to_number, custom_url_hash
-from kv_server.model import State, db
+from kv_server.group_commit import GroupCommitter
+from kv_server.metrics import registry, timed_phase, Gauge, \
+    rejected_requests, requests_in_flight
+from kv_server.model import db
+from kv_server.rate_limit import RateLimiter, retry_after_header
+from kv_server.state_cache import StateCache
+from kv_server.storage import create_storage, StoredState
+
+# States never change once saved (their id is a hash of their value), so
+# browsers and proxies can keep them forever.
+immutable_cache_control = 'public, max-age=31536000, immutable'
+
+state_cache = StateCache(app.config['STATE_CACHE_BYTES'],
+                         precompress=app.config['STATE_CACHE_GZIP'])
+
+storage = create_storage()
+
+registry.add(Gauge('kv_state_cache_hits_total', 'State cache hits.',
+                   lambda: state_cache.hits, type='counter'))
+registry.add(Gauge('kv_state_cache_misses_total', 'State cache misses.',
+                   lambda: state_cache.misses, type='counter'))
+registry.add(Gauge('kv_state_cache_bytes', 'Size of the cached states.',
+                   lambda: state_cache.size))
+
+if app.config['GROUP_COMMIT']:
+    group_committer = GroupCommitter(storage,
+                                     app.config['GROUP_COMMIT_MAX_BATCH'],
+                                     app.config['GROUP_COMMIT_DELAY'])
+    group_committer.start()
+else:
+    group_committer = None
+
+
+def create_rate_limiter(rate, burst):
+    if rate <= 0:
+        return None
+    return RateLimiter(rate, burst,
+                       max_clients=app.config['RATE_LIMIT_MAX_CLIENTS'],
+                       idle_timeout=app.config['RATE_LIMIT_IDLE_SECONDS'])
+
+
+read_limiter = create_rate_limiter(app.config['READ_RATE_LIMIT'],
+                                   app.config['READ_BURST'])
+write_limiter = create_rate_limiter(app.config['WRITE_RATE_LIMIT'],
+                                    app.config['WRITE_BURST'])
+
+
+@app.before_request
+def limit_requests():
+    """Sheds load before doing any work when the server is too busy."""
+    if request.endpoint not in ('get_state', 'get_states_batch', 'put_state'):
+        return
+
+    max_in_flight = app.config['MAX_IN_FLIGHT']
+    if max_in_flight is not None and \
+            requests_in_flight() > max_in_flight:
+        rejected_requests.inc('busy')
+        raise HTTPError(503, 'Server busy', retry_after='1')
+
+    limiter = write_limiter if request.method == 'PUT' else read_limiter
+    if limiter is not None:
+        # A batch costs as much as fetching its states one by one
+        cost = 1
+        if request.endpoint == 'get_states_batch':
+            cost = max(1, len(batch_request_ids()))
+        # Thanks to ProxyFix, this is the address of the client, not nginx
+        wait = limiter.acquire(request.remote_addr, cost)
+        if wait > 0:
+            rejected_requests.inc('rate_limit')
+            raise HTTPError(429, 'Too many requests',
+                            retry_after=retry_after_header(wait))
+
+
+def state_etag(id, gzipped):
+    # The gzip body is a different representation of the state, so it can't
+    # share the strong ETag of the identity body
+    return id + '-gz' if gzipped else id
+
+
+def not_modified_response(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    if app.config['STATE_CACHE_GZIP']:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = immutable_cache_control
+    return response
+
+
+def state_response(id, cached_state):
+    """
+    :type cached_state: kv_server.state_cache.CachedState
+    """
+    use_gzip = cached_state.gzip_body is not None and \
+        'gzip' in request.accept_encodings
+    response = Response(cached_state.gzip_body if use_gzip
+                        else cached_state.body)
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    if cached_state.gzip_body is not None:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(state_etag(id, use_gzip))
+    response.headers['Cache-Control'] = immutable_cache_control
+    return response
 
 
 @app.route('/')
@@ -21,11 +127,103 @@ def get_state(id):
     except ValueError:
         something_fishy('Malformated id')
 
-    state = State.query.get(numeric_id)
-    if state is not None:
-        return state.value
-    else:
-        return Response(status=404)
+    cached_state = state_cache.get(numeric_id)
+    if cached_state is None:
+        with timed_phase('storage'):
+            value = storage.get(numeric_id)
+        if value is None:
+            return Response(status=404)
+        cached_state = state_cache.put(numeric_id, value)
+
+    # The client already has this state, and states never change. If-None-Match
+    # uses the weak comparison. It's only checked once the state is known to
+    # exist, as preconditions don't apply to error responses (RFC 7232,
+    # section 5).
+    response = state_response(id, cached_state)
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        return not_modified_response(response.get_etag()[0])
+    for etag in (state_etag(id, False), state_etag(id, True)):
+        if if_none_match.contains_weak(etag):
+            return not_modified_response(etag)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.exposition(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def batch_request_ids():
+    """
+    Returns the ids of a POST /states/batch request, as a dict mapping every
+    distinct id to its numeric id. It's read once and kept in flask.g, as the
+    rate limit needs it before the view.
+    """
+    if 'batch_ids' in g:
+        return g.batch_ids
+
+    max_ids = app.config['BATCH_MAX_IDS']
+    # Ids are short, leave some room for whitespace
+    if request.content_length is None or \
+            request.content_length > 100 + max_ids * 20:
+        something_fishy('Request too long.')
+    try:
+        ids = json.loads(request.get_data(as_text=True))['ids']
+    except (ValueError, TypeError, KeyError):
+        something_fishy('Invalid JSON.')
+    if not isinstance(ids, list) or len(ids) > max_ids or \
+            not all(isinstance(id, str) for id in ids):
+        something_fishy('Invalid ids.')
+
+    numeric_ids = {}
+    for id in ids:
+        try:
+            numeric_ids[id] = url_string_to_number(id)
+        except ValueError:
+            something_fishy('Malformated id')
+    g.batch_ids = numeric_ids
+    return numeric_ids
+
+
+@app.route('/states/batch', methods=['POST'])
+def get_states_batch():
+    """
+    Returns several states at once. The request is a JSON object like
+    {"ids": ["aBcDe", ...]} and the response looks like
+    {"states": {"aBcDe": <state>, ...}, "missing": [...]}.
+    """
+    numeric_ids = batch_request_ids()
+
+    bodies = {}
+    uncached_ids = []
+    for id, numeric_id in numeric_ids.items():
+        cached_state = state_cache.get(numeric_id)
+        if cached_state is not None:
+            bodies[id] = cached_state.body
+        else:
+            uncached_ids.append(numeric_id)
+    if uncached_ids:
+        with timed_phase('storage'):
+            values = storage.get_many(uncached_ids)
+        for id, numeric_id in numeric_ids.items():
+            value = values.get(numeric_id)
+            if value is not None:
+                bodies[id] = state_cache.put(numeric_id, value).body
+
+    # Saved values are already valid JSON, so they are copied verbatim
+    # instead of being parsed and serialized again.
+    missing = [id for id in numeric_ids if id not in bodies]
+    body = b''.join([
+        b'{"states":{',
+        b','.join(json.dumps(id).encode() + b':' + state_body
+                  for id, state_body in bodies.items()),
+        b'},"missing":',
+        json.dumps(missing).encode(),
+        b'}',
+    ])
+    return Response(body, mimetype='application/json')
 
 
 @app.route('/states/<id>', methods=['PUT'])
@@ -35,27 +233,31 @@ def put_state(id):
         something_fishy('Request too long.')
     value = request.get_data(as_text=True)
 
-    # Only JSON is allowed (don't try to upload HTML pages, please)
-    try:
-        json.loads(value)
-    except ValueError:
-        something_fishy('Invalid JSON.')
+    with timed_phase('validation'):
+        # Only JSON is allowed (don't try to upload HTML pages, please)
+        try:
+            json.loads(value)
+        except ValueError:
+            something_fishy('Invalid JSON.')
 
-    # The id must match the content on a hash function
-    if custom_url_hash(value) != id:
-        something_fishy('Invalid id.')
+        # The id must match the content on a hash function
+        if custom_url_hash(value) != id:
+            something_fishy('Invalid id.')
 
     # OK, everything fine so far, let's try saving
-    try:
-        state = State(url_string_to_number(id), value, request.remote_addr,
-                      datetime.now())
-        db.session.add(state)
-        db.session.commit()
+    state = StoredState(url_string_to_number(id), value, request.remote_addr,
+                        datetime.now())
+    with timed_phase('storage'):
+        if group_committer is not None:
+            created = group_committer.save(state)
+        else:
+            created = storage.add(state)
+
+    if created:
         return Response(status=201)  # OK
-    except IntegrityError:
+    else:
         # The key already exists.
-        db.session.rollback()
-        return Response(status=204) # No Content
+        return Response(status=204)  # No Content
 
 
 @app.teardown_request
@@ -67,3 +269,146 @@ def teardown_request(exception):
     db.session.remove()
 
 
+
+
+class TestViews(TestCase):
+    def setUp(self):
+        from kv_server.log_storage import LogStateStorage
+        from kv_server.value_codec import ValueCodec
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.storage = LogStateStorage(os.path.join(self.dir, 'log'),
+                                       ValueCodec(), fsync=False)
+        self.addCleanup(self.storage.close)
+        self.cache = StateCache(1024 * 1024, precompress=True)
+        patchers = [
+            mock.patch(__name__ + '.storage', self.storage),
+            mock.patch(__name__ + '.state_cache', self.cache),
+            mock.patch.dict(app.config, {'STATE_CACHE_GZIP': True}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+
+    def save(self, value):
+        id = custom_url_hash(value)
+        self.storage.add(StoredState(url_string_to_number(id), value,
+                                     '127.0.0.1', datetime(2020, 1, 1)))
+        return id
+
+    def get(self, id, **headers):
+        return self.client.get('/states/' + id, headers=headers)
+
+    def test_get_state(self):
+        id = self.save('{"a": 1}')
+        for misses in (1, 1):  # Then from the cache
+            response = self.get(id)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'{"a": 1}')
+            self.assertEqual(response.get_etag(), (id, False))
+            self.assertIn('Accept-Encoding', response.vary)
+            self.assertEqual(self.cache.misses, misses)
+        self.assertEqual(self.cache.hits, 1)
+
+        response = self.get(id, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), b'{"a": 1}')
+        self.assertEqual(response.get_etag(), (id + '-gz', False))
+
+    def test_if_none_match(self):
+        id = self.save('{"a": 2}')
+        for if_none_match, etag in [('"%s"' % id, id),
+                                    ('W/"%s"' % id, id),
+                                    ('"other", "%s-gz"' % id, id + '-gz'),
+                                    ('*', id)]:
+            response = self.get(id, **{'If-None-Match': if_none_match})
+            self.assertEqual(response.status_code, 304, if_none_match)
+            self.assertEqual(response.get_etag(), (etag, False))
+            self.assertEqual(response.headers['Cache-Control'],
+                             immutable_cache_control)
+
+        response = self.get(id, **{'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing(self):
+        id = custom_url_hash('{"missing": true}')
+        for if_none_match in ('"%s"' % id, '*', None):
+            headers = {'If-None-Match': if_none_match} if if_none_match \
+                else {}
+            self.assertEqual(self.get(id, **headers).status_code, 404)
+        self.assertEqual(self.get('not!an!id').status_code, 400)
+
+    def post_batch(self, ids, data=None):
+        return self.client.post('/states/batch',
+                                data=data or json.dumps({'ids': ids}))
+
+    def test_batch(self):
+        cached = self.save('{"cached": true}')
+        stored = self.save('{"stored": [1, 2]}')
+        missing = custom_url_hash('{"missing": true}')
+        self.assertEqual(self.get(cached).status_code, 200)
+        misses = self.cache.misses
+
+        response = self.post_batch([cached, stored, missing, stored,
+                                    missing])
+        self.assertEqual(response.status_code, 200)
+        # Repeated ids are only answered once
+        self.assertEqual(json.loads(response.data), {
+            'states': {cached: {'cached': True}, stored: {'stored': [1, 2]}},
+            'missing': [missing],
+        })
+        self.assertEqual(self.cache.misses, misses + 2)
+        self.assertIsNotNone(self.cache.get(url_string_to_number(stored)))
+
+        response = self.post_batch([])
+        self.assertEqual(json.loads(response.data),
+                         {'states': {}, 'missing': []})
+
+    def test_batch_invalid(self):
+        id = self.save('{}')
+        for data in ['{"ids": [', '["%s"]' % id, '{"ids": "%s"}' % id,
+                     '{"ids": [1]}', json.dumps({'ids': [id, 'not!an!id']})]:
+            self.assertEqual(self.post_batch(None, data).status_code, 400,
+                             data)
+
+        with mock.patch.dict(app.config, {'BATCH_MAX_IDS': 2}):
+            self.assertEqual(self.post_batch([id] * 2).status_code, 200)
+            self.assertEqual(self.post_batch([id] * 3).status_code, 400)
+            # Rejected before parsing it
+            self.assertEqual(self.post_batch(
+                None, '{"ids": []}' + ' ' * 200).status_code, 400)
+
+    def test_rate_limit(self):
+        id = self.save('{}')
+        with mock.patch(__name__ + '.read_limiter',
+                        RateLimiter(rate=0.1, burst=5)):
+            for i in range(5):
+                self.assertEqual(self.get(id).status_code, 200)
+            response = self.get(id)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '10')
+            # Writes have their own limit
+            self.assertEqual(self.client.put('/states/' + id,
+                                             data='{}').status_code, 204)
+
+        # Batches cost as many requests as distinct ids they have
+        ids = [custom_url_hash('{"n": %d}' % n) for n in range(3)]
+        with mock.patch(__name__ + '.read_limiter',
+                        RateLimiter(rate=0.1, burst=5)):
+            response = self.post_batch(ids + ids[:1])
+            self.assertEqual(response.status_code, 200)
+            response = self.post_batch(ids)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '10')
+
+    def test_busy(self):
+        id = self.save('{}')
+        # This request is in flight
+        with mock.patch.dict(app.config, {'MAX_IN_FLIGHT': 0}):
+            response = self.get(id)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            self.assertEqual(self.post_batch([id]).status_code, 503)
+        with mock.patch.dict(app.config, {'MAX_IN_FLIGHT': 1}):
+            self.assertEqual(self.get(id).status_code, 200)
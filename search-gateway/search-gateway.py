@@ -0,0 +1,60 @@
+import argh
+
+
+def run_server(host='localhost', port=9202, debug=False,
+               elastic_url='http://localhost:9200', index='hepdata8',
+               cache_mb=128, generation_check_interval=10, enable_cors=False,
+               concurrency=100, fake_backend=False):
+    """
+    Serves searches of the frontend, caching their results.
+
+    With --fake-backend no Elasticsearch is needed: every search finds
+    nothing.
+    """
+    if not debug:
+        # Coalesced searches wait on threading primitives, which must let
+        # other greenlets run when serving with gevent
+        from gevent import monkey
+        monkey.patch_thread()
+        monkey.patch_time()
+        # The Elasticsearch client must not block other requests either
+        monkey.patch_socket()
+
+    from search_gateway.app import app
+    app.config['ELASTIC_URL'] = elastic_url
+    app.config['ELASTIC_INDEX'] = index
+    app.config['QUERY_CACHE_BYTES'] = cache_mb * 1024 * 1024
+    app.config['GENERATION_CHECK_INTERVAL'] = generation_check_interval
+    if fake_backend:
+        from search_gateway.backend import FakeBackend
+        app.config['SEARCH_BACKEND'] = FakeBackend()
+
+    # Decode client IP from X-Forwarded-For (nginx must be used in production,
+    # configured to send this header)
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app)
+
+    # In production the gateway lives in a proxy under /search-gateway
+    if enable_cors:
+        from flask_cors import CORS
+        CORS(app, resources={
+            '*': {
+                'origins': '*'
+            }
+        })
+
+    # looks unused, but it's actually needed in order to have views.
+    import search_gateway.views
+
+    if debug:
+        app.run(host, port, debug)
+    else:
+        from gevent.pywsgi import WSGIServer
+
+        http_server = WSGIServer((host, port), app, spawn=concurrency)
+        http_server.serve_forever()
+
+
+argh.dispatch_commands([
+    run_server,
+])
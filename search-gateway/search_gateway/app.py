@@ -0,0 +1,48 @@
+from flask import Flask, request, jsonify
+
+
+app = Flask(__name__)
+app.config['PRESERVE_CONTEXT_ON_EXCEPTION'] = False
+# Where searches are sent, see search_gateway.backend
+app.config['ELASTIC_URL'] = 'http://localhost:9200'
+app.config['ELASTIC_INDEX'] = 'hepdata8'
+# Maximum size of the cached responses, in bytes
+app.config['QUERY_CACHE_BYTES'] = 128 * 1024 * 1024
+# How often to check whether the index has changed, in seconds
+app.config['GENERATION_CHECK_INTERVAL'] = 10
+# Largest number of hits that can be asked for in a search
+app.config['MAX_SEARCH_SIZE'] = 100
+# Streaming of search results, see search_gateway.streaming: publications
+# per page, most bytes sent in a response and tables per publication
+app.config['STREAM_PAGE_SIZE'] = 20
+app.config['STREAM_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['STREAM_MAX_TABLES'] = 1000
+# Longest request body accepted, in bytes
+app.config['MAX_QUERY_BYTES'] = 64 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, message):
+        Exception.__init__(self)
+        self.message = message
+        self.status_code = status_code
+
+
+def bad_request(reason):
+    app.logger.warning('Bad request from %s at %s %s: %s' %
+                       (request.remote_addr, request.method, request.path,
+                        reason))
+    raise HTTPError(400, reason)
+
+
+@app.errorhandler(HTTPError)
+def handle_http_error(error):
+    """
+    :type error: HTTPError
+    """
+    response = jsonify({
+        'message': error.message,
+        'status_code': error.status_code,
+    })
+    response.status_code = error.status_code
+    return response
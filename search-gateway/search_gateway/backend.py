@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from unittest import mock
+
+
+class BackendError(Exception):
+    def __init__(self, status_code, message):
+        Exception.__init__(self, status_code, message)
+        self.status_code = status_code
+        self.message = message
+
+
+class SearchBackend(object):
+    """Interface of the services searches are sent to."""
+
+    def search(self, body):
+        """Runs a search and returns the response, parsed."""
+        raise NotImplementedError
+
+    def generation(self):
+        """
+        Returns a value that changes whenever the results of searches may
+        change (e.g. when documents are indexed).
+        """
+        raise NotImplementedError
+
+
+class ElasticBackend(SearchBackend):
+    def __init__(self, url, index, doc_type='publication', timeout=60):
+        from elasticsearch import Elasticsearch
+        self.elastic = Elasticsearch([url], timeout=timeout)
+        self.index = index
+        self.doc_type = doc_type
+
+    @contextmanager
+    def _backend_errors(self):
+        """Turns errors of Elasticsearch into BackendError."""
+        # Also catches ConnectionError, a subclass
+        from elasticsearch import TransportError
+        try:
+            yield
+        except TransportError as err:
+            status_code = err.status_code \
+                if isinstance(err.status_code, int) else 502
+            raise BackendError(status_code, str(err.error))
+
+    def search(self, body):
+        with self._backend_errors():
+            return self.elastic.search(index=self.index,
+                                       doc_type=self.doc_type, body=body)
+
+    def generation(self):
+        # The names of the indices behind the alias (if it is one), their
+        # number of documents, their count of indexing and delete operations
+        # and their count of refreshes. Documents indexed only become
+        # searchable when the index is refreshed, and updates don't change
+        # the number of documents, so a search run in between would be
+        # cached with stale results otherwise.
+        with self._backend_errors():
+            stats = self.elastic.indices.stats(index=self.index,
+                                               metric='docs,indexing,refresh')
+        return ','.join(
+            '%s:%d:%d:%d:%d' % (name, primaries['docs']['count'],
+                                primaries['indexing']['index_total'],
+                                primaries['indexing']['delete_total'],
+                                primaries['refresh']['total'])
+            for name, primaries in sorted(
+                (name, index_stats['primaries'])
+                for name, index_stats in stats['indices'].items()))
+
+
+class FakeBackend(SearchBackend):
+    """
+    Backend for tests and development without Elasticsearch.
+
+    Responses are returned by respond(body), which by default finds nothing.
+    Every search is recorded in searches.
+    """
+
+    def __init__(self, respond=None, delay=0):
+        self.respond = respond or (lambda body: {
+            'hits': {'total': 0, 'max_score': None, 'hits': []},
+        })
+        self.delay = delay
+        self.current_generation = 1
+        self.searches = []
+        self._lock = threading.Lock()
+
+    def search(self, body):
+        with self._lock:
+            self.searches.append(body)
+        if self.delay:
+            time.sleep(self.delay)
+        return self.respond(body)
+
+    def generation(self):
+        return str(self.current_generation)
+
+    def reindex(self):
+        """Pretends the index has changed."""
+        self.current_generation += 1
+
+
+class TestElasticBackend(unittest.TestCase):
+    def stats(self, count, index_total, refresh_total):
+        return {'indices': {'hepdata8-v2': {'primaries': {
+            'docs': {'count': count},
+            'indexing': {'index_total': index_total, 'delete_total': 0},
+            'refresh': {'total': refresh_total},
+        }}}}
+
+    def test_generation(self):
+        backend = ElasticBackend('http://localhost:9200', 'hepdata8')
+        backend.elastic = mock.Mock()
+        backend.elastic.indices.stats.return_value = self.stats(10, 12, 3)
+        generation = backend.generation()
+        self.assertEqual(generation, 'hepdata8-v2:10:12:0:3')
+
+        # An update becomes searchable when the index is refreshed
+        backend.elastic.indices.stats.return_value = self.stats(10, 13, 3)
+        indexed = backend.generation()
+        backend.elastic.indices.stats.return_value = self.stats(10, 13, 4)
+        self.assertEqual(len({generation, indexed, backend.generation()}), 3)
+
+    def test_errors(self):
+        from elasticsearch import ConnectionError, TransportError
+        backend = ElasticBackend('http://localhost:9200', 'hepdata8')
+        backend.elastic = mock.Mock()
+        backend.elastic.indices.stats.side_effect = ConnectionError(
+            'N/A', 'Connection refused', None)
+        with self.assertRaises(BackendError) as context:
+            backend.generation()
+        self.assertEqual(context.exception.status_code, 502)
+
+        backend.elastic.search.side_effect = TransportError(
+            400, 'search_phase_execution_exception')
+        with self.assertRaises(BackendError) as context:
+            backend.search({})
+        self.assertEqual(context.exception.status_code, 400)
@@ -0,0 +1,204 @@
+"""
+Caching of search responses.
+
+Searches are identified by their body serialized canonically (sorted keys,
+no whitespace), so the same filter built by different browsers hits the same
+cache entry. Cached responses are kept while the generation of the backend
+(see SearchBackend.generation()) stays the same, which is checked every
+generation_check_interval seconds. Identical searches arriving while one of
+them is being run wait for its response instead of being sent again.
+"""
+import json
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+from search_gateway.backend import FakeBackend
+
+
+def canonical_query(body):
+    """Serializes a search body so that equal bodies give equal strings."""
+    return json.dumps(body, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False)
+
+
+class QueryCache(object):
+    """
+    LRU cache of serialized responses, bounded by their total size. Every
+    entry belongs to the current generation: changing it empties the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.generation = None
+        self.size = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, bytes]
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, response, generation):
+        """Caches a response, unless it was computed for an old generation."""
+        if len(response) > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            old_response = self._entries.pop(key, None)
+            if old_response is not None:
+                self.size -= len(old_response)
+            self._entries[key] = response
+            self.size += len(response)
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def set_generation(self, generation):
+        with self._lock:
+            if generation != self.generation:
+                self.generation = generation
+                self._entries.clear()
+                self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InFlightSearch(object):
+    def __init__(self):
+        self.response = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SearchGateway(object):
+    def __init__(self, backend, cache, generation_check_interval=10):
+        """
+        :type backend: search_gateway.backend.SearchBackend
+        :type cache: QueryCache
+        """
+        self.backend = backend
+        self.cache = cache
+        self.generation_check_interval = generation_check_interval
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._generation_checked = None
+        self._in_flight = {}  # type: dict[tuple, InFlightSearch]
+        self._lock = threading.Lock()
+
+    def _generation(self):
+        now = time.monotonic()
+        with self._lock:
+            check = self._generation_checked is None or \
+                now - self._generation_checked >= \
+                self.generation_check_interval
+            if check:
+                # Other requests keep using the known generation meanwhile
+                self._generation_checked = now
+        if check:
+            self.cache.set_generation(self.backend.generation())
+        return self.cache.generation
+
+    def search(self, body):
+        """Returns the response to a search, serialized as JSON (bytes)."""
+        return self.cached(canonical_query(body), lambda: json.dumps(
+            self.backend.search(body), separators=(',', ':')).encode('UTF-8'))
+
+    def cached(self, key, compute):
+        """
+        Returns the cached response for key, calling compute() to get it
+        if it's not cached and no other request is computing it already.
+        compute() must return bytes derived only from the backend.
+        """
+        generation = self._generation()
+        response = self.cache.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+
+        in_flight_key = (generation, key)
+        with self._lock:
+            in_flight = self._in_flight.get(in_flight_key)
+            is_leader = in_flight is None
+            if is_leader:
+                in_flight = self._in_flight[in_flight_key] = InFlightSearch()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.response
+
+        try:
+            response = compute()
+            self.cache.put(key, response, generation)
+            in_flight.response = response
+            return response
+        except Exception as error:
+            in_flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[in_flight_key]
+            in_flight.done.set()
+
+
+class TestSearchGateway(unittest.TestCase):
+    def make_gateway(self, delay=0, max_bytes=1024 * 1024):
+        self.backend = FakeBackend(
+            respond=lambda body: {'hits': {'total': body['size']}},
+            delay=delay)
+        return SearchGateway(self.backend, QueryCache(max_bytes),
+                             generation_check_interval=0)
+
+    def test_canonical_query(self):
+        self.assertEqual(canonical_query({'b': 1, 'a': {'d': [1], 'c': 2}}),
+                         canonical_query({'a': {'c': 2, 'd': [1]}, 'b': 1}))
+
+    def test_cache(self):
+        gateway = self.make_gateway()
+        self.assertEqual(gateway.search({'size': 1, 'query': {}}),
+                         b'{"hits":{"total":1}}')
+        self.assertEqual(gateway.search({'query': {}, 'size': 1}),
+                         b'{"hits":{"total":1}}')
+        gateway.search({'size': 2})
+        self.assertEqual(len(self.backend.searches), 2)
+        self.assertEqual((gateway.hits, gateway.misses), (1, 2))
+
+    def test_generation(self):
+        gateway = self.make_gateway()
+        gateway.search({'size': 1})
+        self.backend.reindex()
+        gateway.search({'size': 1})
+        self.assertEqual(len(self.backend.searches), 2)
+
+    def test_eviction(self):
+        gateway = self.make_gateway(max_bytes=50)
+        for size in (1, 2, 3, 1):
+            gateway.search({'size': size})
+        self.assertEqual(len(self.backend.searches), 4)
+        self.assertLessEqual(gateway.cache.size, 50)
+
+    def test_coalescing(self):
+        gateway = self.make_gateway(delay=0.1)
+        responses = []
+        threads = [threading.Thread(
+            target=lambda: responses.append(gateway.search({'size': 5})))
+            for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.backend.searches), 1)
+        self.assertEqual(responses, [b'{"hits":{"total":5}}'] * 5)
+        self.assertEqual(gateway.coalesced, 4)
@@ -0,0 +1,230 @@
+"""
+Packed plot data: the points of a pair of variables of the tables matching a
+filter, as float32 columns that browsers can use as typed arrays without
+decoding them.
+
+    PlotData {
+        uint32 header_length;
+        byte[header_length] header;   // JSON, padded with spaces so that the
+                                      // columns start at a multiple of 4
+        float32[num_points] x_low;
+        float32[num_points] x_high;
+        float32[num_points] y;
+        float32[num_points] y_low;    // y minus its error
+        float32[num_points] y_high;   // y plus its error
+    }
+
+All numbers are little endian. The header lists the tables the points come
+from, each one with the range [start, end) of its points in the columns.
+
+Values and errors are computed like Elastic.addRangeProperties() does in the
+frontend. Points without an x or y value are left out.
+"""
+import json
+import math
+import struct
+import sys
+import unittest
+from array import array
+
+plot_columns = ('x_low', 'x_high', 'y', 'y_low', 'y_high')
+
+
+def normalize_error(error):
+    """Returns (error_down, error_up) of an error, both positive."""
+    if error['type'] == 'symerror':
+        value = abs(error['value'])
+        return value, value
+    else:
+        # minus and plus are sometimes swapped
+        return (-min(error['plus'], error['minus'], 0.0),
+                max(error['plus'], error['minus'], 0.0))
+
+
+def column_errors(column):
+    """Returns (error_down, error_up) of a data point column with a value."""
+    if 'low' in column:
+        # low and high are sometimes swapped too
+        low = min(column['low'], column['high'])
+        high = max(column['low'], column['high'])
+        return column_value(column) - low, high - column_value(column)
+
+    errors = column.get('errors') or []
+    if len(errors) == 0:
+        return 0.0, 0.0
+    elif len(errors) == 1:
+        return normalize_error(errors[0])
+    else:
+        # Several errors are added in quadrature
+        normalized = [normalize_error(error) for error in errors]
+        return (math.sqrt(sum(down * down for down, up in normalized)),
+                math.sqrt(sum(up * up for down, up in normalized)))
+
+
+def column_value(column):
+    if 'low' in column:
+        return (column['low'] + column['high']) / 2
+    return column.get('value')
+
+
+def find_column(table, variable_name):
+    """Returns the index of a variable in the data points of a table."""
+    names = [variable['name'] for variable in table['indep_vars']] + \
+        [variable['name'] for variable in table['dep_vars']]
+    try:
+        return names.index(variable_name)
+    except ValueError:
+        return None
+
+
+class PlotDataBuilder(object):
+    def __init__(self, x_var, y_var):
+        self.x_var = x_var
+        self.y_var = y_var
+        self.columns = {name: array('f') for name in plot_columns}
+        self.tables = []
+        # Whether inner_hits left out matching tables of some publication
+        self.tables_left_out = False
+
+    def add_table(self, publication, table):
+        col_x = find_column(table, self.x_var)
+        col_y = find_column(table, self.y_var)
+        if col_x is None or col_y is None:
+            return
+
+        start = len(self.columns['y'])
+        x_low = self.columns['x_low']
+        x_high = self.columns['x_high']
+        y_values = self.columns['y']
+        y_low = self.columns['y_low']
+        y_high = self.columns['y_high']
+        for data_point in table['data_points']:
+            x_column = data_point[col_x]
+            y_column = data_point[col_y]
+            x = column_value(x_column)
+            y = column_value(y_column)
+            if x is None or y is None:
+                continue
+            if 'low' in x_column:
+                x_low.append(min(x_column['low'], x_column['high']))
+                x_high.append(max(x_column['low'], x_column['high']))
+            else:
+                x_low.append(x)
+                x_high.append(x)
+            error_down, error_up = column_errors(y_column)
+            y_values.append(y)
+            y_low.append(y - error_down)
+            y_high.append(y + error_up)
+
+        if len(y_values) > start:
+            self.tables.append({
+                'inspire_record': publication.get('inspire_record'),
+                'table_num': table.get('table_num'),
+                'start': start,
+                'end': len(y_values),
+            })
+
+    def add_search_response(self, response):
+        """Adds the tables of a nested search with inner_hits."""
+        for hit in response['hits']['hits']:
+            table_hits = hit['inner_hits']['tables']['hits']
+            if table_hits['total'] > len(table_hits['hits']):
+                self.tables_left_out = True
+            for table_hit in table_hits['hits']:
+                self.add_table(hit['_source'], table_hit['_source'])
+
+    def pack(self, extra_header=None):
+        header = dict(extra_header or {})
+        header.update({
+            'x_var': self.x_var,
+            'y_var': self.y_var,
+            'num_points': len(self.columns['y']),
+            'columns': list(plot_columns),
+            'tables': self.tables,
+        })
+        header_bytes = json.dumps(header, separators=(',', ':')).encode(
+            'UTF-8')
+        header_bytes += b' ' * (-(4 + len(header_bytes)) % 4)
+
+        parts = [struct.pack('<L', len(header_bytes)), header_bytes]
+        for name in plot_columns:
+            column = self.columns[name]
+            if sys.byteorder != 'little':
+                column = array('f', column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        return b''.join(parts)
+
+
+def unpack_plot_data(data):
+    """Returns the header and columns (dict of arrays) of packed plot data."""
+    header_length, = struct.unpack_from('<L', data, 0)
+    header = json.loads(data[4:4 + header_length].decode('UTF-8'))
+    columns = {}
+    offset = 4 + header_length
+    for name in header['columns']:
+        column = array('f')
+        column.frombytes(data[offset:offset + 4 * header['num_points']])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        columns[name] = column
+        offset += 4 * header['num_points']
+    return header, columns
+
+
+class TestPlotData(unittest.TestCase):
+    def test_pack(self):
+        table = {
+            'table_num': 3,
+            'indep_vars': [{'name': 'PT'}],
+            'dep_vars': [{'name': 'A'}, {'name': 'SIG'}],
+            'data_points': [
+                [{'low': 2, 'high': 1}, {'value': 7},
+                 {'value': 10, 'errors': [
+                     {'type': 'symerror', 'value': -3},
+                     {'type': 'asymerror', 'minus': -4, 'plus': 4}]}],
+                [{'value': 5}, {'value': 7}, {'value': None}],
+                [{'value': 6}, {'value': 7},
+                 {'value': 1, 'errors': [
+                     {'type': 'asymerror', 'minus': 0.5, 'plus': -0.25}]}],
+            ],
+        }
+        builder = PlotDataBuilder('PT', 'SIG')
+        builder.add_table({'inspire_record': 42}, table)
+        builder.add_table({'inspire_record': 43},
+                          dict(table, dep_vars=[{'name': 'A'}]))
+        data = builder.pack({'incomplete': False})
+        header_length, = struct.unpack_from('<L', data, 0)
+        self.assertEqual((4 + header_length) % 4, 0)
+
+        header, columns = unpack_plot_data(data)
+        self.assertEqual(header['num_points'], 2)
+        self.assertEqual(header['tables'], [{
+            'inspire_record': 42, 'table_num': 3, 'start': 0, 'end': 2}])
+        self.assertFalse(header['incomplete'])
+        self.assertEqual(list(columns['x_low']), [1, 6])
+        self.assertEqual(list(columns['x_high']), [2, 6])
+        self.assertEqual(list(columns['y']), [10, 1])
+        self.assertEqual(list(columns['y_low']), [5, 0.75])
+        self.assertEqual(list(columns['y_high']), [15, 1.5])
+
+    def test_search_response(self):
+        table = {'indep_vars': [{'name': 'PT'}], 'dep_vars': [{'name': 'SIG'}],
+                 'data_points': [[{'value': 1}, {'value': 2}]]}
+
+        def response(num_tables, total):
+            return {'hits': {'total': 1, 'hits': [{
+                '_source': {'inspire_record': 42},
+                'inner_hits': {'tables': {'hits': {
+                    'total': total,
+                    'hits': [{'_source': dict(table, table_num=table_num)}
+                             for table_num in range(num_tables)]}}},
+            }]}}
+
+        builder = PlotDataBuilder('PT', 'SIG')
+        builder.add_search_response(response(2, 2))
+        self.assertEqual(len(builder.tables), 2)
+        self.assertFalse(builder.tables_left_out)
+        builder.add_search_response(response(3, 5))
+        self.assertEqual(len(builder.tables), 5)
+        self.assertTrue(builder.tables_left_out)
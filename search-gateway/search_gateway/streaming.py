@@ -0,0 +1,142 @@
+"""
+Streaming of every table matching a filter, page by page.
+
+Publications are fetched sorted by inspire_record (their unique id), each
+page asking for the publications after the last one of the previous page.
+This is what search_after does in newer versions of ElasticSearch, and unlike
+from/size it costs the same for every page and has no limit on the number of
+results.
+
+The response is newline delimited JSON: a line for every publication with
+matching tables, then a final line like
+{"done": true, "total_publications": 123, "complete": true}. complete is
+false when some matching tables were left out: the stream was cut short
+because it reached max_bytes, or a publication had more than max_tables
+matching tables.
+"""
+import json
+import unittest
+
+from search_gateway.backend import FakeBackend
+from search_gateway.gateway import SearchGateway, QueryCache
+
+
+def page_search(query, page_size, max_tables, after=None):
+    nested_query = {
+        'nested': {
+            'path': 'tables',
+            'query': query,
+            'inner_hits': {'size': max_tables},
+        },
+    }
+    if after is not None:
+        nested_query = {
+            'bool': {
+                'must': nested_query,
+                'filter': {'range': {'inspire_record': {'gt': after}}},
+            },
+        }
+    return {
+        'size': page_size,
+        'query': nested_query,
+        'sort': [{'inspire_record': 'asc'}],
+        '_source': {'exclude': ['tables']},
+    }
+
+
+def dump_line(value):
+    return json.dumps(value, separators=(',', ':')).encode('UTF-8') + b'\n'
+
+
+def stream_tables(gateway, query, page_size, max_bytes, max_tables):
+    """
+    Yields the lines of the response (bytes) as pages are fetched.
+
+    :type gateway: search_gateway.gateway.SearchGateway
+    """
+    sent_bytes = 0
+    total = None
+    after = None
+    # Whether inner_hits left out tables of some publication
+    tables_left_out = False
+    while True:
+        response = json.loads(gateway.search(
+            page_search(query, page_size, max_tables, after)).decode('UTF-8'))
+        hits = response['hits']['hits']
+        if total is None:
+            # Later pages only count the publications after them
+            total = response['hits']['total']
+
+        for hit in hits:
+            table_hits = hit['inner_hits']['tables']['hits']
+            if table_hits['total'] > len(table_hits['hits']):
+                tables_left_out = True
+            line = dump_line({
+                'publication': hit['_source'],
+                'tables': [table_hit['_source']
+                           for table_hit in table_hits['hits']],
+            })
+            if sent_bytes + len(line) > max_bytes:
+                yield dump_line({'done': True, 'total_publications': total,
+                                 'complete': False})
+                return
+            yield line
+            sent_bytes += len(line)
+
+        if len(hits) < page_size:
+            break
+        after = hits[-1]['_source']['inspire_record']
+
+    yield dump_line({'done': True, 'total_publications': total,
+                     'complete': not tables_left_out})
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        publications = [{'inspire_record': record} for record in range(1, 8)]
+
+        def respond(body):
+            after = body['query'].get('bool', {}).get('filter', {}) \
+                .get('range', {}).get('inspire_record', {}).get('gt', 0)
+            matching = [publication for publication in publications
+                        if publication['inspire_record'] > after]
+            query = body['query']
+            nested = query['bool']['must'] if 'bool' in query else query
+            max_tables = nested['nested']['inner_hits']['size']
+            return {'hits': {'total': len(matching), 'hits': [{
+                '_source': publication,
+                'inner_hits': {'tables': {'hits': {
+                    'total': self.num_tables,
+                    'hits': [{'_source': {'table_num': table_num}}
+                             for table_num in range(1, min(
+                                 self.num_tables, max_tables) + 1)]}}},
+            } for publication in matching[:body['size']]]}}
+
+        self.num_tables = 1
+        self.backend = FakeBackend(respond=respond)
+        self.gateway = SearchGateway(self.backend, QueryCache(1024 * 1024))
+
+    def read(self, max_bytes=1024 * 1024, max_tables=100):
+        return [json.loads(line.decode('UTF-8')) for line in stream_tables(
+            self.gateway, {'match_all': {}}, 3, max_bytes, max_tables)]
+
+    def test_pages(self):
+        lines = self.read()
+        self.assertEqual([line['publication']['inspire_record']
+                          for line in lines[:-1]], list(range(1, 8)))
+        self.assertEqual(lines[-1], {'done': True, 'total_publications': 7,
+                                     'complete': True})
+        self.assertEqual(len(self.backend.searches), 3)
+
+    def test_max_bytes(self):
+        lines = self.read(max_bytes=150)
+        self.assertEqual(len(lines), 3)
+        self.assertFalse(lines[-1]['complete'])
+
+    def test_max_tables(self):
+        self.num_tables = 3
+        self.assertTrue(self.read(max_tables=3)[-1]['complete'])
+        lines = self.read(max_tables=2)
+        self.assertEqual(len(lines[0]['tables']), 2)
+        self.assertEqual(len(lines), 8)
+        self.assertFalse(lines[-1]['complete'])
@@ -0,0 +1,251 @@
+import json
+import unittest
+from unittest import mock
+
+from flask import request, Response, jsonify
+
+from search_gateway.app import app, bad_request, HTTPError
+from search_gateway.backend import BackendError, ElasticBackend, \
+    FakeBackend
+from search_gateway.gateway import QueryCache, SearchGateway, \
+    canonical_query
+from search_gateway.plot_data import PlotDataBuilder, unpack_plot_data
+from search_gateway.streaming import stream_tables
+
+# Only what the frontend sends (see Elastic.ts) is accepted
+allowed_search_keys = {'query', 'size', 'from', '_source', 'aggs'}
+
+
+def create_backend():
+    if app.config.get('SEARCH_BACKEND') is not None:
+        return app.config['SEARCH_BACKEND']
+    return ElasticBackend(app.config['ELASTIC_URL'],
+                          app.config['ELASTIC_INDEX'])
+
+
+gateway = SearchGateway(create_backend(),
+                        QueryCache(app.config['QUERY_CACHE_BYTES']),
+                        app.config['GENERATION_CHECK_INTERVAL'])
+
+
+def contains_script(value):
+    if isinstance(value, dict):
+        return any(key == 'script' or key.endswith('_script') or
+                   contains_script(item) for key, item in value.items())
+    elif isinstance(value, list):
+        return any(contains_script(item) for item in value)
+    return False
+
+
+def validate_search(body):
+    if not isinstance(body, dict):
+        bad_request('The search must be a JSON object.')
+    unknown_keys = set(body.keys()) - allowed_search_keys
+    if unknown_keys:
+        bad_request('Unsupported search parameters: %s' %
+                    ', '.join(sorted(unknown_keys)))
+    size = body.get('size', 10)
+    if not isinstance(size, int) or not 0 <= size <= \
+            app.config['MAX_SEARCH_SIZE']:
+        bad_request('Invalid size.')
+    if contains_script(body):
+        bad_request('Scripts are not allowed.')
+
+
+@app.route('/')
+def hello():
+    return 'HEPData Explore search gateway'
+
+
+@app.route('/<index>/publication/_search', methods=['POST'])
+def search(index):
+    if index != app.config['ELASTIC_INDEX']:
+        raise HTTPError(404, 'Unknown index.')
+    if request.content_length is None or \
+            request.content_length > app.config['MAX_QUERY_BYTES']:
+        bad_request('Request too long.')
+    try:
+        body = json.loads(request.get_data(as_text=True))
+    except ValueError:
+        bad_request('Invalid JSON.')
+    validate_search(body)
+
+    try:
+        response = gateway.search(body)
+    except BackendError as err:
+        app.logger.warning('Search failed with status %s: %s' %
+                           (err.status_code, err.message))
+        raise HTTPError(400 if err.status_code == 400 else 502,
+                        'Search failed.')
+    return Response(response, mimetype='application/json')
+
+
+@app.route('/<index>/plot-data', methods=['POST'])
+def plot_data(index):
+    """
+    Returns the points of a pair of variables of the tables matching a
+    filter, packed as described in search_gateway.plot_data. The request is
+    a JSON object like {"query": <filter>, "x": "PT", "y": "SIG"}, where
+    filter is an ElasticSearch query on tables, like the ones of the
+    frontend.
+    """
+    if index != app.config['ELASTIC_INDEX']:
+        raise HTTPError(404, 'Unknown index.')
+    if request.content_length is None or \
+            request.content_length > app.config['MAX_QUERY_BYTES']:
+        bad_request('Request too long.')
+    try:
+        body = json.loads(request.get_data(as_text=True))
+        query, x_var, y_var = body['query'], body['x'], body['y']
+    except (ValueError, TypeError, KeyError):
+        bad_request('Invalid JSON.')
+    if not isinstance(x_var, str) or not isinstance(y_var, str):
+        bad_request('Invalid variables.')
+
+    # Same search as Elastic.fetchFilteredData() in the frontend. inner_hits
+    # only returns the first 3 tables of every publication by default.
+    search_body = {
+        'size': app.config['MAX_SEARCH_SIZE'],
+        'query': {
+            'nested': {
+                'path': 'tables',
+                'query': query,
+                'inner_hits': {'size': app.config['STREAM_MAX_TABLES']},
+            },
+        },
+        '_source': {
+            'exclude': ['tables'],
+        },
+    }
+    validate_search(search_body)
+
+    def pack():
+        response = json.loads(gateway.search(search_body).decode('UTF-8'))
+        builder = PlotDataBuilder(x_var, y_var)
+        builder.add_search_response(response)
+        return builder.pack({
+            'total_publications': response['hits']['total'],
+            'incomplete': builder.tables_left_out or
+            response['hits']['total'] != len(response['hits']['hits']),
+        })
+
+    try:
+        response = gateway.cached(
+            'plot-data:' + canonical_query([search_body, x_var, y_var]),
+            pack)
+    except BackendError as err:
+        app.logger.warning('Search failed with status %s: %s' %
+                           (err.status_code, err.message))
+        raise HTTPError(400 if err.status_code == 400 else 502,
+                        'Search failed.')
+    return Response(response, mimetype='application/octet-stream')
+
+
+@app.route('/<index>/stream', methods=['POST'])
+def stream(index):
+    """
+    Streams every publication with tables matching a filter, as described in
+    search_gateway.streaming. The request is a JSON object like
+    {"query": <filter>}, optionally with "max_bytes" to get less data.
+    """
+    if index != app.config['ELASTIC_INDEX']:
+        raise HTTPError(404, 'Unknown index.')
+    if request.content_length is None or \
+            request.content_length > app.config['MAX_QUERY_BYTES']:
+        bad_request('Request too long.')
+    try:
+        body = json.loads(request.get_data(as_text=True))
+        query = body['query']
+        max_bytes = body.get('max_bytes', app.config['STREAM_MAX_BYTES'])
+    except (ValueError, TypeError, KeyError, AttributeError):
+        bad_request('Invalid JSON.')
+    if not isinstance(query, dict) or contains_script(query):
+        bad_request('Invalid query.')
+    if not isinstance(max_bytes, int) or max_bytes <= 0:
+        bad_request('Invalid max_bytes.')
+
+    lines = stream_tables(gateway, query, app.config['STREAM_PAGE_SIZE'],
+                          min(max_bytes, app.config['STREAM_MAX_BYTES']),
+                          app.config['STREAM_MAX_TABLES'])
+    try:
+        # Fail with a proper status if the first page can't be fetched
+        first_line = next(lines)
+    except BackendError as err:
+        app.logger.warning('Search failed with status %s: %s' %
+                           (err.status_code, err.message))
+        raise HTTPError(400 if err.status_code == 400 else 502,
+                        'Search failed.')
+
+    def generate():
+        yield first_line
+        try:
+            for line in lines:
+                yield line
+        except BackendError as err:
+            # Too late to change the status: clients see no final line
+            app.logger.warning('Search failed while streaming, status %s: '
+                               '%s' % (err.status_code, err.message))
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    # Otherwise nginx holds back lines until its buffers fill up
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/stats')
+def stats():
+    return jsonify({
+        'hits': gateway.hits,
+        'misses': gateway.misses,
+        'coalesced': gateway.coalesced,
+        'cached_responses': len(gateway.cache),
+        'cache_bytes': gateway.cache.size,
+        'generation': gateway.cache.generation,
+    })
+
+
+class TestPlotDataView(unittest.TestCase):
+    def setUp(self):
+        table = {'indep_vars': [{'name': 'PT'}],
+                 'dep_vars': [{'name': 'SIG'}],
+                 'data_points': [[{'value': 1}, {'value': 2}]]}
+
+        def respond(body):
+            # Like ElasticSearch, which returns 3 tables unless told otherwise
+            size = body['query']['nested']['inner_hits'].get('size', 3)
+            return {'hits': {'total': 1, 'hits': [{
+                '_source': {'inspire_record': 42},
+                'inner_hits': {'tables': {'hits': {
+                    'total': self.num_tables,
+                    'hits': [{'_source': dict(table, table_num=table_num)}
+                             for table_num in range(min(self.num_tables,
+                                                        size))]}}},
+            }]}}
+
+        self.num_tables = 5
+        patcher = mock.patch(__name__ + '.gateway', SearchGateway(
+            FakeBackend(respond=respond), QueryCache(1024 * 1024),
+            generation_check_interval=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+
+    def plot_data(self):
+        response = self.client.post(
+            '/%s/plot-data' % app.config['ELASTIC_INDEX'],
+            data=json.dumps({'query': {'match_all': {}}, 'x': 'PT',
+                             'y': 'SIG'}))
+        self.assertEqual(response.status_code, 200)
+        return unpack_plot_data(response.data)[0]
+
+    def test_tables(self):
+        header = self.plot_data()
+        self.assertEqual(len(header['tables']), 5)
+        self.assertFalse(header['incomplete'])
+
+        gateway.backend.reindex()
+        self.num_tables = app.config['STREAM_MAX_TABLES'] + 1
+        header = self.plot_data()
+        self.assertEqual(len(header['tables']),
+                         app.config['STREAM_MAX_TABLES'])
+        self.assertTrue(header['incomplete'])
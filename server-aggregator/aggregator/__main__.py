@@ -1,11 +1,12 @@
 from __future__ import print_function
 
 import os
+import signal
 import sys
+import time
 
 import argh
 from contextualized import contextualized_tracebacks
-from elasticsearch.exceptions import TransportError
 
 from aggregator import shared_dcontext
 from progressbar import ProgressBar, Percentage, Bar, Widget
@@ -30,50 +31,274 @@ class AlwaysUpdatingProgressBar(ProgressBar):
         return True
 
 
-def _add(index, submission_paths, only_these=None):
+def _add_submission(record_aggregator, submission_path, with_suggestions):
+    """Adds a submission, returning the details for its checkpoint entry."""
+    from aggregator.suggestions import SuggestionCounter
+    shared_dcontext.dcontext.submission = \
+        os.path.basename(submission_path.rstrip('/'))
+
+    record_aggregator.suggestions = SuggestionCounter()
+    tables_before = record_aggregator.count_tables_total
+    rejected_before = record_aggregator.count_tables_rejected
+    rejections_before = len(record_aggregator.rejections)
+    start = time.monotonic()
+    record_aggregator.process_submission(submission_path)
+
+    details = dict(
+        tables=record_aggregator.count_tables_total - tables_before,
+        rejected_tables=record_aggregator.count_tables_rejected -
+        rejected_before,
+        seconds=round(time.monotonic() - start, 3))
+    if len(record_aggregator.rejections) > rejections_before:
+        details['rejections'] = \
+            record_aggregator.rejections[rejections_before:]
+    if with_suggestions:
+        details['suggestions'] = record_aggregator.suggestions.dump()
+    return details
+
+
+# RecordAggregator of a worker process of a parallel add
+_worker = {}
+
+
+def _init_add_worker(index, with_suggestions, memory_limit_mb):
+    if memory_limit_mb:
+        # Submissions that need more memory fail with MemoryError
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS,
+                           (memory_limit_mb * 1024 * 1024, hard))
+    # Ctrl+C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from aggregator.record_aggregator import RecordAggregator
+    _worker['record_aggregator'] = RecordAggregator(index)
+    _worker['with_suggestions'] = with_suggestions
+
+
+def _add_in_worker(submission_path):
+    try:
+        return 'done', _add_submission(_worker['record_aggregator'],
+                                       submission_path,
+                                       _worker['with_suggestions'])
+    except Exception as err:
+        return 'failed', '%s: %s' % (type(err).__name__, err)
+
+
+def _add(index, submission_paths, only_these=None, suggestions_dir=None,
+         resume=False, checkpoint=None, failed_file=None, shard=None,
+         shard_by='hash', stats_file=None, data_root=None, workers=1,
+         worker_memory_mb=0, max_consecutive_failures=20):
+    from aggregator.checkpoint import Checkpoint
     from aggregator.record_aggregator import RecordAggregator
+    from aggregator.run_statistics import statistics_from_checkpoint, \
+        write_statistics, format_statistics
+    from aggregator.scheduling import discover_submissions, estimate_cost, \
+        schedule, cost_report
+    from aggregator.sharding import select_shard, shard_suffix, \
+        submission_name
+
+    submission_paths = list(submission_paths)
+    if data_root is not None:
+        submission_paths += discover_submissions(data_root)
+    if only_these is not None:
+        submission_paths = [
+            path for path in submission_paths
+            if int(submission_name(path).replace('ins', '')) in only_these]
+
+    # Validate the arguments before connecting to ElasticSearch
+    submission_paths = select_shard(
+        submission_paths, shard, shard_by,
+        size_function=lambda path: estimate_cost(path).cost)
+    # Every shard has its own files, they may share a directory
+    prefix = index + shard_suffix(shard)
+    checkpoint = Checkpoint(checkpoint or '%s-checkpoint.jsonl' % prefix,
+                            resume=resume)
+    failed_file = failed_file or '%s-failed.txt' % prefix
+    stats_file = stats_file or '%s-stats.json' % prefix
+    if shard is not None:
+        print('Shard %s: %d submissions.' % (shard, len(submission_paths)),
+              file=sys.stderr)
+    # Also creates the index, before any worker tries to
     record_aggregator = RecordAggregator(index)
 
+    # Suggestions are counted per submission so that the counts of the
+    # submissions done before resuming are kept in the checkpoint, and added
+    # up by statistics_from_checkpoint()
+    pending = []
+    for path in submission_paths:
+        done = checkpoint.outcomes.get(submission_name(path))
+        if done is None or done['outcome'] != 'done':
+            pending.append(path)
+    if len(pending) < len(submission_paths):
+        print('Skipping %d submissions already added.' %
+              (len(submission_paths) - len(pending)), file=sys.stderr)
+
+    costs = [estimate_cost(path) for path in pending]
+    predicted_costs = {cost.path: cost.cost for cost in costs}
+    if workers > 1:
+        # Biggest first, so that no worker is left with a big one at the end
+        pending = [cost.path for cost in schedule(costs)]
+
+    added = []
+    consecutive_failures = 0
+    start = time.monotonic()
+
     submission_label = Label(min_length=10)
-    pbar = AlwaysUpdatingProgressBar(maxval=len(submission_paths),
+    pbar = AlwaysUpdatingProgressBar(maxval=len(pending),
                                      widgets=[
                                          Percentage(),
                                          submission_label,
                                          Bar(marker='#', left='[', right=']')
                                      ]).start()
 
-    for i, submission_path in enumerate(submission_paths):
-        shared_dcontext.dcontext.submission = os.path.basename(submission_path)
-        submission_label.change_text(shared_dcontext.dcontext.submission)
-        pbar.update(i)
+    def finish_submission(submission_path, outcome, result):
+        nonlocal consecutive_failures
+        submission = submission_name(submission_path)
+        submission_label.change_text(submission)
+        pbar.update(len(added) + 1)
+        added.append(submission)
+
+        if outcome == 'failed':
+            consecutive_failures += 1
+            print('Error: Could not add %s: %s' % (submission, result),
+                  file=sys.stderr)
+            checkpoint.record(submission, submission_path, 'failed',
+                              error=result)
+            if consecutive_failures >= max_consecutive_failures:
+                # Something is wrong with every submission (e.g.
+                # ElasticSearch is down), don't go through all of them
+                raise RuntimeError(
+                    '%d submissions failed in a row, stopping. Run again '
+                    'with --resume to continue.' % consecutive_failures)
+            return
 
-        if only_these is not None:
-            inspire_id = int(
-                shared_dcontext.dcontext.submission.replace('ins', ''))
-            if inspire_id not in only_these:
-                continue
+        consecutive_failures = 0
+        checkpoint.record(submission, submission_path, 'done',
+                          predicted_cost=predicted_costs[submission_path],
+                          **result)
 
-        try:
-            record_aggregator.process_submission(submission_path)
-        except TransportError as err:
-            print(err)
-            print(dir(err))
-            raise err
+    try:
+        if workers > 1:
+            _add_parallel(pending, finish_submission, index,
+                          suggestions_dir is not None, workers,
+                          worker_memory_mb)
+        else:
+            for submission_path in pending:
+                try:
+                    details = _add_submission(record_aggregator,
+                                              submission_path,
+                                              suggestions_dir is not None)
+                except Exception as err:
+                    finish_submission(submission_path, 'failed', '%s: %s' %
+                                      (type(err).__name__, err))
+                else:
+                    finish_submission(submission_path, 'done', details)
+    finally:
+        checkpoint.close()
 
     pbar.finish()
     print('Done', file=sys.stderr)
-    record_aggregator.report_statistics()
+    for line in cost_report([checkpoint.outcomes[submission]
+                             for submission in added],
+                            time.monotonic() - start, workers):
+        print(line, file=sys.stderr)
+    # Counting the submissions added before resuming too
+    stats = statistics_from_checkpoint(checkpoint, index, shard)
+    write_statistics(stats, stats_file)
+    print(format_statistics(stats['submissions'], stats['tables'],
+                            stats['rejected_tables']))
+
+    if suggestions_dir is not None and shard is not None:
+        # Every shard would overwrite the suggestions of the others
+        print('The suggestions of this shard are kept in %s, write them '
+              'with merge-stats --suggestions-dir.' % stats_file,
+              file=sys.stderr)
+    elif suggestions_dir is not None:
+        _write_suggestions(stats, suggestions_dir)
+
+    failed = checkpoint.failed()
+    if not failed and os.path.exists(failed_file):
+        # Left by a previous run, its submissions have been added since
+        os.remove(failed_file)
+    if failed:
+        with open(failed_file, 'w') as f:
+            f.write(''.join(entry['path'] + '\n' for entry in failed))
+        print('%d submissions failed, they are listed in %s. Run again with '
+              '--resume to retry them.' % (len(failed), failed_file),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+def _add_parallel(submission_paths, finish_submission, index,
+                  with_suggestions, workers, worker_memory_mb):
+    """
+    Adds submissions from worker processes, in the order given, calling
+    finish_submission(path, outcome, details or error) as they are done.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
 
+    # Workers inherit shared_dcontext
+    executor = ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('fork'),
+        initializer=_init_add_worker,
+        initargs=(index, with_suggestions, worker_memory_mb))
+    futures = {}
+    try:
+        for submission_path in submission_paths:
+            futures[executor.submit(_add_in_worker, submission_path)] = \
+                submission_path
+        for future in as_completed(futures):
+            outcome, result = future.result()
+            finish_submission(futures[future], outcome, result)
+    except BrokenProcessPool:
+        raise RuntimeError('A worker died while adding submissions (out of '
+                           'memory?). Run again with --resume to continue.')
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
 
-def add(*submission_paths):
-    _add('hepdata8', submission_paths)
 
+def add(*submission_paths, suggestions_dir=None, resume=False,
+        checkpoint=None, failed_file=None, shard=None, shard_by='hash',
+        stats_file=None, data_root=None, workers=1, worker_memory_mb=0):
+    # Submissions are given as paths, and/or found under --data-root.
+    #
+    # With suggestions_dir, autocomplete suggestions for the frontend are
+    # written there at the end, see aggregator.suggestions.
+    #
+    # Progress is kept in --checkpoint (hepdata8-checkpoint.jsonl by
+    # default). Submissions that fail don't stop the run, they are listed in
+    # --failed-file (hepdata8-failed.txt). With --resume, the submissions
+    # added by a previous run with the same checkpoint are skipped, and the
+    # ones that failed are tried again.
+    #
+    # With --shard i/N, only the i-th of N parts of the submissions is added
+    # (split --shard-by hash or size, see aggregator.sharding), so that
+    # several machines can share the work. Statistics are written to
+    # --stats-file (hepdata8-stats.json, or hepdata8-shard1of4-stats.json
+    # for shard 1/4), to be added up with merge-stats.
+    #
+    # With --workers N, submissions are added by N processes, the most
+    # expensive first (see aggregator.scheduling). --worker-memory-mb limits
+    # the memory of each one: submissions needing more fail.
+    _add('hepdata8', submission_paths, suggestions_dir=suggestions_dir,
+         resume=resume, checkpoint=checkpoint, failed_file=failed_file,
+         shard=shard, shard_by=shard_by, stats_file=stats_file,
+         data_root=data_root, workers=workers,
+         worker_memory_mb=worker_memory_mb)
 
-def add_demo_subset(*submission_paths):
+
+def add_demo_subset(*submission_paths, resume=False, shard=None,
+                    shard_by='hash', workers=1):
     # Add just a few publications, useful for testing the UI
     _add('hepdata-demo', submission_paths,
          only_these=[1198427, 1116150, 1296861, 1334140, 1345354, 1383884,
-                     1386475, 1373912, 1343107])
+                     1386475, 1373912, 1343107], resume=resume, shard=shard,
+         shard_by=shard_by, workers=workers)
 
 
 def add_demo_mini():
@@ -84,6 +309,94 @@ def add_demo_mini():
     record_aggregator.report_statistics()
 
 
+def watch(root, poll_interval=30, settle_seconds=5.0, batch_size=20,
+          status_file=None, state_file=None):
+    # Ingest submissions added or changed under root as they land on disk
+    # (e.g. by a sync), see aggregator.watcher. Runs until interrupted. With
+    # --state-file, submissions changed while not running are ingested on
+    # startup.
+    from aggregator.record_aggregator import RecordAggregator
+    from aggregator.suggestions import SuggestionCounter
+    from aggregator.watcher import IngestDaemon, create_watcher
+    record_aggregator = RecordAggregator('hepdata8')
+
+    def ingest(submission_path):
+        if submission_path is None:
+            # End of a batch. Rejections and suggestions are only reported
+            # by add, so they are not kept growing forever.
+            record_aggregator.rejections = []
+            record_aggregator.suggestions = SuggestionCounter()
+            record_aggregator.refresh_index()
+            return
+        shared_dcontext.dcontext.submission = \
+            os.path.basename(submission_path)
+        record_aggregator.process_submission(submission_path)
+
+    watcher = create_watcher(root, poll_interval)
+    print('Watching %s with %s' % (root, type(watcher).__name__),
+          file=sys.stderr)
+    daemon = IngestDaemon(watcher, ingest, settle_seconds, batch_size,
+                          status_file, state_file=state_file)
+    try:
+        daemon.run_forever()
+    except KeyboardInterrupt:
+        print('Stopped. Ingested %d submissions, %d failed.' %
+              (daemon.count_ingested, daemon.count_failed), file=sys.stderr)
+
+
+def _write_suggestions(stats, suggestions_dir):
+    # The suggestions replace those of the whole database, don't let a run
+    # that counted only some submissions hide the rest
+    from aggregator.suggestions import SuggestionCounter, write_suggestions, \
+        suggestions_not_replaced
+    problem = suggestions_not_replaced(
+        suggestions_dir, stats['submissions'],
+        stats['uncounted_suggestions'], len(stats['failed']))
+    if problem is not None:
+        print('Warning: not writing suggestions to %s. %s' %
+              (suggestions_dir, problem), file=sys.stderr)
+        return
+    write_suggestions(SuggestionCounter.load(stats['suggestions']),
+                      suggestions_dir, stats['submissions'])
+    print('Wrote suggestions to %s' % suggestions_dir, file=sys.stderr)
+
+
+def merge_stats(*stats_files, output=None, suggestions_dir=None):
+    # Add up the statistics written by add in each shard. With --output, the
+    # merged statistics (with every rejected table) are written there. With
+    # --suggestions-dir, the suggestions counted by every shard.
+    from aggregator.run_statistics import merge_statistics, \
+        read_statistics, write_statistics, format_statistics
+    stats, warnings = merge_statistics(
+        [read_statistics(path) for path in stats_files])
+    for warning in warnings:
+        print('Warning: %s' % warning, file=sys.stderr)
+    print(format_statistics(stats['submissions'], stats['tables'],
+                            stats['rejected_tables']))
+    if stats['failed']:
+        print('%d submissions failed.' % len(stats['failed']))
+    if output is not None:
+        write_statistics(stats, output)
+    if suggestions_dir is not None:
+        _write_suggestions(stats, suggestions_dir)
+
+
+def convert_records(*variable_dirs, compression='zlib'):
+    # Convert records.bin files to the block-compressed records.v2.bin format.
+    # The original files are left untouched.
+    from aggregator.record_writer import convert_records_file
+    from aggregator.transactions import in_transaction
+
+    for variable_dir in variable_dirs:
+        v1_path = os.path.join(variable_dir, 'records.bin')
+        v2_path = os.path.join(variable_dir, 'records.v2.bin')
+        with in_transaction():
+            num_groups = convert_records_file(v1_path, v2_path, compression)
+        print('%s: %d groups, %d -> %d bytes' %
+              (variable_dir, num_groups, os.path.getsize(v1_path),
+               os.path.getsize(v2_path)))
+
+
 def main():
     with contextualized_tracebacks(
             ['submission', 'table', 'reading_file']) as dcontext:
@@ -92,6 +405,9 @@ def main():
             add,
             add_demo_subset,
             add_demo_mini,
+            merge_stats,
+            watch,
+            convert_records,
         ])
 
 
@@ -14,6 +14,10 @@ def uint32_format(number):
     return struct.pack('<L', number)
 
 
+def uint64_format(number):
+    return struct.pack('<Q', number)
+
+
 def varint_format(number):
     assert (number >= 0)
     if number <= 0x7f:
@@ -33,7 +37,55 @@ def string_format(a_string):
     return varint_format(len(data)) + data
 
 
+# Parsing functions. They all receive a bytes-like buffer and a position
+# inside it and return a tuple (value, position after the value).
+
+uint32_struct = struct.Struct('<L')
+
+
+def uint32_parse(buf, pos):
+    return uint32_struct.unpack_from(buf, pos)[0], pos + 4
+
+
+uint64_struct = struct.Struct('<Q')
+
+
+def uint64_parse(buf, pos):
+    return uint64_struct.unpack_from(buf, pos)[0], pos + 8
+
+
+def varint_parse(buf, pos):
+    number = 0
+    shift = 0
+    while True:
+        current_part = buf[pos]
+        pos += 1
+        number |= (current_part & 0x7f) << shift
+        if current_part & 0x80 == 0:
+            return number, pos
+        shift += 7
+
+
+def size_parse(buf, pos):
+    return varint_parse(buf, pos)
+
+
+def string_parse(buf, pos):
+    length, pos = varint_parse(buf, pos)
+    return bytes(buf[pos:pos + length]).decode('UTF-8'), pos + length
+
+
 class TestVarint(TestCase):
     def test_varint(self):
         self.assertEqual(varint_format(600), b'\xD8\x04')
         self.assertEqual(varint_format(123456), b'\xC0\xC4\x07')
+
+    def test_varint_parse(self):
+        self.assertEqual(varint_parse(b'\xD8\x04', 0), (600, 2))
+        self.assertEqual(varint_parse(b'\x00\xC0\xC4\x07', 1), (123456, 4))
+
+    def test_string_parse(self):
+        data = string_format('ratio') + string_format('')
+        value, pos = string_parse(data, 0)
+        self.assertEqual(value, 'ratio')
+        self.assertEqual(string_parse(data, pos), ('', len(data)))
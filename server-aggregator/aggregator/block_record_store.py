@@ -0,0 +1,421 @@
+"""
+Block-compressed container for table groups (records file format v2).
+
+Groups are encoded exactly like in records.bin (see RecordWriter), but they
+are packed into blocks of roughly block_size uncompressed bytes which are
+compressed independently. A block directory at the end of the file gives the
+key range of each block, so readers only need to decompress the blocks that
+may contain the groups they are interested in.
+
+The key of a group is the tuple (inspire_record, table_num).
+
+    File {
+        Header header;
+        Block* blocks;
+        Directory* directories;  // only the last one is used
+        Trailer trailer;
+    }
+
+    Header {
+        byte[4] magic = "HDRB";
+        varint version = 2;
+        varint compression;  // 0: none, 1: zlib, 2: lzma
+        varint group_version;  // see aggregator.record_reader
+    }
+
+    Directory {
+        varint length;
+        BlockEntry* entries;
+    }
+
+    BlockEntry {
+        varint offset;
+        varint compressed_size;
+        varint uncompressed_size;
+        varint num_groups;
+        varint min_inspire_record, min_table_num;
+        varint max_inspire_record, max_table_num;
+    }
+
+    Trailer {
+        uint64 directory_offset;
+        byte[4] magic = "HDRB";
+    }
+
+Files are append only: when new groups are added to an existing file, the new
+blocks are written after the old trailer, followed by a new directory listing
+both old and new blocks and a new trailer. The old directory is left behind as
+a few bytes of garbage. A file without groups still has a header, an empty
+directory and a trailer.
+
+For now these files are only produced from existing records.bin files, with
+convert_records_file() (the convert-records command).
+"""
+import lzma
+import os
+import zlib
+from collections import namedtuple
+from unittest import TestCase
+
+from aggregator.binary_formats import varint_format, varint_parse, \
+    uint64_format, uint64_parse
+from aggregator.record_reader import iter_groups, scan_groups, group_version
+from aggregator.transactions import get_current_transaction
+
+magic = b'HDRB'
+format_version = 2
+trailer_size = 8 + len(magic)
+default_block_size = 64 * 1024
+
+BlockEntry = namedtuple('BlockEntry', ['offset', 'compressed_size',
+                                       'uncompressed_size', 'num_groups',
+                                       'min_key', 'max_key'])
+
+Compression = namedtuple('Compression', ['code', 'compress', 'decompress'])
+
+compressions = {
+    'none': Compression(0, bytes, bytes),
+    'zlib': Compression(1, zlib.compress, zlib.decompress),
+    'lzma': Compression(2, lzma.compress, lzma.decompress),
+}
+compressions_by_code = {c.code: c for c in compressions.values()}
+
+
+class InvalidBlockStore(Exception):
+    pass
+
+
+def group_key(metadata):
+    return metadata.inspire_record, metadata.table_num
+
+
+def block_entry_format(entry):
+    return b''.join(varint_format(n) for n in (
+        entry.offset, entry.compressed_size, entry.uncompressed_size,
+        entry.num_groups,
+        entry.min_key[0], entry.min_key[1],
+        entry.max_key[0], entry.max_key[1],
+    ))
+
+
+def block_entry_parse(buf, pos):
+    numbers = []
+    for i in range(8):
+        number, pos = varint_parse(buf, pos)
+        numbers.append(number)
+    entry = BlockEntry(offset=numbers[0], compressed_size=numbers[1],
+                       uncompressed_size=numbers[2], num_groups=numbers[3],
+                       min_key=(numbers[4], numbers[5]),
+                       max_key=(numbers[6], numbers[7]))
+    return entry, pos
+
+
+def header_format(compression):
+    return magic + varint_format(format_version) + \
+           varint_format(compressions[compression].code) + \
+           varint_format(group_version)
+
+
+def read_header(fp):
+    """Returns (Compression used in the file, group version)."""
+    fp.seek(0)
+    buf = fp.read(len(magic) + 3)
+    if buf[:len(magic)] != magic:
+        raise InvalidBlockStore('Not a block records file: %s' % fp.name)
+    version, pos = varint_parse(buf, len(magic))
+    if version != format_version:
+        raise InvalidBlockStore('Unsupported records file version %d: %s' %
+                                (version, fp.name))
+    code, pos = varint_parse(buf, pos)
+    if code not in compressions_by_code:
+        raise InvalidBlockStore('Unknown compression %d: %s' % (code, fp.name))
+    file_group_version, pos = varint_parse(buf, pos)
+    return compressions_by_code[code], file_group_version
+
+
+def read_directory(fp):
+    """Returns the list of BlockEntry of the file."""
+    fp.seek(0, os.SEEK_END)
+    if fp.tell() < trailer_size:
+        raise InvalidBlockStore('Missing block directory: %s' % fp.name)
+    fp.seek(-trailer_size, os.SEEK_END)
+    directory_end = fp.tell()
+    trailer = fp.read(trailer_size)
+    if len(trailer) != trailer_size or trailer[8:] != magic:
+        raise InvalidBlockStore('Missing block directory: %s' % fp.name)
+    directory_offset, _ = uint64_parse(trailer, 0)
+
+    fp.seek(directory_offset)
+    buf = fp.read(directory_end - directory_offset)
+    length, pos = varint_parse(buf, 0)
+    blocks = []
+    for i in range(length):
+        entry, pos = block_entry_parse(buf, pos)
+        blocks.append(entry)
+    return blocks
+
+
+class BlockStoreWriter(object):
+    """
+    Appends encoded groups to a block records file.
+
+    Like the rest of the writers, all the data is written through the current
+    transaction.
+    """
+
+    def __init__(self, path, compression='zlib',
+                 block_size=default_block_size):
+        self.path = path
+        self.block_size = block_size
+        get_current_transaction().lock_directory(os.path.dirname(path))
+        self.fp = open(path, 'a+b')
+        self.fp.seek(0, os.SEEK_END)
+        # Where the next write will land, taking into account the data that
+        # is pending in the transaction.
+        self.offset = self.fp.tell()
+
+        if self.offset == 0:
+            self.compression = compressions[compression]
+            self.group_version = group_version
+            self.blocks = []  # type: list[BlockEntry]
+            self._header = header_format(compression)
+        else:
+            # Existing files keep their compression and group version
+            self.compression, self.group_version = read_header(self.fp)
+            self.blocks = read_directory(self.fp)
+            self._header = None
+
+        self._block_buffer = []  # type: list[bytes]
+        self._block_buffer_size = 0
+        self._block_min_key = None
+        self._block_max_key = None
+        self._num_existing_blocks = len(self.blocks)
+        self.closed = False
+
+    def _write(self, data):
+        t = get_current_transaction()
+        if self._header is not None:
+            t.write(self.fp, self._header)
+            self.offset += len(self._header)
+            self._header = None
+        t.write(self.fp, data)
+        self.offset += len(data)
+
+    def add_group(self, key, data):
+        """
+        Adds an encoded group.
+
+        :param key: The tuple (inspire_record, table_num) of the group.
+        :param data: The group, encoded as in records.bin.
+        """
+        assert (not self.closed)
+        self._block_buffer.append(data)
+        self._block_buffer_size += len(data)
+        if self._block_min_key is None or key < self._block_min_key:
+            self._block_min_key = key
+        if self._block_max_key is None or key > self._block_max_key:
+            self._block_max_key = key
+
+        if self._block_buffer_size >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self):
+        if len(self._block_buffer) == 0:
+            return
+
+        uncompressed = b''.join(self._block_buffer)
+        compressed = self.compression.compress(uncompressed)
+
+        self._write(b'')  # ensure the header is in place before the offset is taken
+        entry = BlockEntry(offset=self.offset,
+                           compressed_size=len(compressed),
+                           uncompressed_size=len(uncompressed),
+                           num_groups=len(self._block_buffer),
+                           min_key=self._block_min_key,
+                           max_key=self._block_max_key)
+        self._write(compressed)
+        self.blocks.append(entry)
+
+        self._block_buffer = []
+        self._block_buffer_size = 0
+        self._block_min_key = None
+        self._block_max_key = None
+
+    def close(self):
+        assert (not self.closed)
+        self.flush_block()
+
+        # Only write a new directory if something was added, or if the file
+        # is new, so that it is valid even without groups
+        if len(self.blocks) != self._num_existing_blocks or \
+                self._header is not None:
+            self._write(b'')  # the header goes before the directory
+            directory_offset = self.offset
+            self._write(varint_format(len(self.blocks)) +
+                        b''.join(block_entry_format(entry)
+                                 for entry in self.blocks))
+            self._write(uint64_format(directory_offset) + magic)
+
+        get_current_transaction().close(self.fp)
+        self.closed = True
+
+
+class BlockStoreReader(object):
+    """Reads groups from a block records file, decompressing blocks on demand."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, 'rb')
+        self.compression, self.group_version = read_header(self.fp)
+        self.blocks = read_directory(self.fp)
+
+    def close(self):
+        self.fp.close()
+
+    def read_block(self, entry):
+        """Returns the uncompressed contents of a block."""
+        self.fp.seek(entry.offset)
+        data = self.compression.decompress(self.fp.read(entry.compressed_size))
+        assert len(data) == entry.uncompressed_size
+        return data
+
+    def blocks_in_range(self, min_key=None, max_key=None):
+        """Returns the blocks that may contain keys in [min_key, max_key]."""
+        return [
+            entry for entry in self.blocks
+            if (min_key is None or entry.max_key >= min_key) and
+               (max_key is None or entry.min_key <= max_key)
+        ]
+
+    def iter_groups(self, min_key=None, max_key=None):
+        """
+        Yields (metadata, records) for every group whose key is in the range
+        [min_key, max_key]. Either bound may be None.
+        """
+        for entry in self.blocks_in_range(min_key, max_key):
+            for metadata, records in iter_groups(self.read_block(entry),
+                                                 version=self.group_version):
+                key = group_key(metadata)
+                if (min_key is None or key >= min_key) and \
+                        (max_key is None or key <= max_key):
+                    yield metadata, records
+
+    def iter_record_groups(self, inspire_record):
+        """Yields (metadata, records) for every group of a publication."""
+        return self.iter_groups((inspire_record, 0),
+                                (inspire_record, float('inf')))
+
+    def scan(self, predicate):
+        """
+        Yields (metadata, records) for every group matching a GroupPredicate.
+
+        When the predicate restricts inspire records, blocks that can't contain
+        any of them are not read at all.
+        """
+        blocks = self.blocks
+        if predicate.inspire_records is not None:
+            blocks = [
+                entry for entry in blocks
+                if any(entry.min_key[0] <= inspire_record <= entry.max_key[0]
+                       for inspire_record in predicate.inspire_records)
+            ]
+        for entry in blocks:
+            for group in scan_groups(self.read_block(entry), predicate,
+                                     version=self.group_version):
+                yield group
+
+
+class TestBlockStore(TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'records.v2.bin')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def write_groups(self, groups, compression='zlib', block_size=16):
+        from aggregator.transactions import in_transaction
+        with in_transaction():
+            writer = BlockStoreWriter(self.path, compression, block_size)
+            for key, data in groups:
+                writer.add_group(key, data)
+            writer.close()
+
+    def test_block_entry_round_trip(self):
+        entry = BlockEntry(10, 20, 300, 4, (1234567, 1), (1234567, 12))
+        self.assertEqual(block_entry_parse(block_entry_format(entry), 0),
+                         (entry, len(block_entry_format(entry))))
+
+    def test_append(self):
+        for compression in ('none', 'zlib', 'lzma'):
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.write_groups([((1, 1), b'a' * 20), ((1, 2), b'b' * 20)],
+                              compression)
+            self.write_groups([((2, 1), b'c' * 5)], compression)
+
+            reader = BlockStoreReader(self.path)
+            self.assertEqual(reader.compression, compressions[compression])
+            self.assertEqual(reader.group_version, group_version)
+            self.assertEqual([(e.min_key, e.max_key) for e in reader.blocks],
+                             [((1, 1), (1, 1)), ((1, 2), (1, 2)),
+                              ((2, 1), (2, 1))])
+            self.assertEqual(len(reader.blocks_in_range((1, 2), (1, 9))), 1)
+            self.assertEqual(reader.read_block(reader.blocks[2]), b'c' * 5)
+            reader.close()
+
+    def test_empty(self):
+        self.write_groups([])
+        reader = BlockStoreReader(self.path)
+        self.assertEqual(reader.blocks, [])
+        self.assertEqual(list(reader.iter_groups()), [])
+        reader.close()
+
+        # Groups can still be appended later
+        self.write_groups([((1, 1), b'a')])
+        reader = BlockStoreReader(self.path)
+        self.assertEqual(len(reader.blocks), 1)
+        reader.close()
+
+    def test_trailer(self):
+        self.write_groups([((1, 1), b'a' * 20)])
+        reader = BlockStoreReader(self.path)
+        block = reader.blocks[0]
+        reader.close()
+        with open(self.path, 'rb') as f:
+            f.seek(-trailer_size, os.SEEK_END)
+            trailer = f.read()
+        self.assertEqual(trailer[8:], magic)
+        # The directory follows the last block. Its offset is an uint64, so
+        # files may exceed 4 GB
+        self.assertEqual(uint64_parse(trailer, 0)[0],
+                         block.offset + block.compressed_size)
+
+    def test_scan(self):
+        from aggregator.record_reader import GroupPredicate, encode_test_group
+        self.write_groups([
+            ((1, 1), encode_test_group(1, 1, (7000.0, 7000.0), 'P P --> Z0 X',
+                                       [1.0])),
+            ((2, 1), encode_test_group(2, 1, (7000.0, 7000.0), 'P P --> Z0 X',
+                                       [2.0])),
+            ((2, 2), encode_test_group(2, 2, (13000.0, 13000.0),
+                                       'P P --> JET X', [3.0])),
+        ], block_size=1)
+
+        reader = BlockStoreReader(self.path)
+        blocks_read = []
+        read_block = reader.read_block
+        reader.read_block = lambda entry: (blocks_read.append(entry.min_key),
+                                           read_block(entry))[1]
+        try:
+            self.assertEqual(
+                [(group_key(metadata), records[0].y) for metadata, records in
+                 reader.scan(GroupPredicate(inspire_records=[2],
+                                            cmenergies=(10000, 14000)))],
+                [((2, 2), 3.0)])
+            # The block of inspire record 1 is not even read
+            self.assertEqual(blocks_read, [(2, 1), (2, 2)])
+        finally:
+            reader.close()
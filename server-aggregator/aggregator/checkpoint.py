@@ -0,0 +1,121 @@
+"""
+Checkpoints of add runs, so that an interrupted run can be resumed.
+
+The checkpoint is a file with a JSON line for every submission processed:
+
+    {"submission": "ins1234", "path": "/hepdata/data/a/ins1234",
+     "outcome": "done", "tables": 12, "rejected_tables": 1}
+
+outcome is "done" or "failed" (with the error in "error"). A submission may
+appear several times (e.g. it failed and then was retried); the last line
+counts. Lines are written in batches and fsync'ed, so at most a batch of
+submissions is processed again after a crash. A torn last line is ignored.
+"""
+import json
+import os
+import tempfile
+import unittest
+
+
+class Checkpoint(object):
+    def __init__(self, path, resume=False, batch_size=50):
+        """
+        Opens a checkpoint, starting it from scratch unless resume is True.
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.outcomes = {}  # type: dict[str, dict]
+        if resume:
+            self.outcomes = self._load()
+        self._pending = []
+        self._file = open(path, 'a' if resume else 'w')
+        if resume and self._file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # Don't append to a torn line
+                    self._file.write('\n')
+
+    def _load(self):
+        outcomes = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn write
+                    outcomes[entry['submission']] = entry
+        except FileNotFoundError:
+            pass
+        return outcomes
+
+    def is_done(self, submission):
+        entry = self.outcomes.get(submission)
+        return entry is not None and entry['outcome'] == 'done'
+
+    def failed(self):
+        """Returns the entries of the submissions that failed."""
+        return [entry for entry in self.outcomes.values()
+                if entry['outcome'] == 'failed']
+
+    def record(self, submission, path, outcome, **details):
+        entry = dict(submission=submission, path=path, outcome=outcome,
+                     **details)
+        self.outcomes[submission] = entry
+        self._pending.append(entry)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._file.write(''.join(json.dumps(entry) + '\n'
+                                 for entry in self._pending))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'checkpoint.jsonl')
+            with Checkpoint(path, batch_size=2) as checkpoint:
+                checkpoint.record('ins1', '/data/ins1', 'done', tables=3)
+                checkpoint.record('ins2', '/data/ins2', 'failed',
+                                  error='TransportError')
+                checkpoint.record('ins3', '/data/ins3', 'done')
+                # Only full batches are written until closed
+                with Checkpoint(path, resume=True) as resumed:
+                    self.assertEqual(len(resumed.outcomes), 2)
+            with open(path, 'a') as f:
+                f.write('{"submission": "ins4", "outc')
+
+            with Checkpoint(path, resume=True) as checkpoint:
+                self.assertTrue(checkpoint.is_done('ins1'))
+                self.assertFalse(checkpoint.is_done('ins2'))
+                self.assertTrue(checkpoint.is_done('ins3'))
+                self.assertFalse(checkpoint.is_done('ins4'))
+                self.assertEqual([entry['path'] for entry in
+                                  checkpoint.failed()], ['/data/ins2'])
+                checkpoint.record('ins2', '/data/ins2', 'done')
+
+            checkpoint = Checkpoint(path, resume=True)
+            self.assertEqual(checkpoint.failed(), [])
+            checkpoint.close()
+
+            # Without resume, the checkpoint starts again
+            with Checkpoint(path) as checkpoint:
+                self.assertFalse(checkpoint.is_done('ins1'))
+            self.assertEqual(os.path.getsize(path), 0)
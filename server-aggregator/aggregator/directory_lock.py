@@ -0,0 +1,25 @@
+import contextlib
+import os
+
+lock_file_name = '.lock'
+
+if os.name == 'posix':
+    import fcntl
+
+    @contextlib.contextmanager
+    def locked_directory(path):
+        """
+        Holds an exclusive lock on a directory, shared by all the processes
+        and threads of the machine that use this function.
+        """
+        with open(os.path.join(path, lock_file_name), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+else:
+    @contextlib.contextmanager
+    def locked_directory(path):
+        # Not supported on Windows OS
+        yield
@@ -1,13 +1,19 @@
 import json
 import os
-from itertools import chain
+import shutil
+import tempfile
+import unittest
+from itertools import chain, islice
 
 import yaml
 
 from aggregator.harmonizing import find_keyword, find_qualifier, \
     coerce_float, NotNumeric, find_inspire_record, ensure_list, \
     coerce_float_or_null, value_is_actually_a_range, parse_value_range
-from aggregator.shared_dcontext import dcontext
+from aggregator.run_statistics import format_statistics
+from aggregator import shared_dcontext
+from aggregator.suggestions import SuggestionCounter
+from aggregator.table_reader import iter_table_variables
 from elasticsearch import Elasticsearch
 import re
 
@@ -105,6 +111,68 @@ def extract_variable_name(header):
         return header['name']
 
 
+def clean_indep_var_values(values):
+    """
+    Cleans in place the values of an independent variable (handles infinity,
+    scientific notation and so on).
+
+    Returns the first exception that makes the variable unusable, or None.
+    """
+    exclusion_reason = None
+    for value in values:
+        assert 'value' in value or \
+               ('low' in value and 'high' in value)
+
+        if 'value' in value:
+            if value_is_actually_a_range(value['value']):
+                center, plus_minus = parse_value_range(value['value'])
+                value['low'] = center - plus_minus
+                value['high'] = center + plus_minus
+                del value['value']
+
+            try:
+                # Note: nulls are allowed in dependent variables, but
+                # not in independent ones.
+                value['value'] = coerce_float(value['value'])
+            except NotNumeric as err:
+                exclusion_reason = exclusion_reason or err
+                continue
+
+        if 'low' in value:
+            value['low'] = coerce_float(value['low'])
+            value['high'] = coerce_float(value['high'])
+    return exclusion_reason
+
+
+def clean_dep_var_values(values):
+    """
+    Cleans in place the values of a dependent variable.
+
+    Returns the first exception that makes the variable unusable, or None.
+    """
+    exclusion_reason = None
+    for value in values:
+        assert 'value' in value, value
+
+        if value_is_actually_a_range(value['value']):
+            center, plus_minus = parse_value_range(value['value'])
+            value['value'] = center
+            value.setdefault('errors', []).append({
+                'label': '_pm',
+                'symerror': plus_minus,
+            })
+
+        try:
+            value['value'] = coerce_float_or_null(value['value'])
+        except NotNumeric as err:
+            exclusion_reason = exclusion_reason or err
+            continue
+
+        value['errors'] = clean_errors(value['value'],
+                                       value.get('errors', []))
+    return exclusion_reason
+
+
 class RejectedTable(Exception):
     @property
     def reason(self):
@@ -118,6 +186,7 @@ def format_exception(ex):
 re_arrow = re.compile(r' *-+> *')
 
 def analyze_reactions(reactions):
+    dcontext = shared_dcontext.dcontext
     ret = []
     for string_full in reactions:
         if '->' not in string_full:
@@ -153,13 +222,16 @@ class RecordAggregator(object):
         self.count_submissions = 0
         self.count_tables_total = 0
         self.count_tables_rejected = 0
+        # {"submission", "table", "reason"} of every table rejected
+        self.rejections = []
+        # Values of the tables indexed, see aggregator.suggestions
+        self.suggestions = SuggestionCounter()
         self.init_mapping()
 
     def report_statistics(self):
-        print('Indexed %d submissions.' % self.count_submissions)
-        print('Scanned %d tables, rejected %d tables (%.2f%%).' %
-              (self.count_tables_total, self.count_tables_rejected,
-               100 * (self.count_tables_rejected / self.count_tables_total)))
+        print(format_statistics(self.count_submissions,
+                                self.count_tables_total,
+                                self.count_tables_rejected))
 
     def process_submission(self, path):
         with open(os.path.join(path, 'submission.yaml')) as f:
@@ -190,9 +262,15 @@ class RecordAggregator(object):
             try:
                 new_table = self.process_table(path, header, publication_meta, table)
                 processed_tables.append(new_table)
+                self.suggestions.add_table(new_table)
             except RejectedTable as err:
                 print('Warning: Rejected table. ins%s, %s. Reason: %s' %
                       (inspire_record, table['name'], err.reason))
+                self.rejections.append({
+                    'submission': 'ins%s' % inspire_record,
+                    'table': table['name'],
+                    'reason': err.reason,
+                })
                 self.count_tables_rejected += 1
             self.count_tables_total += 1
 
@@ -209,14 +287,11 @@ class RecordAggregator(object):
         :param submission_header: The dictionary describing the submission metadata.
         :param table: The dictionary describing the table metadata (as in submission.yaml)
         """
+        dcontext = shared_dcontext.dcontext
         dcontext.table = filename = table['data_file']
 
         table_num = int(table['name'].replace('Table ', ''))
 
-        with open(os.path.join(submission_path, filename)) as f:
-            # Holds the parsed contents of the table file (e.g. Table1.yaml)
-            doc = yaml.load(f, Loader=SafeLoader)
-
         cmenergies_raw = find_keyword(table, 'cmenergies')
         if len(cmenergies_raw) > 0:
             assert len(cmenergies_raw) == 1
@@ -228,90 +303,58 @@ class RecordAggregator(object):
         phrases   = ensure_list(find_keyword(table, 'phrases'))
         reactions = analyze_reactions(ensure_list(find_keyword(table, 'reactions')))
 
-        indep_var_meta = [
-            {'name': extract_variable_name(var['header'])}
-            for var in doc['independent_variables']
-        ]
-        dep_var_meta = [
-            {
-                'name': extract_variable_name(var['header']),
-                'qualifiers': var.get('qualifiers', []),
-            }
-            for var in doc['dependent_variables']
-        ]
-
-        # Reject this table if any variable has empty name
-        for var_meta in chain(indep_var_meta, dep_var_meta):
-            if var_meta['name'] == '':
-                raise RejectedTable('Variable with empty name.')
-
-        indep_var_values = (var['values']
-                            for var in doc['independent_variables'])
-        dep_var_values = (var['values']
-                          for var in doc['dependent_variables'])
-
-        # This spell extracts a table of values, with one column per variable.
-        # Independent variables go first, then dependent variables.
-        data_points = list(zip(*chain(indep_var_values, dep_var_values)))
+        indep_var_meta = []
+        dep_var_meta = []
+        # Columns of values, one per variable. Excluded ones are set to None.
+        indep_var_values = []
+        dep_var_values = []
 
         # A bit of validation and cleaning never hurts...
         excluded_indep_vars = set()
         excluded_indep_vars_reason = {}
         excluded_dep_vars = set()
         excluded_dep_vars_reason = {}
+        num_rows = None
 
-        # For each row...
-        for data_point in data_points:
-            indep_var_cols = data_point[:len(indep_var_meta)]
-            dep_var_cols = data_point[len(indep_var_meta):]
-
-            # Only for independent variables...
-            for col, value in enumerate(indep_var_cols):
-                assert 'value' in value or \
-                       ('low' in value and 'high' in value)
-
-                # Clean the data (handle infinity, scientific notation and so on)
-                if 'value' in value:
-                    if value_is_actually_a_range(value['value']):
-                        center, plus_minus = parse_value_range(value['value'])
-                        value['low'] = center - plus_minus
-                        value['high'] = center + plus_minus
-                        del value['value']
-
-                    try:
-                        # Note: nulls are allowed in dependent variables, but
-                        # not in independent ones.
-                        value['value'] = coerce_float(value['value'])
-                    except NotNumeric as err:
-                        excluded_indep_vars.add(col)
-                        excluded_indep_vars_reason.setdefault(col, err)
-                        continue
-
-                if 'low' in value:
-                    value['low'] = coerce_float(value['low'])
-                    value['high'] = coerce_float(value['high'])
-
-            # Only for dependent variables...
-            for col, value in enumerate(dep_var_cols):
-                assert 'value' in value, value
-
-                if value_is_actually_a_range(value['value']):
-                    center, plus_minus = parse_value_range(value['value'])
-                    value['value'] = center
-                    value.setdefault('errors', []).append({
-                        'label': '_pm',
-                        'symerror': plus_minus,
+        with open(os.path.join(submission_path, filename)) as f:
+            # The table file (e.g. Table1.yaml) is read one variable at a
+            # time, so huge tables are never held in memory in full as
+            # parsed documents.
+            for section, var in iter_table_variables(f, Loader=SafeLoader):
+                var_name = extract_variable_name(var['header'])
+
+                # Reject this table if any variable has empty name
+                if var_name == '':
+                    raise RejectedTable('Variable with empty name.')
+
+                values = var['values']
+                if num_rows is None or len(values) < num_rows:
+                    num_rows = len(values)
+
+                if section == 'independent_variables':
+                    indep_var_meta.append({'name': var_name})
+                    indep_var_values.append(values)
+                else:
+                    dep_var_meta.append({
+                        'name': var_name,
+                        'qualifiers': var.get('qualifiers', []),
                     })
-
-                try:
-                    value['value'] = coerce_float_or_null(value['value'])
-                except NotNumeric as err:
-                    excluded_dep_vars.add(col)
-                    excluded_dep_vars_reason.setdefault(col, err)
-                    continue
-
-                value['errors'] = clean_errors(value['value'],
-                                               value.get('errors', []))
+                    dep_var_values.append(values)
+
+        # Only the rows up to the shortest column make it into data_points, so
+        # values past them are neither cleaned nor a reason for exclusion.
+        for col, values in enumerate(indep_var_values):
+            reason = clean_indep_var_values(values[:num_rows])
+            if reason is not None:
+                excluded_indep_vars.add(col)
+                excluded_indep_vars_reason[col] = reason
+                indep_var_values[col] = None
+        for col, values in enumerate(dep_var_values):
+            reason = clean_dep_var_values(values[:num_rows])
+            if reason is not None:
+                excluded_dep_vars.add(col)
+                excluded_dep_vars_reason[col] = reason
+                dep_var_values[col] = None
 
         # Some variables may have been excluded (e.g. because they contain non
         # numeric data). Warn and remove them.
@@ -327,10 +370,6 @@ class RecordAggregator(object):
                   (var_name, dcontext.submission, dcontext.table,
                    format_exception(excluded_dep_vars_reason[index])))
 
-        excluded_cols = excluded_indep_vars.union({
-            col_number + len(indep_var_meta)
-            for col_number in excluded_dep_vars
-        })
         indep_var_meta = [
             x for i, x in enumerate(indep_var_meta)
             if i not in excluded_indep_vars
@@ -339,19 +378,20 @@ class RecordAggregator(object):
             x for i, x in enumerate(dep_var_meta)
             if i not in excluded_dep_vars
         ]
-        data_points = [
-            tuple(
-                x for i, x in enumerate(row)
-                if i not in excluded_cols
-            )
-            for row in data_points
-        ]
 
         if len(indep_var_meta) == 0:
             raise RejectedTable('No valid independent variables.')
         if len(dep_var_meta) == 0:
             raise RejectedTable('No valid dependent variables.')
 
+        # This spell extracts a table of values, with one column per variable.
+        # Independent variables go first, then dependent variables.
+        data_points = list(islice(zip(*(
+            values
+            for values in chain(indep_var_values, dep_var_values)
+            if values is not None
+        )), num_rows))
+
         table = dict(
             table_num=table_num,
             description=table['description'],
@@ -384,6 +424,10 @@ class RecordAggregator(object):
                                 'doc_as_upsert': True,
                             })
 
+    def refresh_index(self):
+        """Makes the publications written so far searchable right away."""
+        self.elastic.indices.refresh(self.index)
+
     def load_mini_demo(self):
         self.write_publication({
             "comment": "Publication A",
@@ -515,3 +559,100 @@ class RecordAggregator(object):
                 }
             }
         })
+
+
+class TestProcessTable(unittest.TestCase):
+    # A ragged table: the shortest column has 3 values, so only 3 rows are
+    # indexed. The SIG column has a non numeric value past them, which must
+    # not exclude it.
+    ragged_table = r"""
+independent_variables:
+- header: {name: PT, units: GeV}
+  values:
+  - {low: 0.0, high: 10.0}
+  - {value: 15.0}
+  - {value: 25.0}
+  - {value: 35.0}
+dependent_variables:
+- header: {name: SIG, units: PB}
+  values:
+  - value: 1.5
+    errors:
+    - {symerror: 0.1, label: stat}
+    - {asymerror: {minus: -0.2, plus: 0.3}, label: sys}
+  - {value: 2.5e+1, errors: [{symerror: 0.5}]}
+  - {value: '-'}
+  - {value: '4 $\pm$ 1'}
+  - {value: not a number}
+- header: {name: RATIO}
+  values:
+  - {value: 1.0}
+  - {value: 2.0}
+  - {value: 3.0}
+- header: {name: NAME}
+  values:
+  - {value: abc}
+  - {value: 2.0}
+  - {value: 3.0}
+"""
+
+    def setUp(self):
+        from types import SimpleNamespace
+        if getattr(shared_dcontext, 'dcontext', None) is None:
+            shared_dcontext.dcontext = SimpleNamespace(submission=None,
+                                                       table=None)
+        self.dir = tempfile.mkdtemp()
+        # Only process_table() is used, which doesn't need ElasticSearch
+        self.aggregator = RecordAggregator.__new__(RecordAggregator)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def process(self, table_yaml):
+        with open(os.path.join(self.dir, 'Table1.yaml'), 'w') as f:
+            f.write(table_yaml)
+        return self.aggregator.process_table(
+            self.dir, {}, {'record': {'collaborations': ['CMS']}},
+            {'name': 'Table 1', 'data_file': 'Table1.yaml',
+             'description': 'Cross section', 'keywords': []})
+
+    def test_ragged_columns(self):
+        table = self.process(self.ragged_table)
+        # Same result as when the whole file was loaded with yaml.load() and
+        # its columns zipped
+        self.assertEqual(table['indep_vars'], [{'name': 'PT [GeV]'}])
+        self.assertEqual(table['dep_vars'],
+                         [{'name': 'SIG [PB]', 'qualifiers': []},
+                          {'name': 'RATIO', 'qualifiers': []}])
+        self.assertEqual(table['data_points'], [
+            ({'low': 0.0, 'high': 10.0},
+             {'value': 1.5, 'errors': [
+                 {'label': 'stat', 'type': 'symerror', 'value': 0.1},
+                 {'label': 'sys', 'type': 'asymerror', 'minus': -0.2,
+                  'plus': 0.3}]},
+             {'value': 1.0, 'errors': []}),
+            ({'value': 15.0},
+             {'value': 25.0, 'errors': [
+                 {'label': 'main', 'type': 'symerror', 'value': 0.5}]},
+             {'value': 2.0, 'errors': []}),
+            ({'value': 25.0},
+             {'value': None, 'errors': []},
+             {'value': 3.0, 'errors': []}),
+        ])
+
+    def test_empty_name_first(self):
+        # The empty name is reported even though a variable read before it
+        # has an invalid error
+        with self.assertRaises(RejectedTable) as context:
+            self.process("""
+dependent_variables:
+- header: {name: SIG}
+  values:
+  - {value: 1.0, errors: [{symerror: invalid}]}
+independent_variables:
+- header: {name: ''}
+  values:
+  - {value: 1.0}
+""")
+        self.assertEqual(context.exception.reason,
+                         'Variable with empty name.')
@@ -0,0 +1,302 @@
+import mmap
+import os
+import struct
+import tempfile
+from unittest import TestCase
+
+from aggregator.binary_formats import size_parse, string_parse, varint_parse
+from aggregator.record_types import Record, RecordError, TableGroupMetadata
+
+# Records files start with a small header declaring the version of the group
+# encoding:
+#
+#     byte[4] magic = "HDRS";
+#     varint group_version;
+#
+# Files written before this header existed have none and use version 1, whose
+# group headers lack the body length.
+records_file_magic = b'HDRS'
+legacy_group_version = 1
+group_version = 2
+
+cmenergies_struct = struct.Struct('<ff')
+record_values_struct = struct.Struct('<fff')
+error_values_struct = struct.Struct('<ff')
+
+
+def read_records_file_header(buf):
+    """Returns (group version, position of the first group)."""
+    if bytes(buf[:len(records_file_magic)]) == records_file_magic:
+        return varint_parse(buf, len(records_file_magic))
+    else:
+        return legacy_group_version, 0
+
+
+def read_group_header(buf, pos, version=group_version):
+    """
+    Parses a group header as written by RecordWriter.
+
+    Returns (metadata, num_records, body_length, position of the first record).
+    body_length is None in version 1 groups. var_x is not stored in records
+    files, so it is always None.
+    """
+    inspire_record, pos = varint_parse(buf, pos)
+    table_num, pos = varint_parse(buf, pos)
+    cmenergies = cmenergies_struct.unpack_from(buf, pos)
+    pos += cmenergies_struct.size
+    reaction, pos = string_parse(buf, pos)
+    observables, pos = string_parse(buf, pos)
+    var_y, pos = string_parse(buf, pos)
+    num_records, pos = size_parse(buf, pos)
+    if version >= 2:
+        body_length, pos = size_parse(buf, pos)
+    else:
+        body_length = None
+
+    metadata = TableGroupMetadata(inspire_record, table_num, cmenergies,
+                                  reaction, observables, None, var_y)
+    return metadata, num_records, body_length, pos
+
+
+def read_record(buf, pos):
+    x_low, x_high, y = record_values_struct.unpack_from(buf, pos)
+    pos += record_values_struct.size
+
+    num_errors, pos = varint_parse(buf, pos)
+    errors = []
+    for i in range(num_errors):
+        label, pos = varint_parse(buf, pos)
+        minus, plus = error_values_struct.unpack_from(buf, pos)
+        pos += error_values_struct.size
+        errors.append(RecordError(label, minus, plus))
+
+    return Record(x_low, x_high, y, errors), pos
+
+
+def skip_record(buf, pos):
+    pos += record_values_struct.size
+    num_errors, pos = varint_parse(buf, pos)
+    for i in range(num_errors):
+        label, pos = varint_parse(buf, pos)
+        pos += error_values_struct.size
+    return pos
+
+
+def read_group_body(buf, pos, num_records):
+    records = []
+    for i in range(num_records):
+        record, pos = read_record(buf, pos)
+        records.append(record)
+    return records, pos
+
+
+def skip_group_body(buf, pos, num_records, body_length):
+    """Returns the position of the end of a group body without decoding it."""
+    if body_length is not None:
+        return pos + body_length
+    for i in range(num_records):
+        pos = skip_record(buf, pos)
+    return pos
+
+
+def read_group(buf, pos, version=group_version):
+    """Parses a whole table group. Returns (metadata, records, new position)."""
+    metadata, num_records, body_length, pos = \
+        read_group_header(buf, pos, version)
+    records, pos = read_group_body(buf, pos, num_records)
+    return metadata, records, pos
+
+
+def iter_groups(buf, pos=0, end=None, version=group_version):
+    """Yields (metadata, records) for every group in buf[pos:end]."""
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        metadata, records, pos = read_group(buf, pos, version)
+        yield metadata, records
+
+
+def iter_raw_groups(buf, pos=0, end=None, version=group_version):
+    """
+    Yields (metadata, num_records, body_start, body_end) for every group in
+    buf[pos:end].
+    """
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        metadata, num_records, body_length, pos = \
+            read_group_header(buf, pos, version)
+        body_start = pos
+        pos = skip_group_body(buf, pos, num_records, body_length)
+        yield metadata, num_records, body_start, pos
+
+
+class GroupPredicate(object):
+    """
+    Conditions on the fields stored in group headers. A group matches when it
+    satisfies all the conditions that have been set.
+
+    :param inspire_records: Collection of accepted inspire record ids.
+    :param cmenergies: Tuple (min, max). Groups whose cmenergies range
+      overlaps it are accepted.
+    :param reaction: Accepted reaction string.
+    :param reaction_contains: Substring the reaction string must contain.
+    :param observables: Collection of accepted observables strings.
+    :param var_y: Collection of accepted dependent variable names.
+    """
+
+    def __init__(self, inspire_records=None, cmenergies=None, reaction=None,
+                 reaction_contains=None, observables=None, var_y=None):
+        self.inspire_records = set(inspire_records) \
+            if inspire_records is not None else None
+        self.cmenergies = cmenergies
+        self.reaction = reaction
+        self.reaction_contains = reaction_contains
+        self.observables = set(observables) \
+            if observables is not None else None
+        self.var_y = set(var_y) if var_y is not None else None
+
+    def matches(self, metadata):
+        if self.inspire_records is not None and \
+                metadata.inspire_record not in self.inspire_records:
+            return False
+        if self.cmenergies is not None:
+            range_min, range_max = self.cmenergies
+            group_min, group_max = metadata.cmenergies
+            if group_max < range_min or group_min > range_max:
+                return False
+        if self.reaction is not None and metadata.reaction != self.reaction:
+            return False
+        if self.reaction_contains is not None and \
+                self.reaction_contains not in metadata.reaction:
+            return False
+        if self.observables is not None and \
+                metadata.observables not in self.observables:
+            return False
+        if self.var_y is not None and metadata.var_y not in self.var_y:
+            return False
+        return True
+
+
+def scan_groups(buf, predicate, pos=0, end=None, version=group_version):
+    """
+    Yields (metadata, records) for the groups in buf[pos:end] that match
+    predicate.
+
+    Only the headers are decoded for groups that don't match. In version 2
+    groups their bodies are skipped using the stored body length, so they are
+    not even read.
+    """
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        metadata, num_records, body_length, pos = \
+            read_group_header(buf, pos, version)
+        if predicate.matches(metadata):
+            records, pos = read_group_body(buf, pos, num_records)
+            yield metadata, records
+        else:
+            pos = skip_group_body(buf, pos, num_records, body_length)
+
+
+def scan_records_file(path, predicate):
+    """
+    Yields (metadata, records) for the groups of a records.bin file that match
+    predicate.
+
+    The file is memory mapped, so the pages of skipped group bodies are never
+    loaded.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file, cannot be mapped
+            return
+        try:
+            version, pos = read_records_file_header(buf)
+            for group in scan_groups(buf, predicate, pos, version=version):
+                yield group
+        finally:
+            buf.close()
+
+
+def encode_test_group(inspire_record, table_num, cmenergies, reaction, ys,
+                      version=group_version):
+    """Encodes a group of records without errors, for tests."""
+    from aggregator.record_writer import group_header_format
+    metadata = TableGroupMetadata(inspire_record, table_num, cmenergies,
+                                  reaction, 'SIG', None, 'SIG [PB]')
+    body = b''.join(record_values_struct.pack(0.0, 1.0, y) + b'\x00'
+                    for y in ys)
+    return group_header_format(metadata, len(ys), len(body), version) + body
+
+
+class TestScanGroups(TestCase):
+    def write_file(self, data):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def groups(self, version):
+        return [
+            encode_test_group(1, 1, (7000.0, 7000.0), 'P P --> Z0 X',
+                              [1.0, 2.0], version),
+            encode_test_group(1, 2, (8000.0, 8000.0), 'P P --> JET X',
+                              [3.0], version),
+            encode_test_group(2, 1, (13000.0, 13000.0), 'P P --> Z0 X',
+                              [4.0, 5.0, 6.0], version),
+        ]
+
+    def scan(self, path, **conditions):
+        return [(metadata.inspire_record, metadata.table_num,
+                 [record.y for record in records])
+                for metadata, records in
+                scan_records_file(path, GroupPredicate(**conditions))]
+
+    def check_scans(self, path):
+        self.assertEqual(self.scan(path), [(1, 1, [1.0, 2.0]), (1, 2, [3.0]),
+                                           (2, 1, [4.0, 5.0, 6.0])])
+        self.assertEqual(self.scan(path, inspire_records=[2]),
+                         [(2, 1, [4.0, 5.0, 6.0])])
+        self.assertEqual(self.scan(path, cmenergies=(7500, 8500)),
+                         [(1, 2, [3.0])])
+        self.assertEqual(self.scan(path, reaction_contains='Z0',
+                                   inspire_records=[1]),
+                         [(1, 1, [1.0, 2.0])])
+        self.assertEqual(self.scan(path, reaction='P P --> JET X'),
+                         [(1, 2, [3.0])])
+        self.assertEqual(self.scan(path, observables=['ASYM']), [])
+        self.assertEqual(len(self.scan(path, var_y=['SIG [PB]'])), 3)
+
+    def test_legacy_file(self):
+        # Version 1: no file header, no body lengths
+        data = b''.join(self.groups(legacy_group_version))
+        self.assertEqual(read_records_file_header(data),
+                         (legacy_group_version, 0))
+        self.check_scans(self.write_file(data))
+
+    def test_file(self):
+        header = records_file_magic + bytes((group_version,))
+        data = header + b''.join(self.groups(group_version))
+        self.assertEqual(read_records_file_header(data),
+                         (group_version, len(header)))
+        self.check_scans(self.write_file(data))
+
+    def test_skipped_bodies_are_not_decoded(self):
+        groups = self.groups(group_version)
+        # Replace the body of the second group with bytes that can't be
+        # decoded as records, keeping its length
+        metadata, num_records, body_length, body_start = \
+            read_group_header(groups[1], 0)
+        groups[1] = groups[1][:body_start] + b'\xff' * body_length
+        path = self.write_file(records_file_magic + bytes((group_version,)) +
+                               b''.join(groups))
+        self.assertEqual(self.scan(path, inspire_records=[1, 2],
+                                   reaction_contains='Z0'),
+                         [(1, 1, [1.0, 2.0]), (2, 1, [4.0, 5.0, 6.0])])
+
+    def test_empty_file(self):
+        self.assertEqual(self.scan(self.write_file(b'')), [])
@@ -1,6 +1,95 @@
+from array import array
 from collections import namedtuple
 
 TableGroupMetadata = namedtuple('TableGroup',
                                 ['inspire_record', 'table_num', 'cmenergies', 'reaction',
                                  'observables', 'var_x', 'var_y'])
-Record = namedtuple('Record', ['x_low', 'x_high', 'y', 'errors'])
\ No newline at end of file
+Record = namedtuple('Record', ['x_low', 'x_high', 'y', 'errors'])
+# Errors as read back from a records file. label is an id from the string
+# dictionary of the variable directory.
+RecordError = namedtuple('RecordError', ['label', 'minus', 'plus'])
+
+
+class RecordBatch(object):
+    """
+    The records of a table group, stored in columns.
+
+    Values are kept in float32 arrays, as they are stored in records files.
+    Errors use a CSR layout: the errors of record i are the items in the range
+    error_offsets[i]:error_offsets[i + 1] of the error columns. Error labels are
+    ids in the labels list of the batch.
+
+    A table with thousands of rows needs a handful of objects this way,
+    instead of several per row.
+    """
+    __slots__ = ('x_low', 'x_high', 'y',
+                 'error_offsets', 'error_labels', 'error_minus', 'error_plus',
+                 'labels', '_label_ids')
+
+    def __init__(self):
+        self.x_low = array('f')
+        self.x_high = array('f')
+        self.y = array('f')
+
+        self.error_offsets = array('L', [0])
+        self.error_labels = array('L')
+        self.error_minus = array('f')
+        self.error_plus = array('f')
+
+        self.labels = []  # type: list[str]
+        self._label_ids = {}  # type: dict[str, int]
+
+    @classmethod
+    def from_columns(cls, x_low, x_high, y, errors=()):
+        """
+        Builds a batch from the columns of a table, without an object per row.
+
+        :param errors: List of (label, minus, plus), where minus and plus are
+        columns with the bounds of that error in every row, or None in the rows
+        that don't have it.
+        """
+        batch = cls()
+        batch.x_low = array('f', x_low)
+        batch.x_high = array('f', x_high)
+        batch.y = array('f', y)
+        num_rows = len(batch.y)
+        assert len(batch.x_low) == len(batch.x_high) == num_rows
+
+        label_ids = [batch._label_id(label) for label, _, _ in errors]
+        offsets = batch.error_offsets
+        for i in range(num_rows):
+            count = 0
+            for label_id, (_, minus, plus) in zip(label_ids, errors):
+                if minus[i] is not None:
+                    batch.error_labels.append(label_id)
+                    batch.error_minus.append(minus[i])
+                    batch.error_plus.append(plus[i])
+                    count += 1
+            offsets.append(offsets[-1] + count)
+        return batch
+
+    def _label_id(self, label):
+        try:
+            return self._label_ids[label]
+        except KeyError:
+            label_id = self._label_ids[label] = len(self.labels)
+            self.labels.append(label)
+            return label_id
+
+    def __len__(self):
+        return len(self.y)
+
+    def add_record(self, x_low, x_high, y):
+        """Adds a record without errors. Use add_error() to add them."""
+        self.x_low.append(x_low)
+        self.x_high.append(x_high)
+        self.y.append(y)
+        self.error_offsets.append(self.error_offsets[-1])
+
+    def add_error(self, label, minus, plus):
+        """Adds an error to the last record."""
+        assert len(self.y) > 0
+        self.error_labels.append(self._label_id(label))
+        self.error_minus.append(minus)
+        self.error_plus.append(plus)
+        self.error_offsets[-1] += 1
@@ -1,10 +1,16 @@
 import os
 import struct
+from unittest import TestCase, skipIf
 
+from aggregator.block_record_store import BlockStoreReader, BlockStoreWriter, \
+    default_block_size, group_key
 from aggregator.string_dictionary import StringDictionary
 from aggregator.binary_formats import size_format, string_format, varint_format
-from aggregator.record_types import Record
-from aggregator.transactions import get_current_transaction
+from aggregator.record_reader import records_file_magic, group_version, \
+    read_records_file_header, iter_groups, iter_raw_groups
+from aggregator.record_types import Record, RecordBatch, TableGroupMetadata
+from aggregator.transactions import get_current_transaction, \
+    in_transaction
 
 
 def error_to_float(value, error_value):
@@ -20,13 +26,81 @@ def error_to_float(value, error_value):
             raise RuntimeError('Invalid error: ' + error_value)
 
 
+def error_bounds(value, error):
+    """Returns (minus, plus) for an error dictionary."""
+    if 'asymerror' in error:
+        return (error_to_float(value, error['asymerror']['minus']),
+                error_to_float(value, error['asymerror']['plus']))
+    else:
+        error_value = error_to_float(value, error['symerror'])
+        return error_value, error_value
+
+
+def records_to_batch(records):
+    """
+    Converts a list of Record into a RecordBatch. Tables should be turned into
+    batches with RecordBatch.from_columns() instead, this is for the code that
+    already has a list of Record.
+    """
+    batch = RecordBatch()
+    for record in records:
+        batch.add_record(record.x_low, record.x_high, record.y)
+        for error in record.errors:
+            error_minus, error_plus = error_bounds(record.y, error)
+            batch.add_error(error.get('label', ''), error_minus, error_plus)
+    return batch
+
+
+record_values_struct = struct.Struct('<fff')
+error_values_struct = struct.Struct('<ff')
+
+
+def group_header_format(metadata, num_records, body_length, version=group_version):
+    """
+    Encodes a group header:
+
+        TableGroup {
+            varint inspire_record;
+            varint table_num;
+            float cmenergies_min;
+            float cmenergies_max;
+            string reaction;
+            string observables;
+            string var_y;
+            size num_records;
+            size body_length;  // only since version 2
+        }
+    """
+    data = varint_format(metadata.inspire_record) + \
+           varint_format(metadata.table_num) + \
+           struct.pack('<ff', *metadata.cmenergies) + \
+           string_format(metadata.reaction) + \
+           string_format(metadata.observables) + \
+           string_format(metadata.var_y) + \
+           size_format(num_records)
+    if version >= 2:
+        data += size_format(body_length)
+    return data
+
+
 class RecordWriter(object):
     def __init__(self, dependent_variable_dir):
         self.path = dependent_variable_dir
+        get_current_transaction().lock_directory(self.path)
         self.fp_records = open(os.path.join(self.path, 'records.bin'), 'a+b')
         self.string_dict = StringDictionary(os.path.join(self.path, 'strings.txt'))
         self.closed = False
 
+        # Existing files keep the group version they were created with
+        self.fp_records.seek(0)
+        head = self.fp_records.read(len(records_file_magic) + 1)
+        if len(head) == 0:
+            self.group_version = group_version
+            self._file_header = records_file_magic + varint_format(group_version)
+        else:
+            self.group_version = read_records_file_header(head)[0]
+            self._file_header = None
+
     def close(self):
         assert (not self.closed)
         t = get_current_transaction()
@@ -35,31 +109,31 @@ class RecordWriter(object):
         self.closed = True
 
     def write_table_group(self, metadata, records):
-        self.write_group_header(metadata, len(records))
-        for record in records:
-            self.write_record(record)
-
-    def write_group_header(self, metadata, num_records):
         t = get_current_transaction()
+        if self._file_header is not None:
+            t.write(self.fp_records, self._file_header)
+            self._file_header = None
+        t.write(self.fp_records, self.encode_table_group(metadata, records))
 
-        t.write(self.fp_records, varint_format(metadata.inspire_record))
-        t.write(self.fp_records, varint_format(metadata.table_num))
-        t.write(self.fp_records, struct.pack('<ff', *metadata.cmenergies))
-        t.write(self.fp_records, string_format(metadata.reaction))
-        t.write(self.fp_records, string_format(metadata.observables))
-        t.write(self.fp_records, string_format(metadata.var_y))
-
-        t.write(self.fp_records, size_format(num_records))
+    def encode_table_group(self, metadata, records):
+        """
+        :param records: Either a list of Record or a RecordBatch.
+        """
+        if isinstance(records, RecordBatch):
+            body = self.encode_batch(records)
+        else:
+            body = b''.join(self.encode_record(record) for record in records)
+        return group_header_format(metadata, len(records), len(body),
+                                   self.group_version) + body
 
-    def write_record(self, record):
+    def encode_record(self, record):
         assert isinstance(record, Record)
-        t = get_current_transaction()
-        t.write(self.fp_records, struct.pack('<fff', record.x_low, record.x_high, record.y))
-        self.write_errors(record.y, record.errors)
+        return record_values_struct.pack(record.x_low, record.x_high, record.y) + \
+               self.encode_errors(record.y, record.errors)
 
-    def write_errors(self, value, errors):
+    def encode_errors(self, value, errors):
         """
-        // Writes Error[]
+        // Encodes Error[]
 
         T[] {
             varint length;
@@ -73,30 +147,271 @@ class RecordWriter(object):
         }
         """
 
-        t = get_current_transaction()
-        t.write(self.fp_records, varint_format(len(errors)))
+        parts = [varint_format(len(errors))]
         for error in errors:
             error_label_str = error.get('label', '')
-
-            if 'asymerror' in error:
-                error_minus = error_to_float(value, error['asymerror']['minus'])
-                error_plus = error_to_float(value, error['asymerror']['plus'])
-            else:
-                error_minus = error_plus = error_to_float(value, error['symerror'])
+            error_minus, error_plus = error_bounds(value, error)
 
             error_label = self.string_dict.id_for_str(error_label_str)
-            t.write(self.fp_records, varint_format(error_label))
-            t.write(self.fp_records, struct.pack('<ff',
-                                                 error_minus, error_plus))
+            parts.append(varint_format(error_label))
+            parts.append(error_values_struct.pack(error_minus, error_plus))
+        return b''.join(parts)
 
+    def encode_batch(self, batch):
+        """
+        Encodes the records of a RecordBatch, as encode_record() does, with a
+        single struct.pack() call instead of building bytes for every record.
+        """
+        # Encoded labels, indexed by the label ids of the batch
+        encoded_labels = [varint_format(self.string_dict.id_for_str(label))
+                          for label in batch.labels]
+        label_formats = ['%dsff' % len(encoded) for encoded in encoded_labels]
+        offsets = batch.error_offsets
+        error_labels = batch.error_labels
+        # Tables have few errors per record, so there are few counts
+        encoded_counts = {}
 
-record_writers = {}
+        formats = ['<']
+        values = []
+        for i in range(len(batch)):
+            start, end = offsets[i], offsets[i + 1]
+            try:
+                count_format, encoded_count = encoded_counts[end - start]
+            except KeyError:
+                encoded_count = varint_format(end - start)
+                count_format = 'fff%ds' % len(encoded_count)
+                encoded_counts[end - start] = count_format, encoded_count
+            formats.append(count_format)
+            values += (batch.x_low[i], batch.x_high[i], batch.y[i],
+                       encoded_count)
+            for j in range(start, end):
+                formats.append(label_formats[error_labels[j]])
+                values += (encoded_labels[error_labels[j]],
+                           batch.error_minus[j], batch.error_plus[j])
+        return struct.pack(''.join(formats), *values)
 
 
-def get_record_writer(dependent_variable):
-    if dependent_variable in record_writers.keys():
-        return record_writers[dependent_variable]
-    else:
-        record_writer = RecordWriter(dependent_variable)
-        record_writers[dependent_variable] = record_writer
-        return record_writer
+def get_record_writer(dependent_variable_dir):
+    """
+    Returns the RecordWriter of a directory in the current transaction,
+    opening it the first time. It is closed when the transaction is committed.
+    """
+    writers = get_current_transaction().writers
+    try:
+        return writers[dependent_variable_dir]
+    except KeyError:
+        writer = writers[dependent_variable_dir] = \
+            RecordWriter(dependent_variable_dir)
+        return writer
+
+
+def convert_records_file(v1_path, v2_path, compression='zlib',
+                         block_size=default_block_size):
+    """
+    Copies every group of a records.bin file into a new block records file.
+    This is the only way records.v2.bin files are produced.
+
+    Record bodies are copied byte by byte, so error labels still refer to the
+    string dictionary of the variable directory. Group headers are upgraded to
+    the current group version. Must be called inside a transaction.
+    """
+    if os.path.exists(v2_path) and os.path.getsize(v2_path) > 0:
+        raise RuntimeError('Refusing to convert into existing file: %s' %
+                           v2_path)
+
+    with open(v1_path, 'rb') as f:
+        buf = f.read()
+
+    writer = BlockStoreWriter(v2_path, compression, block_size)
+    version, pos = read_records_file_header(buf)
+    num_groups = 0
+    for metadata, num_records, body_start, body_end in \
+            iter_raw_groups(buf, pos, version=version):
+        header = group_header_format(metadata, num_records,
+                                     body_end - body_start,
+                                     writer.group_version)
+        writer.add_group((metadata.inspire_record, metadata.table_num),
+                         header + buf[body_start:body_end])
+        num_groups += 1
+    writer.close()
+    return num_groups
+
+
+class TestRecordWriter(TestCase):
+    def setUp(self):
+        import tempfile
+        from types import SimpleNamespace
+        from aggregator import shared_dcontext
+        if getattr(shared_dcontext, 'dcontext', None) is None:
+            shared_dcontext.dcontext = SimpleNamespace()
+        self.dir = tempfile.mkdtemp()
+        self.v1_path = os.path.join(self.dir, 'records.bin')
+        self.v2_path = os.path.join(self.dir, 'records.v2.bin')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def metadata(self, inspire_record, table_num):
+        return TableGroupMetadata(inspire_record, table_num, (7000.0, 7000.0),
+                                  'P P --> Z0 X', 'SIG', None, 'SIG [PB]')
+
+    def groups(self):
+        return [
+            (self.metadata(1, 1), [
+                Record(0.0, 1.0, 2.5, []),
+                Record(1.0, 2.0, 3.0, [{'symerror': 0.5, 'label': 'stat'}]),
+            ]),
+            (self.metadata(1, 2), [
+                Record(0.0, 1.0, 4.0, [{'asymerror': {'minus': -0.5,
+                                                      'plus': 0.25}}]),
+            ]),
+            (self.metadata(2, 1), [Record(5.0, 6.0, 7.0, [])]),
+        ]
+
+    def test_convert(self):
+        with in_transaction():
+            writer = RecordWriter(self.dir)
+            for metadata, records in self.groups():
+                writer.write_table_group(metadata, records)
+            writer.close()
+        with in_transaction():
+            self.assertEqual(convert_records_file(self.v1_path, self.v2_path,
+                                                  block_size=1), 3)
+
+        reader = BlockStoreReader(self.v2_path)
+        try:
+            self.assertEqual(len(reader.blocks), 3)
+            groups = list(reader.iter_groups())
+            self.assertEqual([group_key(metadata) for metadata, _ in groups],
+                             [(1, 1), (1, 2), (2, 1)])
+            metadata, records = groups[0]
+            self.assertEqual(metadata.var_y, 'SIG [PB]')
+            self.assertEqual([record.y for record in records], [2.5, 3.0])
+            self.assertEqual(records[1].errors[0][1:], (0.5, 0.5))
+            self.assertEqual(groups[1][1][0].errors[0][1:], (-0.5, 0.25))
+
+            # Only the groups in the key range
+            self.assertEqual([group_key(metadata) for metadata, _ in
+                              reader.iter_groups((1, 2), (2, 0))], [(1, 2)])
+            self.assertEqual([group_key(metadata) for metadata, _ in
+                              reader.iter_record_groups(2)], [(2, 1)])
+        finally:
+            reader.close()
+
+        with in_transaction():
+            with self.assertRaises(RuntimeError):
+                convert_records_file(self.v1_path, self.v2_path)
+
+    def test_convert_empty(self):
+        open(self.v1_path, 'wb').close()
+        with in_transaction():
+            self.assertEqual(convert_records_file(self.v1_path, self.v2_path),
+                             0)
+        reader = BlockStoreReader(self.v2_path)
+        self.assertEqual(list(reader.iter_groups()), [])
+        reader.close()
+
+    def test_writer_per_transaction(self):
+        metadata, records = self.groups()[0]
+        with in_transaction():
+            writer = get_record_writer(self.dir)
+            self.assertIs(get_record_writer(self.dir), writer)
+            writer.write_table_group(metadata, records)
+        self.assertTrue(writer.closed)
+
+        with in_transaction():
+            other = get_record_writer(self.dir)
+            self.assertIsNot(other, writer)
+            other.write_table_group(metadata, records)
+
+        with open(self.v1_path, 'rb') as f:
+            buf = f.read()
+        version, pos = read_records_file_header(buf)
+        self.assertEqual(len(list(iter_raw_groups(buf, pos, version=version))),
+                         2)
+
+    @skipIf(os.name != 'posix', 'directory locks need fcntl')
+    def test_processes(self):
+        import multiprocessing
+
+        def append(process_num):
+            for i in range(20):
+                with in_transaction():
+                    writer = get_record_writer(self.dir)
+                    writer.write_table_group(
+                        self.metadata(process_num, i),
+                        [Record(0.0, 1.0, float(i), [
+                            {'symerror': 0.5, 'label': 'stat'},
+                            {'symerror': 0.5,
+                             'label': 'p%d-%d' % (process_num, i)}])])
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=append, args=(process_num,))
+                     for process_num in (1, 2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        with open(os.path.join(self.dir, 'strings.txt')) as f:
+            strings = f.read().split('\n')[:-1]
+        # Ids are line numbers, see StringDictionary
+        strings_by_id = dict(enumerate(strings, 1))
+        self.assertEqual(len(set(strings)), len(strings))
+
+        with open(self.v1_path, 'rb') as f:
+            buf = f.read()
+        version, pos = read_records_file_header(buf)
+        groups = list(iter_groups(buf, pos, version=version))
+        self.assertEqual(len(groups), 40)
+        for metadata, records in groups:
+            self.assertEqual(records[0].y, metadata.table_num)
+            self.assertEqual([strings_by_id[error.label]
+                              for error in records[0].errors],
+                             ['stat', 'p%d-%d' % (metadata.inspire_record,
+                                                  metadata.table_num)])
+
+    def test_encode_batch(self):
+        records = [
+            Record(0.0, 1.0, 2.5, []),
+            Record(1.0, 2.0, 3.0, [{'symerror': 0.5, 'label': 'stat'},
+                                   {'asymerror': {'minus': -0.25,
+                                                  'plus': '0.75'},
+                                    'label': 'sys'}]),
+            Record(2.0, 3.0, 1.5, []),
+            Record(3.0, 4.0, 0.5, [{'symerror': '0.1'},
+                                   {'symerror': 0.2, 'label': 'stat'}]),
+        ]
+        batch = records_to_batch(records)
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch.error_offsets), [0, 0, 2, 2, 4])
+
+        # The same records from the columns of their table
+        nothing = [None, None]
+        columns = RecordBatch.from_columns(
+            [0.0, 1.0, 2.0, 3.0], [1.0, 2.0, 3.0, 4.0], [2.5, 3.0, 1.5, 0.5],
+            [('stat', [None, 0.5] + nothing, [None, 0.5] + nothing),
+             ('sys', [None, -0.25] + nothing, [None, 0.75] + nothing),
+             ('', nothing + [None, 0.1], nothing + [None, 0.1]),
+             ('stat', nothing + [None, 0.2], nothing + [None, 0.2])])
+        for name in RecordBatch.__slots__[:-2]:
+            self.assertEqual(getattr(columns, name), getattr(batch, name))
+        self.assertEqual(columns.labels, batch.labels)
+
+        other_dir = os.path.join(self.dir, 'other')
+        os.mkdir(other_dir)
+        metadata = self.metadata(1, 1)
+        with in_transaction():
+            # Separate directories, so that labels get their ids in the order
+            # each encoding asks for them
+            writers = RecordWriter(self.dir), RecordWriter(other_dir)
+            from_records = writers[0].encode_table_group(metadata, records)
+            from_batch = writers[1].encode_table_group(metadata, batch)
+            for writer in writers:
+                writer.close()
+        self.assertEqual(from_batch, from_records)
+        with open(os.path.join(self.dir, 'strings.txt')) as f, \
+                open(os.path.join(other_dir, 'strings.txt')) as g:
+            self.assertEqual(f.read(), g.read())
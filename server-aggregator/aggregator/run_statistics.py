@@ -0,0 +1,183 @@
+"""
+Statistics of add runs, written to a JSON file per run (or per shard, see
+aggregator.sharding) and combined with the merge-stats command:
+
+    {"index": "hepdata8", "shard": "1/4", "submissions": 2500,
+     "tables": 40000, "rejected_tables": 1200, "failed": [<path>, ...],
+     "rejections": [{"submission": "ins1234", "table": "Table 3",
+                     "reason": "No valid dependent variables."}, ...],
+     "suggestions": {"reactions_full": {"P P --> X": 120, ...}, ...},
+     "uncounted_suggestions": 0}
+
+shard is null when the run was not sharded. suggestions are the counts of
+aggregator.suggestions, empty unless they were asked for, and
+uncounted_suggestions the number of submissions added without counting them.
+"""
+import json
+import unittest
+from types import SimpleNamespace
+
+from aggregator.sharding import parse_shard
+from aggregator.suggestions import SuggestionCounter
+
+
+def format_statistics(submissions, tables, rejected_tables):
+    return ('Indexed %d submissions.\n'
+            'Scanned %d tables, rejected %d tables (%.2f%%).' %
+            (submissions, tables, rejected_tables,
+             100 * rejected_tables / tables if tables else 0))
+
+
+def statistics_from_checkpoint(checkpoint, index, shard):
+    """
+    Returns the statistics of the submissions of a checkpoint (see
+    aggregator.checkpoint), so they include the ones done before resuming.
+    """
+    stats = {
+        'index': index,
+        'shard': shard,
+        'submissions': 0,
+        'tables': 0,
+        'rejected_tables': 0,
+        'failed': [],
+        'rejections': [],
+        'uncounted_suggestions': 0,
+    }
+    suggestions = SuggestionCounter()
+    for entry in checkpoint.outcomes.values():
+        if entry['outcome'] == 'done':
+            stats['submissions'] += 1
+            stats['tables'] += entry.get('tables', 0)
+            stats['rejected_tables'] += entry.get('rejected_tables', 0)
+            stats['rejections'].extend(entry.get('rejections', []))
+            if 'suggestions' in entry:
+                suggestions.update(SuggestionCounter.load(
+                    entry['suggestions']))
+            else:
+                stats['uncounted_suggestions'] += 1
+        else:
+            stats['failed'].append(entry['path'])
+    stats['suggestions'] = suggestions.dump()
+    return stats
+
+
+def merge_statistics(all_stats):
+    """
+    Adds up the statistics of several shards. Returns the merged statistics
+    and a list of warnings about missing or repeated shards.
+    """
+    warnings = []
+    merged = {
+        'index': None,
+        'shard': None,
+        'submissions': 0,
+        'tables': 0,
+        'rejected_tables': 0,
+        'failed': [],
+        'rejections': [],
+        'uncounted_suggestions': 0,
+    }
+    suggestions = SuggestionCounter()
+    shards_seen = {}  # type: dict[int, set[int]] (count -> indices)
+    for stats in all_stats:
+        if merged['index'] is None:
+            merged['index'] = stats['index']
+        elif stats['index'] != merged['index']:
+            warnings.append('Statistics of different indices: %s and %s.' %
+                            (merged['index'], stats['index']))
+        if stats['shard'] is not None:
+            index, count = parse_shard(stats['shard'])
+            seen = shards_seen.setdefault(count, set())
+            if index in seen:
+                warnings.append('Shard %s is repeated.' % stats['shard'])
+            seen.add(index)
+        for key in ('submissions', 'tables', 'rejected_tables'):
+            merged[key] += stats[key]
+        merged['failed'].extend(stats['failed'])
+        merged['rejections'].extend(stats['rejections'])
+        # Missing in the statistics of older runs, which counted none
+        suggestions.update(SuggestionCounter.load(
+            stats.get('suggestions', {})))
+        merged['uncounted_suggestions'] += stats.get(
+            'uncounted_suggestions', stats['submissions'])
+    merged['suggestions'] = suggestions.dump()
+
+    if len(shards_seen) > 1:
+        warnings.append('Shards of different splits: %s.' % ', '.join(
+            'x/%d' % count for count in sorted(shards_seen)))
+    for count, seen in sorted(shards_seen.items()):
+        missing = sorted(set(range(1, count + 1)) - seen)
+        if missing:
+            warnings.append('Missing shards: %s.' % ', '.join(
+                '%d/%d' % (index, count) for index in missing))
+    return merged, warnings
+
+
+def write_statistics(stats, path):
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2)
+
+
+def read_statistics(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class TestRunStatistics(unittest.TestCase):
+    def shard_stats(self, shard, submissions):
+        return {'index': 'hepdata8', 'shard': shard,
+                'submissions': submissions, 'tables': 10 * submissions,
+                'rejected_tables': submissions,
+                'failed': ['/data/%s' % shard],
+                'rejections': [{'submission': 'ins1', 'table': 'Table 1',
+                                'reason': 'Variable with empty name.'}],
+                'suggestions': {'reactions_full': {'P P --> X': submissions,
+                                                   shard: 1}}}
+
+    def test_merge(self):
+        merged, warnings = merge_statistics(
+            [self.shard_stats('1/3', 5), self.shard_stats('3/3', 15)])
+        self.assertEqual((merged['submissions'], merged['tables'],
+                          merged['rejected_tables']), (20, 200, 20))
+        self.assertEqual(len(merged['failed']), 2)
+        self.assertEqual(len(merged['rejections']), 2)
+        self.assertEqual(merged['suggestions'], {'reactions_full': {
+            'P P --> X': 20, '1/3': 1, '3/3': 1}})
+        self.assertEqual(warnings, ['Missing shards: 2/3.'])
+        self.assertEqual(format_statistics(20, 200, 20),
+                         'Indexed 20 submissions.\n'
+                         'Scanned 200 tables, rejected 20 tables (10.00%).')
+
+        merged, warnings = merge_statistics(
+            [self.shard_stats('1/2', 1), self.shard_stats('1/2', 1),
+             self.shard_stats('2/2', 1)])
+        self.assertEqual(warnings, ['Shard 1/2 is repeated.'])
+
+    def test_from_checkpoint(self):
+        checkpoint = SimpleNamespace(outcomes={
+            'ins1': {'outcome': 'done', 'path': '/data/ins1', 'tables': 3,
+                     'rejected_tables': 1, 'rejections': [{}],
+                     'suggestions': {'reactions_full': {'P P --> X': 2}}},
+            'ins2': {'outcome': 'done', 'path': '/data/ins2', 'tables': 1,
+                     'rejected_tables': 0, 'rejections': [],
+                     'suggestions': {'reactions_full': {'P P --> X': 1},
+                                     'observables': {'SIG': 1}}},
+            'ins3': {'outcome': 'failed', 'path': '/data/ins3'},
+        })
+        stats = statistics_from_checkpoint(checkpoint, 'hepdata8', '2/2')
+        self.assertEqual((stats['submissions'], stats['tables'],
+                          stats['rejected_tables'], stats['failed']),
+                         (2, 4, 1, ['/data/ins3']))
+        self.assertEqual(stats['suggestions'], {
+            'reactions_full': {'P P --> X': 3}, 'observables': {'SIG': 1}})
+        self.assertEqual(stats['uncounted_suggestions'], 0)
+        del checkpoint.outcomes['ins2']['suggestions']
+        self.assertEqual(statistics_from_checkpoint(
+            checkpoint, 'hepdata8', '2/2')['uncounted_suggestions'], 1)
+
+        # Statistics written before suggestions were kept
+        del stats['suggestions']
+        del stats['uncounted_suggestions']
+        merged, warnings = merge_statistics([stats])
+        self.assertEqual(merged['suggestions'], {})
+        self.assertEqual(merged['uncounted_suggestions'], 2)
@@ -0,0 +1,139 @@
+"""
+Cost-aware ordering of the submissions of an add run.
+
+Submission sizes vary by orders of magnitude, so when several workers add
+submissions in glob order, the run ends with a few workers busy with the
+biggest ones while the rest sit idle. Instead, the cost of every submission
+is estimated before starting (from the size of its files and the number of
+tables in its submission.yaml, without parsing them) and the most expensive
+ones are started first, which leaves the small ones to fill the gaps at the
+end.
+
+Costs are in bytes: the size of the files plus table_overhead for every
+table, since each table has a cost of its own (a YAML document, a file to
+open) regardless of its size. After the run, cost_report() compares the
+predicted costs with the seconds each submission actually took.
+"""
+import os
+import re
+import tempfile
+import unittest
+from collections import namedtuple
+
+from aggregator.watcher import find_submissions
+
+# Processing cost of a table apart from the size of its data, in bytes
+table_overhead = 64 * 1024
+
+re_data_file = re.compile(rb'^\s*data_file\s*:', re.MULTILINE)
+
+
+class SubmissionCost(namedtuple('SubmissionCost',
+                                ['path', 'num_tables', 'data_bytes'])):
+    @property
+    def cost(self):
+        return self.data_bytes + table_overhead * self.num_tables
+
+
+def estimate_cost(path):
+    num_tables = 0
+    data_bytes = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return SubmissionCost(path, 0, 0)
+    for entry in entries:
+        if not entry.is_file() or entry.name == 'publication.json':
+            continue
+        data_bytes += entry.stat().st_size
+        if entry.name == 'submission.yaml':
+            with open(entry.path, 'rb') as f:
+                num_tables = len(re_data_file.findall(f.read()))
+    return SubmissionCost(path, num_tables, data_bytes)
+
+
+def discover_submissions(root):
+    """Returns the submission directories under root, sorted by name."""
+    return sorted(find_submissions(root))
+
+
+def schedule(costs):
+    """Sorts SubmissionCost's so that the most expensive go first."""
+    return sorted(costs, key=lambda cost: (-cost.cost, cost.path))
+
+
+def cost_report(entries, wall_seconds, workers):
+    """
+    Returns lines comparing predicted costs and actual seconds, from the
+    checkpoint entries (see aggregator.checkpoint) of the submissions added
+    in a run.
+    """
+    entries = [entry for entry in entries
+               if 'seconds' in entry and 'predicted_cost' in entry]
+    if not entries:
+        return []
+    total_seconds = sum(entry['seconds'] for entry in entries)
+    total_cost = sum(entry['predicted_cost'] for entry in entries)
+    lines = ['Worked %.1f seconds in %.1f seconds of wall time with %d '
+             'workers (%.0f%% busy).' %
+             (total_seconds, wall_seconds, workers,
+              100 * total_seconds / max(wall_seconds * workers, 1e-9))]
+    if total_cost == 0:
+        return lines
+
+    seconds_per_byte = total_seconds / total_cost
+    lines.append('Cost model: %.2f seconds per predicted MB.' %
+                 (seconds_per_byte * 1024 * 1024))
+
+    def predicted(entry):
+        return entry['predicted_cost'] * seconds_per_byte
+
+    worst = sorted(entries,
+                   key=lambda entry: -abs(entry['seconds'] - predicted(entry)))
+    lines.append('Worst predictions (predicted vs actual seconds):')
+    for entry in worst[:5]:
+        lines.append('    %s: %.1f vs %.1f' % (entry['submission'],
+                                               predicted(entry),
+                                               entry['seconds']))
+    return lines
+
+
+class TestScheduling(unittest.TestCase):
+    def test_estimate(self):
+        with tempfile.TemporaryDirectory() as root:
+            paths = []
+            for name, num_tables, table_bytes in (('ins1', 1, 10),
+                                                  ('ins2', 3, 5000),
+                                                  ('ins3', 2, 10)):
+                path = os.path.join(root, 'data', name)
+                os.makedirs(path)
+                paths.append(path)
+                with open(os.path.join(path, 'submission.yaml'), 'w') as f:
+                    f.write('comment: x\n')
+                    for i in range(num_tables):
+                        f.write('---\nname: Table %d\ndata_file: '
+                                'Table%d.yaml\n' % (i, i))
+                for i in range(num_tables):
+                    with open(os.path.join(path, 'Table%d.yaml' % i),
+                              'w') as f:
+                        f.write('x' * table_bytes)
+                with open(os.path.join(path, 'publication.json'), 'w') as f:
+                    f.write('x' * 100000)
+
+            self.assertEqual(discover_submissions(root), paths)
+            costs = [estimate_cost(path) for path in paths]
+            self.assertEqual([cost.num_tables for cost in costs], [1, 3, 2])
+            self.assertEqual([os.path.basename(cost.path)
+                              for cost in schedule(costs)],
+                             ['ins2', 'ins3', 'ins1'])
+
+    def test_report(self):
+        entries = [{'submission': 'ins%d' % i, 'seconds': i,
+                    'predicted_cost': i * 1024 * 1024} for i in (1, 2, 3)]
+        entries[0]['seconds'] = 4
+        lines = cost_report(entries, wall_seconds=5, workers=2)
+        self.assertEqual(lines[0], 'Worked 9.0 seconds in 5.0 seconds of '
+                                   'wall time with 2 workers (90% busy).')
+        self.assertEqual(lines[1], 'Cost model: 1.50 seconds per predicted '
+                                   'MB.')
+        self.assertEqual(lines[3], '    ins1: 1.5 vs 4.0')
@@ -0,0 +1,129 @@
+"""
+Splitting of the submissions of an add run among several machines.
+
+Every machine is given the same list of submission paths and its shard
+(--shard i/N, with i from 1 to N), and keeps only the submissions of its
+shard. Shards are computed from the submissions alone, so the machines don't
+need to talk to each other:
+
+* by hash (the default): a submission goes to shard
+  sha1(directory name) mod N. This doesn't depend on the other submissions,
+  so adding submissions doesn't move the rest between shards.
+* by size: submissions are sorted by their total file size, biggest first,
+  and every one is given to the shard with the least bytes so far. Shards
+  get about the same amount of work, but all the machines must see the same
+  files.
+"""
+import hashlib
+import os
+import unittest
+
+
+class ShardError(ValueError):
+    pass
+
+
+def parse_shard(shard):
+    """Parses 'i/N' as (i, N), with 1 <= i <= N."""
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ShardError('Invalid shard %r, it must be like 1/4.' % shard)
+    if not 1 <= index <= count:
+        raise ShardError('Invalid shard %r, it must be between 1/%d and '
+                         '%d/%d.' % (shard, count, count, count))
+    return index, count
+
+
+def submission_name(path):
+    return os.path.basename(path.rstrip('/'))
+
+
+def hash_shard(path, count):
+    """Returns the shard (from 1 to count) of a submission, by hash."""
+    digest = hashlib.sha1(submission_name(path).encode('UTF-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def submission_size(path):
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path)
+                   if entry.is_file())
+    except FileNotFoundError:
+        return 0
+
+
+def size_shards(paths, count, size_function=submission_size):
+    """Returns a dict with the shard of every path, balanced by size."""
+    sizes = {path: size_function(path) for path in paths}
+    loads = [0] * count
+    shards = {}
+    # Ties are broken by name, so every machine gets the same result
+    for path in sorted(paths, key=lambda path: (-sizes[path],
+                                                submission_name(path))):
+        shard = min(range(count), key=lambda shard: (loads[shard], shard))
+        loads[shard] += sizes[path]
+        shards[path] = shard + 1
+    return shards
+
+
+def select_shard(paths, shard, by='hash', size_function=submission_size):
+    """
+    Returns the paths that belong to shard ('i/N', or None for all of them),
+    in their original order.
+    """
+    if shard is None:
+        return list(paths)
+    index, count = parse_shard(shard)
+    if by == 'hash':
+        return [path for path in paths if hash_shard(path, count) == index]
+    elif by == 'size':
+        shards = size_shards(paths, count, size_function)
+        return [path for path in paths if shards[path] == index]
+    else:
+        raise ShardError('Unknown shard method %r, use hash or size.' % by)
+
+
+def shard_suffix(shard):
+    """Returns a suffix for the file names of a shard: 1/4 -> -shard1of4."""
+    if shard is None:
+        return ''
+    return '-shard%dof%d' % parse_shard(shard)
+
+
+class TestSharding(unittest.TestCase):
+    paths = ['/data/a/ins%d' % i for i in range(100)]
+
+    def check_partition(self, by, size_function=submission_size):
+        shards = [select_shard(self.paths, '%d/3' % i, by, size_function)
+                  for i in (1, 2, 3)]
+        self.assertEqual(sorted(sum(shards, [])), sorted(self.paths))
+        for shard in shards:
+            self.assertGreater(len(shard), 0)
+            # Original order is kept
+            self.assertEqual(shard, sorted(shard, key=self.paths.index))
+        return shards
+
+    def test_hash(self):
+        shards = self.check_partition('hash')
+        # Doesn't depend on the directory above
+        self.assertEqual(hash_shard('/data/a/ins5', 3),
+                         hash_shard('/elsewhere/ins5/', 3))
+        self.assertEqual(select_shard(self.paths[:50], '2/3'),
+                         [path for path in shards[1]
+                          if path in self.paths[:50]])
+
+    def test_size(self):
+        def size(path):
+            return int(path.rsplit('ins', 1)[1]) ** 2
+
+        shards = self.check_partition('size', size)
+        loads = [sum(size(path) for path in shard) for shard in shards]
+        self.assertLess(max(loads) - min(loads), size(self.paths[-1]))
+
+    def test_parse(self):
+        self.assertEqual(parse_shard('2/4'), (2, 4))
+        self.assertEqual(shard_suffix('2/4'), '-shard2of4')
+        for invalid in ('0/4', '5/4', '2', 'a/b'):
+            with self.assertRaises(ShardError):
+                parse_shard(invalid)
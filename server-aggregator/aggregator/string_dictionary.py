@@ -1,4 +1,6 @@
-from aggregator.shared_dcontext import dcontext
+import os
+
+from aggregator import shared_dcontext
 from aggregator.transactions import get_current_transaction
 
 
@@ -15,6 +17,7 @@ class StringDictionary(object):
 
     def __init__(self, path):
         self.path = path
+        get_current_transaction().lock_directory(os.path.dirname(path))
         self.fp = open(path, 'a+')
         self.fp.seek(0)
 
@@ -28,11 +31,12 @@ class StringDictionary(object):
         t.close(self.fp)
 
     def load_existing_strings(self):
+        dcontext = shared_dcontext.dcontext
         dcontext.reading_file = self.path
         for string in self.fp.read().split('\n'):
             if string != "":
-                self.counter += 1
                 str_id = self.counter
+                self.counter += 1
                 self.dict_id_to_str[str_id] = string
                 self.dict_str_to_id[string] = str_id
 
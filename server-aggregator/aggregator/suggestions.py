@@ -0,0 +1,216 @@
+"""
+Precomputed autocomplete suggestions.
+
+While publications are indexed, the values of the fields that can be chosen
+in choice filters are counted (number of tables having each value). At the
+end of a run they are written as static files that the frontend fetches
+instead of asking ElasticSearch for a terms aggregation:
+
+    <directory>/suggestions.json               manifest, rewritten every run
+    <directory>/<field>.<hash>.json            one file per field
+    <directory>/<field>.<hash>.json.gz         same, for nginx's gzip_static
+
+A field file looks like {"format": 1, "field": "dep_vars.name",
+"terms": [...], "counts": [...]}: terms are sorted by their lower case form
+(so terms starting with a prefix are a contiguous range that can be found
+with a binary search) and counts[i] is the number of tables having terms[i].
+
+File names contain a hash of their content, so they never change and can be
+cached forever. The manifest maps every field to the name of its file, and
+records the number of submissions the counts come from.
+
+The suggestions are used for the whole database, so a run only replaces them
+if it counted every one of its submissions, and at least as many as the
+previous suggestions (see suggestions_not_replaced()).
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import unittest
+from collections import Counter
+from datetime import datetime, timezone
+
+suggestions_format = 1
+
+# Same field names as the ChoiceFilter subclasses of the frontend
+suggestion_fields = ('dep_vars.name', 'indep_vars.name', 'reactions_full',
+                     'observables', 'phrases', 'collaborations')
+
+
+def table_field_values(table, field):
+    """Returns the distinct values of a field in a processed table."""
+    if field in ('dep_vars.name', 'indep_vars.name'):
+        values = [variable['name'] for variable in table[field.split('.')[0]]]
+    else:
+        values = table.get(field) or []
+    return set(value for value in values
+               if isinstance(value, str) and value != '')
+
+
+class SuggestionCounter(object):
+    def __init__(self):
+        self.counts = {field: Counter() for field in suggestion_fields}
+
+    def add_table(self, table):
+        """Counts the values of a table, as returned by process_table()."""
+        for field in suggestion_fields:
+            self.counts[field].update(table_field_values(table, field))
+
+    def update(self, other):
+        """Adds the counts of another SuggestionCounter."""
+        for field in suggestion_fields:
+            self.counts[field].update(other.counts[field])
+
+    def dump(self):
+        return {field: dict(counts) for field, counts in self.counts.items()
+                if counts}
+
+    @classmethod
+    def load(cls, data):
+        """Returns a SuggestionCounter from the result of dump()."""
+        counter = cls()
+        for field, counts in data.items():
+            counter.counts[field].update(counts)
+        return counter
+
+    def field_document(self, field):
+        terms = sorted(self.counts[field], key=lambda term: (term.lower(),
+                                                             term))
+        return {
+            'format': suggestions_format,
+            'field': field,
+            'terms': terms,
+            'counts': [self.counts[field][term] for term in terms],
+        }
+
+
+def write_file_atomically(path, data):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def suggestions_not_replaced(directory, num_submissions, num_uncounted,
+                             num_failed):
+    """
+    Returns why the suggestions counted from a run must not replace the ones
+    in directory, or None if they can.
+
+    :param num_uncounted: Number of submissions added without counting their
+    suggestions (e.g. before resuming a run without --suggestions-dir).
+    """
+    if num_failed:
+        return '%d submissions failed.' % num_failed
+    if num_uncounted:
+        return ('%d submissions were added without counting their '
+                'suggestions.' % num_uncounted)
+    try:
+        with open(os.path.join(directory, 'suggestions.json')) as f:
+            previous = json.load(f).get('submissions')
+    except FileNotFoundError:
+        previous = None
+    if previous is not None and num_submissions < previous:
+        return ('The current suggestions were counted from %d submissions, '
+                'and this run only has %d. Remove %s to replace them '
+                'anyway.' % (previous, num_submissions,
+                             os.path.join(directory, 'suggestions.json')))
+    return None
+
+
+def write_suggestions(counter, directory, num_submissions=None):
+    """
+    Writes the suggestion files of every field and then the manifest, so
+    clients never see a manifest pointing to missing files. Files of previous
+    runs are left for clients that still have the old manifest.
+
+    Returns the manifest.
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    for field in suggestion_fields:
+        data = json.dumps(counter.field_document(field), ensure_ascii=False,
+                          separators=(',', ':')).encode('UTF-8')
+        file_name = '%s.%s.json' % (field,
+                                    hashlib.sha1(data).hexdigest()[:12])
+        path = os.path.join(directory, file_name)
+        if not os.path.exists(path):
+            # mtime=0 makes the compressed file reproducible too
+            write_file_atomically(path + '.gz',
+                                  gzip.compress(data, 9, mtime=0))
+            write_file_atomically(path, data)
+        files[field] = file_name
+
+    manifest = {
+        'format': suggestions_format,
+        'generated': datetime.now(timezone.utc).isoformat(),
+        'fields': files,
+        'submissions': num_submissions,
+    }
+    write_file_atomically(os.path.join(directory, 'suggestions.json'),
+                          json.dumps(manifest, indent=2).encode('UTF-8'))
+    return manifest
+
+
+class TestSuggestions(unittest.TestCase):
+    def test_write(self):
+        counter = SuggestionCounter()
+        counter.add_table({
+            'indep_vars': [{'name': 'PT [GeV]'}],
+            'dep_vars': [{'name': 'SIG'}, {'name': 'SIG'}, {'name': 'asym'}],
+            'reactions_full': ['P P --> JET X'],
+            'observables': ['SIG'],
+            'phrases': [],
+            'collaborations': ['ATLAS'],
+        })
+        other = SuggestionCounter()
+        other.add_table({
+            'indep_vars': [{'name': 'PT [GeV]'}],
+            'dep_vars': [{'name': 'Ratio'}],
+            'collaborations': ['CMS'],
+        })
+        counter.update(SuggestionCounter.load(
+            json.loads(json.dumps(other.dump()))))
+
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = write_suggestions(counter, directory)
+            self.assertEqual(set(manifest['fields']), set(suggestion_fields))
+            with open(os.path.join(directory, 'suggestions.json')) as f:
+                self.assertEqual(json.load(f), manifest)
+
+            path = os.path.join(directory, manifest['fields']['dep_vars.name'])
+            with gzip.open(path + '.gz') as f:
+                document = json.loads(f.read().decode('UTF-8'))
+            self.assertEqual(document['terms'], ['asym', 'Ratio', 'SIG'])
+            self.assertEqual(document['counts'], [1, 1, 1])
+
+            with open(os.path.join(
+                    directory, manifest['fields']['indep_vars.name'])) as f:
+                self.assertEqual(json.load(f)['counts'], [2])
+
+            # Same content, same file
+            self.assertEqual(write_suggestions(counter, directory)['fields'],
+                             manifest['fields'])
+
+    def test_not_replaced(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertIsNone(suggestions_not_replaced(directory, 3, 0, 0))
+            self.assertIn('1 submissions failed',
+                          suggestions_not_replaced(directory, 3, 0, 1))
+            self.assertIn('2 submissions were added without',
+                          suggestions_not_replaced(directory, 3, 2, 0))
+
+            self.assertEqual(write_suggestions(
+                SuggestionCounter(), directory, 10)['submissions'], 10)
+            # A run of a few submissions would hide the rest
+            self.assertIn('counted from 10 submissions',
+                          suggestions_not_replaced(directory, 3, 0, 0))
+            self.assertIsNone(suggestions_not_replaced(directory, 10, 0, 0))
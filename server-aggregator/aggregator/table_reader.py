@@ -0,0 +1,150 @@
+"""
+Streaming reader for HEPData table files (e.g. Table1.yaml).
+
+yaml.load() composes a node tree for the whole document before constructing
+any Python object, so reading a huge table needs several times its size in
+memory. This reader consumes parser events instead and builds the objects of
+one variable at a time, so memory is bounded by the size of a column.
+"""
+import io
+from unittest import TestCase
+
+import yaml
+from yaml.events import AliasEvent, ScalarEvent, SequenceStartEvent, \
+    SequenceEndEvent, MappingStartEvent, MappingEndEvent, StreamStartEvent, \
+    DocumentStartEvent
+from yaml.nodes import ScalarNode
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+variable_sections = ('independent_variables', 'dependent_variables')
+
+
+class _EventReader(object):
+    """Builds Python objects from the events of a YAML loader."""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.anchors = {}
+        self.default_constructor = loader.yaml_constructors[None]
+
+    def expect(self, event_class):
+        event = self.loader.get_event()
+        if not isinstance(event, event_class):
+            raise yaml.YAMLError('Expected %s, found %s' %
+                                 (event_class.__name__, event))
+        return event
+
+    def read_value(self):
+        loader = self.loader
+        event = loader.get_event()
+
+        if isinstance(event, AliasEvent):
+            return self.anchors[event.anchor]
+        elif isinstance(event, ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(ScalarNode, event.value, event.implicit)
+            node = ScalarNode(tag, event.value, event.start_mark,
+                              event.end_mark, style=event.style)
+            constructor = loader.yaml_constructors.get(
+                tag, self.default_constructor)
+            value = constructor(loader, node)
+        elif isinstance(event, SequenceStartEvent):
+            value = []
+            while not loader.check_event(SequenceEndEvent):
+                value.append(self.read_value())
+            loader.get_event()
+        elif isinstance(event, MappingStartEvent):
+            value = {}
+            while not loader.check_event(MappingEndEvent):
+                key = self.read_value()
+                value[key] = self.read_value()
+            loader.get_event()
+        else:
+            raise yaml.YAMLError('Unexpected event: %s' % event)
+
+        if event.anchor is not None:
+            self.anchors[event.anchor] = value
+        return value
+
+
+def iter_table_variables(stream, Loader=SafeLoader):
+    """
+    Reads a table file, yielding a tuple (section, variable) as soon as each
+    variable has been read.
+
+    section is either 'independent_variables' or 'dependent_variables' and
+    variable is the dictionary of the variable, as yaml.load() would return it.
+    Other top level keys are skipped.
+    """
+    loader = Loader(stream)
+    try:
+        reader = _EventReader(loader)
+        reader.expect(StreamStartEvent)
+        reader.expect(DocumentStartEvent)
+        reader.expect(MappingStartEvent)
+
+        while not loader.check_event(MappingEndEvent):
+            key = reader.read_value()
+            if key in variable_sections and \
+                    loader.check_event(SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(SequenceEndEvent):
+                    yield key, reader.read_value()
+                loader.get_event()
+            else:
+                reader.read_value()
+    finally:
+        loader.dispose()
+
+
+class TestTableReader(TestCase):
+    def check_same_as_load(self, document):
+        expected = yaml.load(document, Loader=SafeLoader)
+        variables = list(iter_table_variables(io.StringIO(document)))
+        self.assertEqual(variables, [
+            (section, variable)
+            for section in expected
+            if section in variable_sections
+            for variable in expected[section]
+        ])
+        return variables
+
+    def test_same_as_load(self):
+        variables = self.check_same_as_load(r"""
+comment: {skipped: [as, any, other, key]}
+dependent_variables:
+- header: {name: SIG, units: PB}
+  qualifiers:
+  - &energy {name: SQRT(S), units: GeV, value: 7000}
+  values:
+  - value: 1.5e+1
+    errors:
+    - {symerror: 10%, label: stat}
+    - asymerror: {minus: -0.2, plus: 0.3}
+  - {value: '-'}
+  - {value: !!float '3', errors: []}
+independent_variables:
+- header: {name: PT}
+  values: [{low: 0.0, high: 10.0}, {value: .inf}, {value: null}]
+- header: {name: ETA}
+  qualifiers: [*energy]
+  values: []
+extra:
+  - independent_variables
+""")
+        self.assertEqual([section for section, variable in variables],
+                         ['dependent_variables', 'independent_variables',
+                          'independent_variables'])
+        # Aliases point to the same object, as with yaml.load()
+        self.assertIs(variables[2][1]['qualifiers'][0],
+                      variables[0][1]['qualifiers'][0])
+        self.assertEqual(variables[0][1]['values'][2]['value'], 3.0)
+
+    def test_empty_sections(self):
+        self.assertEqual(self.check_same_as_load(
+            'independent_variables: []\ndependent_variables: []\n'), [])
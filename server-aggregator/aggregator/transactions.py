@@ -1,52 +1,238 @@
+"""
+Buffered writes to the files of the aggregator stores.
+
+Writers don't write to their files directly. Instead they queue data in the
+current transaction, which writes everything when it's committed at the end of
+an in_transaction() block. If the block raises an exception nothing is written.
+
+Each thread (and each asyncio task) has its own current transaction, so
+several of them can build transactions at the same time. Writers load the
+state of their files (e.g. string ids, block offsets) when they are opened, so
+they lock their directory with lock_directory() before, and the lock is held
+until the transaction is committed or rolled back. Any other directory written
+to is locked when committing. This way several processes and threads may
+append to the same variable directories, one transaction at a time per
+directory. Transactions opening writers in several directories should open
+them in the same order (e.g. sorted), or they may deadlock each other. Writers
+shared through get_record_writer() belong to the current transaction and are
+closed when it is committed, so they are never shared between threads or
+tasks.
+
+Crash safety:
+
+* SIGINT is deferred while a transaction is being committed, so Ctrl+C never
+  leaves half written transactions.
+* If the process dies while committing (e.g. SIGKILL) or the machine loses
+  power, the files touched by the transaction may end with a partial write of
+  it. Everything committed before is left intact, since files are only
+  appended to.
+* Data is not fsync'ed: a committed transaction is visible to other processes
+  immediately, but may be lost on power loss.
+"""
 import contextlib
+import os
+import tempfile
+import threading
+from contextvars import ContextVar
+from unittest import TestCase
 
+from aggregator.directory_lock import locked_directory
 from aggregator.uninterruptible import uninterruptible_section
 
-current_transaction = None
+current_transaction = ContextVar('current_transaction', default=None)
 
 
 class Transaction(object):
     def __init__(self):
         self.committed = False
-        self._data_to_be_written = {}  # type: dict[file, bytes]
+        self._data_to_be_written = {}  # type: dict[file, list]
         self._files_to_close = set() # type: set[file]
+        # Writers opened during the transaction, by directory, see
+        # record_writer.get_record_writer()
+        self.writers = {}
+        self._locks = contextlib.ExitStack()
+        self._locked_directories = set()  # type: set[str]
+
+    def lock_directory(self, directory):
+        """
+        Locks a directory until the transaction is committed or rolled back.
+        Writers must call this before reading the state of their files.
+        """
+        directory = os.path.abspath(directory)
+        if directory not in self._locked_directories:
+            self._locks.enter_context(locked_directory(directory))
+            self._locked_directories.add(directory)
+
+    def release_locks(self):
+        self._locks.close()
+        self._locked_directories.clear()
 
     def write(self, fp, data):
         if 'b' in fp.mode:
             # binary file
-            empty_string = b''
             assert(isinstance(data, bytes))
         else:
             # text file
-            empty_string = ''
             assert(isinstance(data, str))
-        new_buf = self._data_to_be_written.get(fp, empty_string) + data
-        self._data_to_be_written[fp] = new_buf
+        self._data_to_be_written.setdefault(fp, []).append(data)
 
     def close(self, fp):
         self._files_to_close.add(fp)
 
+    def _directories(self):
+        files = set(self._data_to_be_written.keys()) | self._files_to_close
+        # Sorted so that concurrent commits always lock in the same order
+        return sorted(set(os.path.dirname(os.path.abspath(fp.name))
+                          for fp in files))
+
     def commit(self):
         assert(not self.committed)
-        with uninterruptible_section():
-            self.committed = True
-            for (fp, data) in self._data_to_be_written.items():
-                fp.write(data)
-            for fp in self._files_to_close:
-                fp.close()
+        for writer in self.writers.values():
+            if not writer.closed:
+                writer.close()
+
+        try:
+            for directory in self._directories():
+                self.lock_directory(directory)
+
+            with uninterruptible_section():
+                self.committed = True
+                for (fp, chunks) in self._data_to_be_written.items():
+                    empty_string = b'' if 'b' in fp.mode else ''
+                    fp.write(empty_string.join(chunks))
+                    # Make the data visible before the lock is released
+                    fp.flush()
+                for fp in self._files_to_close:
+                    fp.close()
+        finally:
+            self.release_locks()
 
 
 @contextlib.contextmanager
 def in_transaction():
-    global current_transaction
-    current_transaction = Transaction()
-    yield
-    current_transaction.commit()
-    current_transaction = None
+    if current_transaction.get() is not None:
+        raise RuntimeError("Already in transaction")
+
+    transaction = Transaction()
+    token = current_transaction.set(transaction)
+    try:
+        yield
+        transaction.commit()
+    finally:
+        # Rolled back if not committed
+        transaction.release_locks()
+        current_transaction.reset(token)
 
 
 def get_current_transaction():
-    if current_transaction:
-        return current_transaction
+    transaction = current_transaction.get()
+    if transaction:
+        return transaction
     else:
-        raise RuntimeError("Not in transaction")
\ No newline at end of file
+        raise RuntimeError("Not in transaction")
+
+
+class TestTransactions(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.txt')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def test_commit(self):
+        fp = open(self.path, 'a')
+        with in_transaction():
+            get_current_transaction().write(fp, 'a')
+            get_current_transaction().write(fp, 'b')
+            get_current_transaction().close(fp)
+            self.assertEqual(self.read(), '')
+        self.assertEqual(self.read(), 'ab')
+        self.assertTrue(fp.closed)
+        self.assertIsNone(current_transaction.get())
+
+        if os.name == 'posix':
+            # The directory lock has been released
+            import fcntl
+            with open(os.path.join(self.dir, '.lock')) as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def test_exception(self):
+        fp = open(self.path, 'a')
+        with self.assertRaises(ValueError):
+            with in_transaction():
+                get_current_transaction().write(fp, 'a')
+                raise ValueError()
+        fp.close()
+        self.assertEqual(self.read(), '')
+        with self.assertRaises(RuntimeError):
+            get_current_transaction()
+
+    def assertLocked(self, locked):
+        if os.name != 'posix':
+            return
+        import fcntl
+        with open(os.path.join(self.dir, '.lock'), 'a') as f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.assertTrue(locked)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                self.assertFalse(locked)
+
+    def test_lock_directory(self):
+        # Held from lock_directory() until the transaction is done, whether
+        # it's committed or not
+        with in_transaction():
+            get_current_transaction().lock_directory(self.dir)
+            get_current_transaction().lock_directory(self.dir)
+            self.assertLocked(True)
+        self.assertLocked(False)
+
+        with self.assertRaises(ValueError):
+            with in_transaction():
+                get_current_transaction().lock_directory(self.dir)
+                self.assertLocked(True)
+                raise ValueError()
+        self.assertLocked(False)
+
+    def test_nesting(self):
+        with in_transaction():
+            outer = get_current_transaction()
+            with self.assertRaises(RuntimeError):
+                with in_transaction():
+                    pass
+            self.assertIs(get_current_transaction(), outer)
+        self.assertIsNone(current_transaction.get())
+
+    def test_threads(self):
+        barrier = threading.Barrier(2)
+        seen = []
+
+        def run(data):
+            fp = open(os.path.join(self.dir, data), 'a')
+            with in_transaction():
+                get_current_transaction().write(fp, data)
+                get_current_transaction().close(fp)
+                # Both transactions are open at the same time
+                barrier.wait(timeout=5)
+                seen.append(get_current_transaction())
+
+        threads = [threading.Thread(target=run, args=(data,))
+                   for data in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(seen), 2)
+        self.assertIsNot(seen[0], seen[1])
+        for data in ('a', 'b'):
+            with open(os.path.join(self.dir, data)) as f:
+                self.assertEqual(f.read(), data)
@@ -0,0 +1,577 @@
+"""
+Ingestion of submissions as they land on disk (the watch command).
+
+Submission directories (named ins<id>, anywhere under the watched root) are
+watched with inotify on Linux and by polling their files' sizes and mtimes
+elsewhere, or when inotify can't watch every directory. A directory that
+changed is only ingested after it has stayed the same for settle_seconds, so
+that submissions being written by a sync are not read half way. Submissions
+ready to be ingested are processed in batches of up to batch_size. The ones
+that fail are tried again later, waiting longer after every failure (from
+retry_seconds up to max_retry_seconds), unless they change meanwhile.
+
+With a state file, the signature of every submission ingested is saved after
+each batch. On startup, submissions that are new or changed since then (e.g.
+synced while the daemon was stopped) are ingested. Without one, or on the
+first run, the submissions already on disk are assumed to be indexed (by
+the add command).
+
+Health is reported in a JSON status file, rewritten after every batch and
+every status_interval seconds: number of submissions waiting, ingested and
+failed, the last error and the lag (how long ago the oldest waiting
+submission changed, and how long the last batch took to become searchable
+since its submissions changed).
+"""
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import json
+import os
+import re
+import select
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+re_submission = re.compile(r'^ins\d+$')
+
+
+def is_submission(path):
+    return re_submission.match(os.path.basename(path)) is not None
+
+
+def find_submissions(root, max_depth=3):
+    """Yields the submission directories under root."""
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        if re_submission.match(entry.name):
+            yield entry.path
+        elif max_depth > 1:
+            yield from find_submissions(entry.path, max_depth - 1)
+
+
+def submission_signature(path):
+    """
+    Returns something that changes whenever a file of a submission is added,
+    removed or written, or None if the directory doesn't exist.
+    """
+    try:
+        return tuple(sorted((entry.name, entry.stat().st_size,
+                             entry.stat().st_mtime_ns)
+                            for entry in os.scandir(path)
+                            if entry.is_file()))
+    except FileNotFoundError:
+        return None
+
+
+def signature_digest(signature):
+    """Returns a short string identifying a signature, to be saved."""
+    return hashlib.sha1(json.dumps(signature).encode('UTF-8')).hexdigest()[:16]
+
+
+def write_json_atomically(path, value):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def is_complete(path):
+    return os.path.exists(os.path.join(path, 'submission.yaml')) and \
+        os.path.exists(os.path.join(path, 'publication.json'))
+
+
+class PollingWatcher(object):
+    """Finds changed submissions by comparing their signatures."""
+
+    def __init__(self, root, poll_interval=30):
+        self.root = root
+        self.poll_interval = poll_interval
+        self._signatures = self._scan()
+        self._last_poll = time.monotonic()
+
+    def _scan(self):
+        return {path: submission_signature(path)
+                for path in find_submissions(self.root)}
+
+    def changed_submissions(self, timeout):
+        """Waits up to timeout seconds, returning the submissions changed."""
+        wait = self._last_poll + self.poll_interval - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self._last_poll = time.monotonic()
+
+        signatures = self._scan()
+        changed = set(path for path, signature in signatures.items()
+                      if self._signatures.get(path) != signature)
+        self._signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+if sys.platform.startswith('linux'):
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    # Directories containing submissions only need to know about new ones
+    parent_mask = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+    submission_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | \
+        IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+    inotify_event = struct.Struct('iIII')
+
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    class InotifyWatcher(object):
+        """
+        Finds changed submissions with inotify. Raises OSError if the
+        directories can't be watched (e.g. too many of them for
+        fs.inotify.max_user_watches).
+        """
+
+        def __init__(self, root, max_depth=3):
+            self.root = root
+            self.max_depth = max_depth
+            # Watched path of every watch descriptor
+            self._paths = {}  # type: dict[int, str]
+            self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self._fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            try:
+                self._watch_tree(root, max_depth)
+            except OSError:
+                self.close()
+                raise
+
+        def _watch(self, path, mask):
+            wd = _libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    return  # Removed meanwhile
+                raise OSError(error, 'Could not watch %s: %s' %
+                              (path, os.strerror(error)))
+            self._paths[wd] = path
+
+        def _watch_tree(self, path, max_depth, found=None):
+            """Watches a directory and the ones inside it, up to max_depth."""
+            self._watch(path, parent_mask)
+            try:
+                entries = list(os.scandir(path))
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if re_submission.match(entry.name):
+                    self._watch(entry.path, submission_mask)
+                    if found is not None:
+                        found.add(entry.path)
+                elif max_depth > 1:
+                    self._watch_tree(entry.path, max_depth - 1, found)
+
+        def _depth(self, path):
+            return len(os.path.relpath(path, self.root).split(os.sep))
+
+        def changed_submissions(self, timeout):
+            """Same as PollingWatcher.changed_submissions()."""
+            readable, _, _ = select.select([self._fd], [], [], timeout)
+            if not readable:
+                return set()
+
+            changed = set()
+            while True:
+                try:
+                    data = os.read(self._fd, 64 * 1024)
+                except BlockingIOError:
+                    break
+                offset = 0
+                while offset < len(data):
+                    wd, mask, cookie, name_length = \
+                        inotify_event.unpack_from(data, offset)
+                    offset += inotify_event.size
+                    name = os.fsdecode(
+                        data[offset:offset + name_length].rstrip(b'\0'))
+                    offset += name_length
+                    self._handle_event(wd, mask, name, changed)
+            return changed
+
+        def _handle_event(self, wd, mask, name, changed):
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, check everything
+                changed.update(find_submissions(self.root, self.max_depth))
+                return
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                return
+            path = self._paths.get(wd)
+            if path is None:
+                return
+
+            if is_submission(path):
+                changed.add(path)
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                new_path = os.path.join(path, name)
+                if is_submission(new_path):
+                    self._watch(new_path, submission_mask)
+                    changed.add(new_path)
+                elif self._depth(new_path) < self.max_depth:
+                    # A whole tree may have been moved in
+                    self._watch_tree(new_path,
+                                     self.max_depth - self._depth(new_path),
+                                     changed)
+
+        def close(self):
+            if self._fd >= 0:
+                os.close(self._fd)
+                self._fd = -1
+else:
+    InotifyWatcher = None
+
+
+def create_watcher(root, poll_interval=30):
+    if InotifyWatcher is not None:
+        try:
+            return InotifyWatcher(root)
+        except OSError as err:
+            print('Warning: Could not use inotify, polling every %d seconds '
+                  'instead. Reason: %s' % (poll_interval, err))
+    return PollingWatcher(root, poll_interval)
+
+
+class PendingSubmission(object):
+    def __init__(self, signature, now):
+        self.signature = signature
+        self.first_changed = now
+        self.last_changed = now
+        # Failed attempts to ingest this version of the submission
+        self.failures = 0
+        self.retry_at = None
+
+
+class IngestDaemon(object):
+    def __init__(self, watcher, ingest, settle_seconds=5, batch_size=20,
+                 status_file=None, status_interval=10, state_file=None,
+                 retry_seconds=30, max_retry_seconds=3600):
+        """
+        :param ingest: Function ingesting a submission directory, called for
+        each one of a batch, and then with None when the batch is done.
+        """
+        self.watcher = watcher
+        self.ingest = ingest
+        self.settle_seconds = settle_seconds
+        self.batch_size = batch_size
+        self.status_file = status_file
+        self.status_interval = status_interval
+        self.state_file = state_file
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+
+        self.pending = {}  # type: dict[str, PendingSubmission]
+        # Signature digest of every submission ingested, by path
+        self.ingested = {}  # type: dict[str, str]
+        self.count_ingested = 0
+        self.count_failed = 0
+        self.last_error = None
+        self.last_batch_lag = None
+        self._last_status = None
+
+        if state_file is not None:
+            self.load_state(time.monotonic())
+
+    def load_state(self, now):
+        """
+        Queues the submissions that are new or changed since the state file
+        was saved. If there is no state file yet, saves the current one.
+        """
+        current = {path: submission_signature(path)
+                   for path in find_submissions(self.watcher.root)}
+        try:
+            with open(self.state_file) as f:
+                saved = json.load(f)['ingested']
+        except FileNotFoundError:
+            saved = None
+
+        if saved is None:
+            self.ingested = {path: signature_digest(signature)
+                             for path, signature in current.items()}
+            self.save_state()
+            return
+        self.ingested = {path: digest for path, digest in saved.items()
+                         if path in current}
+        changed = [path for path, signature in current.items()
+                   if saved.get(path) != signature_digest(signature)]
+        if changed:
+            print('%d submissions changed while not watching.' %
+                  len(changed))
+        self.add_changes(changed, now)
+
+    def save_state(self):
+        if self.state_file is not None:
+            write_json_atomically(self.state_file, {'ingested': self.ingested})
+
+    def add_changes(self, paths, now):
+        for path in paths:
+            signature = submission_signature(path)
+            pending = self.pending.get(path)
+            if pending is None:
+                self.pending[path] = PendingSubmission(signature, now)
+            else:
+                if signature != pending.signature:
+                    # A new version, which may ingest fine
+                    pending.failures = 0
+                    pending.retry_at = None
+                pending.signature = signature
+                pending.last_changed = now
+
+    def ready_submissions(self, now):
+        """Returns the submissions that stopped changing, oldest first."""
+        ready = []
+        for path, pending in list(self.pending.items()):
+            # Writes in place may not be notified again (polling), so the
+            # signature is checked too
+            signature = submission_signature(path)
+            if signature != pending.signature:
+                pending.signature = signature
+                pending.last_changed = now
+                pending.failures = 0
+                pending.retry_at = None
+            elif signature is None:
+                del self.pending[path]  # Removed
+                self.ingested.pop(path, None)
+            elif pending.retry_at is not None and now < pending.retry_at:
+                continue
+            elif now - pending.last_changed >= self.settle_seconds and \
+                    is_complete(path):
+                ready.append(path)
+        ready.sort(key=lambda path: self.pending[path].first_changed)
+        return ready[:self.batch_size]
+
+    def record_error(self, message):
+        self.last_error = message
+        print('Error: %s' % message)
+
+    def ingest_batch(self, paths, now):
+        first_changed = min(self.pending[path].first_changed
+                            for path in paths)
+        count_done = 0
+        for path in paths:
+            pending = self.pending.pop(path)
+            try:
+                self.ingest(path)
+            except Exception as err:
+                # Kept waiting, to be tried again later (e.g. ElasticSearch
+                # may be down)
+                self.count_failed += 1
+                pending.failures += 1
+                pending.retry_at = time.monotonic() + min(
+                    self.retry_seconds * 2 ** (pending.failures - 1),
+                    self.max_retry_seconds)
+                self.pending[path] = pending
+                self.record_error('Could not ingest %s: %s: %s' %
+                                  (path, type(err).__name__, err))
+            else:
+                self.count_ingested += 1
+                count_done += 1
+                self.ingested[path] = signature_digest(pending.signature)
+        try:
+            self.ingest(None)
+        except Exception as err:
+            # The submissions will still become searchable when
+            # ElasticSearch refreshes the index by itself
+            self.record_error('Could not finish batch: %s: %s' %
+                              (type(err).__name__, err))
+        self.save_state()
+        self.last_batch_lag = time.monotonic() - first_changed
+        print('Ingested %d submissions, %.1f seconds after they changed. '
+              '%d waiting.' % (count_done, self.last_batch_lag,
+                               len(self.pending)))
+
+    def status(self, now):
+        oldest = min((pending.first_changed
+                      for pending in self.pending.values()), default=None)
+        return {
+            'time': time.time(),
+            'waiting': len(self.pending),
+            'retrying': sum(1 for pending in self.pending.values()
+                            if pending.failures > 0),
+            'ingested': self.count_ingested,
+            'failed': self.count_failed,
+            'last_error': self.last_error,
+            'oldest_waiting_seconds': now - oldest
+            if oldest is not None else None,
+            'last_batch_lag_seconds': self.last_batch_lag,
+        }
+
+    def write_status(self, now):
+        self._last_status = now
+        if self.status_file is None:
+            return
+        write_json_atomically(self.status_file, self.status(now))
+
+    def step(self, timeout=1):
+        self.add_changes(self.watcher.changed_submissions(timeout),
+                         time.monotonic())
+        now = time.monotonic()
+        ready = self.ready_submissions(now)
+        if ready:
+            self.ingest_batch(ready, now)
+            self.write_status(time.monotonic())
+        elif self._last_status is None or \
+                now - self._last_status >= self.status_interval:
+            self.write_status(now)
+
+    def run_forever(self):
+        try:
+            while True:
+                self.step()
+        finally:
+            self.watcher.close()
+
+
+class TestIngestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.ingested = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_submission(self, name, files=('submission.yaml',
+                                            'publication.json')):
+        path = os.path.join(self.root, 'data', name)
+        os.makedirs(path, exist_ok=True)
+        for file_name in files:
+            with open(os.path.join(path, file_name), 'a') as f:
+                f.write('x')
+        return path
+
+    def make_daemon(self, watcher):
+        return IngestDaemon(watcher, self.ingested.append, settle_seconds=0.2,
+                            status_file=os.path.join(self.root, 'status.json'))
+
+    def run_daemon(self, daemon, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            daemon.step(timeout=0.05)
+
+    def check_watcher(self, watcher):
+        daemon = self.make_daemon(watcher)
+        existing = self.write_submission('ins1')
+        self.run_daemon(daemon, 0.5)
+        self.assertEqual(self.ingested, [existing, None])
+
+        # Incomplete submissions wait for the rest of their files
+        new = self.write_submission('ins2', files=['submission.yaml'])
+        self.write_submission('not-a-submission')
+        self.run_daemon(daemon, 0.5)
+        self.assertEqual(self.ingested, [existing, None])
+        self.assertEqual(daemon.status(time.monotonic())['waiting'], 1)
+
+        self.write_submission('ins2', files=['publication.json'])
+        self.run_daemon(daemon, 0.5)
+        self.assertEqual(self.ingested, [existing, None, new, None])
+        with open(os.path.join(self.root, 'status.json')) as f:
+            status = json.load(f)
+        self.assertEqual((status['waiting'], status['ingested']), (0, 2))
+
+    def test_polling(self):
+        os.mkdir(os.path.join(self.root, 'data'))
+        self.check_watcher(PollingWatcher(self.root, poll_interval=0.05))
+
+    @unittest.skipIf(InotifyWatcher is None, 'inotify is not available')
+    def test_inotify(self):
+        os.mkdir(os.path.join(self.root, 'data'))
+        self.check_watcher(InotifyWatcher(self.root))
+
+    def test_failures(self):
+        failures = []
+
+        def ingest(path):
+            if path is not None and len(failures) < 2:
+                failures.append(path)
+                raise ValueError('Bad submission')
+            self.ingested.append(path)
+
+        daemon = IngestDaemon(PollingWatcher(self.root, poll_interval=0.05),
+                              ingest, settle_seconds=0, retry_seconds=0.2)
+        path = self.write_submission('ins3')
+        self.run_daemon(daemon, 0.15)
+        self.assertEqual(daemon.count_failed, 1)
+        self.assertIn('Bad submission', daemon.last_error)
+        self.assertEqual(daemon.status(time.monotonic())['retrying'], 1)
+
+        # Tried again after 0.2 seconds, then after 0.4 more
+        self.run_daemon(daemon, 0.3)
+        self.assertEqual(failures, [path, path])
+        self.assertEqual(self.ingested, [None, None])
+        self.run_daemon(daemon, 0.5)
+        self.assertEqual(self.ingested, [None, None, path, None])
+        self.assertEqual((daemon.count_failed, daemon.count_ingested), (2, 1))
+        self.assertEqual(daemon.pending, {})
+
+    def test_refresh_failure(self):
+        def ingest(path):
+            if path is None:
+                raise ConnectionError('No ElasticSearch')
+            self.ingested.append(path)
+
+        daemon = IngestDaemon(PollingWatcher(self.root, poll_interval=0.05),
+                              ingest, settle_seconds=0)
+        path = self.write_submission('ins4')
+        self.run_daemon(daemon, 0.2)
+        self.assertEqual(self.ingested, [path])
+        self.assertIn('No ElasticSearch', daemon.last_error)
+
+    def test_catch_up(self):
+        state_file = os.path.join(self.root, 'state.json')
+        unchanged = self.write_submission('ins5')
+        changed = self.write_submission('ins6')
+
+        # Without a state file, what is on disk is taken as indexed
+        daemon = IngestDaemon(PollingWatcher(self.root, poll_interval=0.05),
+                              self.ingested.append, settle_seconds=0,
+                              state_file=state_file)
+        self.assertEqual(daemon.pending, {})
+        self.assertEqual(sorted(daemon.ingested), [unchanged, changed])
+
+        # Changed and added while the daemon is stopped
+        self.write_submission('ins6')
+        new = self.write_submission('ins7')
+        daemon = IngestDaemon(PollingWatcher(self.root, poll_interval=0.05),
+                              self.ingested.append, settle_seconds=0,
+                              state_file=state_file)
+        self.run_daemon(daemon, 0.2)
+        self.assertEqual(sorted(self.ingested[:2]), [changed, new])
+        self.assertEqual(self.ingested[2:], [None])
+
+        # Nothing left to do on the next start
+        daemon = IngestDaemon(PollingWatcher(self.root, poll_interval=0.05),
+                              self.ingested.append, settle_seconds=0,
+                              state_file=state_file)
+        self.assertEqual(daemon.pending, {})
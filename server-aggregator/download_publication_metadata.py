@@ -1,47 +1,434 @@
+import asyncio
+import email.utils
+import json
 import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
 from concurrent.futures.thread import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import re
 
+import aiohttp
 import argh
 import requests
 from contextualized import contextualized_tracebacks
+from requests.adapters import HTTPAdapter
 
 re_record = re.compile(r'.*ins(\d+)$')
 
+default_base_url = 'https://hepdata.net'
+# Kept next to publication.json: the ETag and Last-Modified of the response it
+# was saved from, sent back in conditional requests when refreshing it.
+validators_file_name = 'publication.http.json'
 
-def download_publication(publication_path):
-    publication_path = publication_path.rstrip('/')
-    dest_file_path = os.path.join(publication_path, 'publication.json')
-    if os.path.exists(dest_file_path):
-        return
 
+class RateLimiter(object):
+    """Spaces out requests (from any thread) to at most rate per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes the next free slot, returning the seconds until it."""
+        if self.interval == 0:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        return slot - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# Longer waits asked by Retry-After are shortened to this, in seconds
+max_retry_after = 300
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait given by a Retry-After header, or None if
+    there is no header or it is malformed.
+    """
+    if value is None:
+        return None
+    try:
+        delay = int(value)
+    except ValueError:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        delay = date.timestamp() - time.time()
+    return min(max(0, delay), max_retry_after)
+
+
+def retry_delay(attempt, backoff, retry_after=None):
+    delay = parse_retry_after(retry_after)
+    if delay is None:
+        # "Full jitter", so that failed requests don't retry together
+        delay = random.uniform(0, backoff * 2 ** attempt)
+    return delay
+
+
+def is_retryable_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+
+def publication_url(base_url, inspire_record):
+    return base_url + '/record/ins' + inspire_record + \
+        '?format=json&light=true'
+
+
+def find_record(publication_path):
+    """Returns the INSPIRE record of a submission directory, or None."""
     match = re_record.match(publication_path)
     if match:
-        inspire_record = match.groups()[0]
+        return match.groups()[0]
     else:
-        print('Ignoring directory with invalid format: %s' % publication_path)
-        return
+        print('Ignoring directory with invalid format: %s' %
+              publication_path)
+        return None
+
+
+def conditional_headers(publication_path):
+    """Returns the headers to only get publication.json if it changed."""
+    validators_path = os.path.join(publication_path, validators_file_name)
+    headers = {}
+    if os.path.exists(os.path.join(publication_path, 'publication.json')) \
+            and os.path.exists(validators_path):
+        with open(validators_path) as f:
+            validators = json.load(f)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+    return headers
 
-    response = requests.get('https://hepdata.net/record/ins' + inspire_record +
-                            '?format=json&light=true')
 
+def is_not_found(status_code, text):
     # Not Found errors don't use real 404 codes
-    if "we weren't able to find what you were looking for" in response.text:
-        print('Warning: Not Found error on %s' % inspire_record)
-        return
+    return status_code == 404 or \
+        "we weren't able to find what you were looking for" in text
+
+
+def write_file_atomically(path, text):
+    """Writes a file through a temporary file, never leaving it half written."""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def save_publication(publication_path, text, headers):
+    """Saves a downloaded publication.json with its validators."""
+    assert json.loads(text) is not None
+
+    validators_path = os.path.join(publication_path, validators_file_name)
+    write_file_atomically(os.path.join(publication_path, 'publication.json'),
+                          text)
+    validators = {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+    }
+    if any(validators.values()):
+        write_file_atomically(validators_path, json.dumps(validators))
+    elif os.path.exists(validators_path):
+        os.unlink(validators_path)
+
+
+class Downloader(object):
+    def __init__(self, base_url=default_base_url, workers=64, rate_limit=20,
+                 retries=5, timeout=30, backoff=1, only_missing=False):
+        self.base_url = base_url.rstrip('/')
+        self.retries = retries
+        self.timeout = timeout
+        # Longest wait between retries is backoff * 2 ** retries
+        self.backoff = backoff
+        self.only_missing = only_missing
+        self.rate_limiter = RateLimiter(rate_limit)
+
+        # Connections are kept alive and shared by the threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers,
+                              pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.results = {}  # type: dict[str, int]
+        self._results_lock = threading.Lock()
+
+    def _count(self, result):
+        with self._results_lock:
+            self.results[result] = self.results.get(result, 0) + 1
+        return result
+
+    def fetch(self, url, headers):
+        """
+        GETs a URL, retrying with jittered exponential backoff after
+        connection errors, timeouts, 429 and 5xx responses.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            retry_after = None
+            try:
+                response = self.session.get(url, headers=headers,
+                                            timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if not is_retryable_status(response.status_code):
+                    return response
+                if attempt >= self.retries:
+                    response.raise_for_status()
+                retry_after = response.headers.get('Retry-After')
+
+            delay = retry_delay(attempt, self.backoff, retry_after)
+            attempt += 1
+            self._count('retries')
+            time.sleep(delay)
+
+    def download_publication(self, publication_path):
+        """
+        Downloads the publication.json of a submission directory, or refreshes
+        it if it exists. Returns what happened: 'downloaded',
+        'not_modified', 'not_found', 'skipped' or 'invalid'.
+        """
+        publication_path = publication_path.rstrip('/')
+        if self.only_missing and os.path.exists(
+                os.path.join(publication_path, 'publication.json')):
+            return self._count('skipped')
+
+        inspire_record = find_record(publication_path)
+        if inspire_record is None:
+            return self._count('invalid')
+
+        response = self.fetch(publication_url(self.base_url, inspire_record),
+                              conditional_headers(publication_path))
+        if response.status_code == 304:
+            return self._count('not_modified')
+        if is_not_found(response.status_code, response.text):
+            print('Warning: Not Found error on %s' % inspire_record)
+            return self._count('not_found')
+        response.raise_for_status()
+
+        save_publication(publication_path, response.text, response.headers)
+        return self._count('downloaded')
+
+
+class HTTPStatusError(Exception):
+    pass
+
+
+class Progress(object):
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        rate = self.done / elapsed
+        if self.done > 0:
+            eta = '%d:%02d' % divmod(int((self.total - self.done) / rate), 60)
+        else:
+            eta = '?'
+        return '%d/%d publications (%.1f%%), %.1f/s, %.1f kB/s, ETA %s' % (
+            self.done, self.total, 100 * self.done / max(self.total, 1), rate,
+            self.bytes / 1024 / elapsed, eta)
 
-    assert response.json() is not None
 
-    with open(dest_file_path, 'w') as f:
-        f.write(response.text)
+class AsyncDownloader(object):
+    """
+    Same as Downloader, but with asyncio: all the requests are made from a
+    single thread, with at most connections of them at once (and
+    per_host_limit to the same host).
+    """
 
+    def __init__(self, base_url=default_base_url, connections=64,
+                 per_host_limit=32, rate_limit=20, retries=5, timeout=30,
+                 backoff=1, only_missing=False):
+        self.base_url = base_url.rstrip('/')
+        self.connections = connections
+        self.per_host_limit = per_host_limit
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.only_missing = only_missing
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.results = {}  # type: dict[str, int]
+        # Publications that could not be downloaded, with the error
+        self.failures = []  # type: list[tuple[str, str]]
+        self.progress = None  # type: Progress
 
-def download_publications(*directory_paths):
-    with ThreadPoolExecutor(max_workers=64) as executor:
+    def _count(self, result):
+        self.results[result] = self.results.get(result, 0) + 1
+        return result
+
+    async def fetch(self, session, url, headers):
+        """Returns (status, headers, text), retrying like Downloader.fetch."""
+        attempt = 0
+        while True:
+            delay = self.rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            retry_after = None
+            try:
+                async with session.get(url, headers=headers) as response:
+                    if not is_retryable_status(response.status) or \
+                            attempt >= self.retries:
+                        text = await response.text()
+                        self.progress.bytes += len(text)
+                        return response.status, response.headers, text
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= self.retries:
+                    raise
+
+            delay = retry_delay(attempt, self.backoff, retry_after)
+            attempt += 1
+            self._count('retries')
+            await asyncio.sleep(delay)
+
+    async def download_publication(self, session, publication_path):
+        publication_path = publication_path.rstrip('/')
+        if self.only_missing and os.path.exists(
+                os.path.join(publication_path, 'publication.json')):
+            return self._count('skipped')
+
+        inspire_record = find_record(publication_path)
+        if inspire_record is None:
+            return self._count('invalid')
+
+        status, headers, text = await self.fetch(
+            session, publication_url(self.base_url, inspire_record),
+            conditional_headers(publication_path))
+        if status == 304:
+            return self._count('not_modified')
+        if is_not_found(status, text):
+            print('Warning: Not Found error on %s' % inspire_record)
+            return self._count('not_found')
+        if status >= 400:
+            raise HTTPStatusError('HTTP status %d' % status)
+
+        save_publication(publication_path, text, headers)
+        return self._count('downloaded')
+
+    async def _worker(self, session, queue):
+        while True:
+            path = await queue.get()
+            try:
+                await self.download_publication(session, path)
+            except Exception as error:
+                self._count('failed')
+                self.failures.append((path, format_error(error)))
+            finally:
+                self.progress.done += 1
+                queue.task_done()
+
+    async def _report_progress(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.progress.line(), file=sys.stderr)
+
+    async def download_publications(self, directory_paths,
+                                    progress_interval=5):
+        self.progress = Progress(len(directory_paths))
+        queue = asyncio.Queue()
+        for path in directory_paths:
+            queue.put_nowait(path)
+
+        connector = aiohttp.TCPConnector(limit=self.connections,
+                                         limit_per_host=self.per_host_limit)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+            tasks = [asyncio.ensure_future(self._worker(session, queue))
+                     for i in range(min(self.connections,
+                                        len(directory_paths)))]
+            reporter = asyncio.ensure_future(
+                self._report_progress(progress_interval))
+            try:
+                await queue.join()
+            finally:
+                for task in tasks + [reporter]:
+                    task.cancel()
+                await asyncio.gather(*tasks, reporter,
+                                     return_exceptions=True)
+
+
+def format_error(error):
+    return '%s: %s' % (type(error).__name__, error)
+
+
+def write_failures(failures, failures_file):
+    """
+    Writes the directories of the failed publications, one per line, so
+    they can be retried with $(cat failures_file).
+    """
+    write_file_atomically(failures_file,
+                          ''.join(path + '\n' for path, error in failures))
+    print('%d publications failed:' % len(failures), file=sys.stderr)
+    for path, error in failures[:20]:
+        print('    %s: %s' % (path, error), file=sys.stderr)
+    if len(failures) > 20:
+        print('    ...', file=sys.stderr)
+    print('Retry them with: %s %s --use-asyncio $(cat %s)' % (
+        sys.executable, sys.argv[0], failures_file), file=sys.stderr)
+
+
+def download_publications(*directory_paths, workers=64, rate_limit=20.0,
+                          retries=5, timeout=30.0, only_missing=False,
+                          base_url=default_base_url, use_asyncio=False,
+                          per_host_limit=32,
+                          failures_file='failed-publications.txt'):
+    # Existing publication.json files are refreshed, with conditional requests
+    # if they were saved with an ETag or Last-Modified date. Use
+    # --only-missing to skip them instead. --rate-limit is in requests per
+    # second (0 for no limit), --timeout in seconds.
+    #
+    # With --use-asyncio, up to --workers requests are made at once from a
+    # single thread, progress is reported as it goes and publications that
+    # fail don't stop the others: they are listed in --failures-file.
+    if use_asyncio:
+        downloader = AsyncDownloader(base_url, workers, per_host_limit,
+                                     rate_limit, retries, timeout,
+                                     only_missing=only_missing)
+        asyncio.run(downloader.download_publications(directory_paths))
+        print(downloader.progress.line(), file=sys.stderr)
+        print(', '.join('%s: %d' % item
+                        for item in sorted(downloader.results.items())))
+        if downloader.failures:
+            write_failures(downloader.failures, failures_file)
+            sys.exit(1)
+        return
+
+    downloader = Downloader(base_url, workers, rate_limit, retries, timeout,
+                            only_missing=only_missing)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
         tasks = []
         for path in directory_paths:
-            future = executor.submit(download_publication, path)
+            future = executor.submit(downloader.download_publication, path)
             tasks.append((future, path))
 
         # Wait for all subprocesses to finish, in the same order they were
@@ -53,6 +440,134 @@ def download_publications(*directory_paths):
                 print('Error caught in submission directory "%s"' % path)
                 raise error
 
+    print(', '.join('%s: %d' % item
+                    for item in sorted(downloader.results.items())))
+
+
+class FakeHEPDataHandler(BaseHTTPRequestHandler):
+    # Set by TestDownloader
+    responses = None
+
+    def do_GET(self):
+        record = re.match(r'/record/ins(\d+)', self.path).group(1)
+        status, headers, body = self.responses[record](self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloader(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        self.failures_left = 2
+
+        def versioned(request_headers):
+            self.requests.append(request_headers.get('If-None-Match'))
+            if request_headers.get('If-None-Match') == '"v1"':
+                return 304, {}, b''
+            return 200, {'ETag': '"v1"'}, b'{"version": 1}'
+
+        def flaky(request_headers):
+            if self.failures_left > 0:
+                self.failures_left -= 1
+                # Malformed, so the usual backoff is used
+                return 503, {'Retry-After': ('garbage', '1.5')[
+                    self.failures_left % 2]}, b''
+            return 200, {}, b'{"version": 2}'
+
+        def not_found(request_headers):
+            return 200, {}, b"<p>we weren't able to find what you were " \
+                            b"looking for</p>"
+
+        FakeHEPDataHandler.responses = {
+            '1': versioned, '2': flaky, '3': not_found}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          FakeHEPDataHandler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+        self.data_dir = tempfile.mkdtemp()
+        for record in FakeHEPDataHandler.responses:
+            os.mkdir(os.path.join(self.data_dir, 'ins' + record))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.data_dir)
+
+    def download(self, record, **kwargs):
+        downloader = Downloader('http://127.0.0.1:%d' %
+                                self.server.server_address[1],
+                                workers=2, rate_limit=0, backoff=0.01,
+                                **kwargs)
+        return downloader.download_publication(
+            os.path.join(self.data_dir, 'ins' + record))
+
+    def test_conditional_refresh(self):
+        self.assertEqual(self.download('1'), 'downloaded')
+        self.assertEqual(self.download('1'), 'not_modified')
+        self.assertEqual(self.requests, [None, '"v1"'])
+        self.assertEqual(self.download('1', only_missing=True), 'skipped')
+        with open(os.path.join(self.data_dir, 'ins1',
+                               'publication.json')) as f:
+            self.assertEqual(json.load(f), {'version': 1})
+
+    def test_retries(self):
+        self.assertEqual(self.download('2'), 'downloaded')
+        self.assertEqual(self.failures_left, 0)
+        self.failures_left = 2
+        with self.assertRaises(requests.HTTPError):
+            self.download('2', retries=1)
+
+    def test_not_found(self):
+        self.assertEqual(self.download('3'), 'not_found')
+        self.assertFalse(os.path.exists(
+            os.path.join(self.data_dir, 'ins3', 'publication.json')))
+
+    def test_asyncio(self):
+        os.mkdir(os.path.join(self.data_dir, 'invalid'))
+        paths = [os.path.join(self.data_dir, name)
+                 for name in ('ins1', 'ins2', 'ins3', 'invalid')]
+        downloader = AsyncDownloader('http://127.0.0.1:%d' %
+                                     self.server.server_address[1],
+                                     connections=2, rate_limit=0, retries=1,
+                                     backoff=0.01)
+        asyncio.run(downloader.download_publications(paths))
+        self.assertEqual(downloader.results, {
+            'downloaded': 1, 'not_found': 1, 'invalid': 1, 'failed': 1,
+            'retries': 1})
+        self.assertEqual([path for path, error in downloader.failures],
+                         [paths[1]])
+        self.assertEqual(downloader.progress.done, 4)
+
+        downloader.results = {}
+        asyncio.run(downloader.download_publications(paths[:2]))
+        self.assertEqual(downloader.results, {
+            'downloaded': 1, 'not_modified': 1})
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('2'), 2)
+        self.assertEqual(parse_retry_after('-2'), 0)
+        self.assertEqual(parse_retry_after('86400'), max_retry_after)
+        self.assertEqual(parse_retry_after(email.utils.formatdate(0)), 0)
+        self.assertGreater(parse_retry_after(
+            email.utils.formatdate(time.time() + 60, usegmt=True)), 50)
+        for invalid in (None, 'garbage', '1.5', ''):
+            self.assertIsNone(parse_retry_after(invalid))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(50)
+        start = time.monotonic()
+        for i in range(6):
+            limiter.wait()
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
 
 if __name__ == '__main__':
     argh.dispatch_command(download_publications)